@@ -3,7 +3,7 @@ import subprocess
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from common import explode, bsub
+from common import bsub, interval_index, overlapping_pairs
 import re
 import time
 import tempfile
@@ -23,6 +23,8 @@ parser.add_argument('build', type=str, help='Genome build (e.g., mm10)')
 parser.add_argument('prefix', type=str, help='Prefix for outfile.')
 parser.add_argument('-d', '--distance', type=int, default=2000, help='Distance threshold to define upstream/downstream of a gene.')
 parser.add_argument('-o', '--output_dir', default='.', help='Window size for merging intra and inter replicate peaks.')
+parser.add_argument('--native', action='store_true', help='Annotate in-process from <db>/<build>_refGene.txt instead of submitting ANNOVAR.')
+parser.add_argument('--splicing_threshold', type=int, default=2, help='Distance from an exon boundary still called splicing (--native).')
 parser.add_argument('--debug', action='store_true', help='')
 args = parser.parse_args()
 
@@ -97,63 +99,341 @@ def format_gene_annotation(variant_function_file):
 
     df = df.drop(['null1', 'null2'], axis=1)
 
-    # two types of annotation cases with 
-    # multiple gene hits. Format each separately.
+    return(format_variant_function(df))
 
-    # first case: multiple up/downstream gene hits 
-    spec_df = df[df['gene_region'] == 'upstream;downstream']
-    df = df.drop(spec_df.index.tolist())
+def _flanking_genes(region, desc):
 
-    spec_df['gene_region'] = spec_df['gene_region'].map(lambda x: x.split(';'))
-    spec_df['gene_desc'] = spec_df['gene_desc'].map(lambda x: x.split(';'))
-    spec_df = explode(spec_df, ['gene_desc', 'gene_region'])
+    # split a multi-gene flanking annotation into one entry per gene:
+    # 'upstream;downstream' rows carry one gene list per side, and genes at
+    # the same distance are listed as 'A,B(dist=N)', sharing the last suffix
 
-    df = pd.concat([df, spec_df], ignore_index=True, sort=True)
+    entries = list()
+    for side, (r, d) in enumerate(zip(region.split(';'), desc.split(';'))):
 
-    spec_cols = ['upstream', 'downstream']
+        genes = d.split(',')
+        if len(genes) == 1:
+            entries.append((r, d, side, False, 0))
+            continue
 
-    # second case: equidistant up/downstream gene hits
-    equid_df = df[df['gene_desc'].str.contains(',') & df['gene_region'].isin(spec_cols)] 
-    df = df.drop(equid_df.index.tolist()) 
+        suffix = re.search(r'(\(dist\=[0-9]+\))', genes[-1]).group(0)
+        entries += [(r, g + suffix, side, True, k) for k, g in enumerate(genes[:-1])]
+        entries.append((r, genes[-1], side, True, len(genes) - 1))
 
-    # add (dist=<int>) suffix to each ',' separated gene_desc value
-    equid_df['gene_desc'] = equid_df['gene_desc'].map(lambda x: [x.split(',')[i] + re.search(r'(\(dist\=[0-9]+\))', x.split(',')[-1]).group(0) for i in range(len(x.split(',')) - 1)] + [x.split(',')[-1]]) 
+    return(entries)
 
-    equid_df = explode(equid_df, ['gene_desc'])
+def format_variant_function(df):
 
-    df = pd.concat([df, equid_df], ignore_index=True, sort=True)
+    # df has the variant_function columns gene_region, gene_desc, chr,
+    # start, end and peak_id, from ANNOVAR or from annotate_native
 
-    # make distance into separate columns 
-    dist_cols = ['upstream', 'downstream', 'intergenic']
-    dist_df = df[df['gene_region'].isin(dist_cols)]   
-    df = df.drop(dist_df.index.tolist()) 
+    df = df.reset_index(drop=True)
+    df['pos'] = np.arange(df.shape[0])
 
-    dist_df['dist'] = dist_df['gene_desc'].map(lambda x: re.search(r'(?<=\(dist=)[0-9A-Z]+(?=\))', x).group(0))
-    df['dist'] = 0
+    # two types of annotation cases with multiple gene hits, both flanking:
+    # multiple up/downstream gene hits ('upstream;downstream') and
+    # equidistant up/downstream gene hits ('A,B(dist=N)'); these rows are
+    # split into one row per gene with a single explode
 
-    df = pd.concat([df, dist_df], ignore_index=True, sort=True)
+    flank = df['gene_region'].isin(['upstream', 'downstream', 'upstream;downstream'])
+    multi = flank & (df['gene_region'].str.contains(';') | df['gene_desc'].str.contains(',', regex=False))
 
-    # make gene as separate column 
-    df['gene'] = df['gene_desc'].map(lambda x: re.search(r'(^[A-Za-z0-9]+)', x).group(0))
+    multi_df = df[multi]
+    entries = [_flanking_genes(r, d) for r, d in zip(multi_df['gene_region'], multi_df['gene_desc'])]
+    multi_df = multi_df.assign(entry=entries).explode('entry').reset_index(drop=True)
+
+    fields = pd.DataFrame(multi_df['entry'].tolist(), index=multi_df.index, columns=['gene_region', 'gene_desc', 'side', 'equid', 'k'])
+    multi_df = multi_df.drop(columns=['gene_region', 'gene_desc', 'entry']).join(fields)
+    multi_df['spec'] = df['gene_region'].values[multi_df['pos'].values] == 'upstream;downstream'
+
+    df = df[~multi].assign(side=0, equid=False, k=0, spec=False)
+    df = pd.concat([df, multi_df[df.columns]], ignore_index=True)
+
+    # row order of the original step-wise formatting (which appended each
+    # reformatted subset to the end): by whether the row has a distance, is
+    # a split equidistant gene, comes from an 'upstream;downstream' row, and
+    # then by input position, side and gene position
+
+    dist = df['gene_region'].isin(['upstream', 'downstream', 'intergenic']).values
+    order = np.lexsort((df['k'].values, df['side'].values, df['pos'].values, df['spec'].values, df['equid'].values, dist))
+    df = df.iloc[order]
+    dist = dist[order]
+
+    # distance (first '(dist=N)') and gene (leading name) as separate columns
+    df['dist'] = '0'
+    df.loc[dist, 'dist'] = df.loc[dist, 'gene_desc'].str.extract(r'\(dist=([0-9A-Z]+)\)', expand=False)
+    df['gene'] = df['gene_desc'].str.extract(r'^([A-Za-z0-9]+)', expand=False)
 
     # drop 'NONE' intergenic flanking rows
-    mask = df['gene'].map(lambda x: x == 'NONE')
-    df = df[[not i for i in mask]]
+    df = df[df['gene'] != 'NONE']
 
     # final formatting
-    df = df[['gene', 'gene_region', 'chr', 'start', 'end', 'peak_id', 'dist']]
+    df = df[['gene', 'gene_region', 'chr', 'start', 'end', 'peak_id', 'dist']].reset_index(drop=True)
     df['dist'] = df['dist'].astype(np.int32)
+    df['gene_region'] = df['gene_region'].astype('category')
 
     return(df) 
 
+# native gene annotation (--native): the ANNOVAR gene-based categories and
+# precedence, computed in-process from the same <build>_refGene.txt table
+
+REGIONS = ['exonic', 'splicing', 'ncRNA_exonic', 'ncRNA_splicing', 'ncRNA_intronic', 'UTR5', 'UTR3', 'intronic', 'upstream', 'downstream']
+
+# ANNOVAR precedence: exonic = splicing > ncRNA > UTR5 = UTR3 > intronic >
+# upstream = downstream > intergenic; regions of equal rank are reported
+# together (e.g. 'exonic;splicing')
+RANKS = np.array([0, 0, 1, 1, 2, 3, 3, 4, 5, 5])
+
+CHROM_SPAN = np.int64(1) << 32
+
+def _join_runs(keys, values, sep):
+
+    # join values over runs of equal (sorted) keys; faster than a groupby
+    # with str.join for many small groups
+
+    if not len(keys):
+        return(np.zeros(0, dtype=np.int64), [])
+
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    bounds = np.r_[first, len(keys)]
+    values = list(values)
+
+    return(first, [sep.join(values[a:b]) for a, b in zip(bounds[:-1], bounds[1:])])
+
+def index_refgene(refgene):
+
+    # per-transcript arrays sorted by chromosome and start, with the exons of
+    # each transcript stored contiguously (1-based, inclusive coordinates);
+    # chromosomes are matched without their 'chr' prefix, as in ANNOVAR
+
+    colnames = ['name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'name2']
+    df = pd.read_csv(refgene, sep='\t', header=None, usecols=[1,2,3,4,5,6,7,8,9,10,12], names=colnames, dtype={'chrom':str, 'name2':str})
+
+    df['chrom'] = df['chrom'].str.replace(r'^chr', '', regex=True)
+    df = df.sort_values(['chrom', 'txStart'], kind='stable')
+
+    n_exons = df['exonCount'].values.astype(np.int64)
+    ex_start = np.array(''.join(df['exonStarts']).split(',')[:-1], dtype=np.int64) + 1
+    ex_end = np.array(''.join(df['exonEnds']).split(',')[:-1], dtype=np.int64)
+
+    chroms, chrom_idx = np.unique(np.asarray(df['chrom'], dtype=str), return_inverse=True)
+
+    return({
+        'chroms': chroms,
+        'chrom': chrom_idx.astype(np.int64),
+        'plus': (df['strand'] == '+').values,
+        'tx_start': df['txStart'].values.astype(np.int64) + 1,
+        'tx_end': df['txEnd'].values.astype(np.int64),
+        'cds_start': df['cdsStart'].values.astype(np.int64) + 1,
+        'cds_end': df['cdsEnd'].values.astype(np.int64),
+        'coding': (df['cdsStart'] != df['cdsEnd']).values,
+        'gene': np.asarray(df['name2'], dtype=str),
+        'exon_offset': np.concatenate([[0], np.cumsum(n_exons)]),
+        'exon_start': ex_start,
+        'exon_end': ex_end,
+    })
+
+def load_refgene(db, build):
+
+    # the indexed table is cached next to the refGene file (.npz) and
+    # rebuilt when the table is newer than the cache
+
+    refgene = os.path.join(db, build + '_refGene.txt')
+    cache = os.path.join(db, build + '_refGene.intervals.npz')
+
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(refgene):
+        return(dict(np.load(cache)))
+
+    ref = index_refgene(refgene)
+    try:
+        np.savez(cache, **ref)
+    except OSError:
+        print('could not cache refGene index at {}.'.format(cache))
+
+    return(ref)
+
+def _overlaps_segment(seg, offset, starts, ends, qs, qe):
+
+    # for query intervals [qs, qe] paired with segments seg (transcripts),
+    # whether any interval of that segment overlaps; the intervals of each
+    # segment are disjoint and sorted, so one search on a (segment, end)
+    # key finds the first candidate
+
+    if not len(starts):
+        return(np.zeros(len(seg), dtype=bool))
+
+    seg_of = np.repeat(np.arange(len(offset)-1), np.diff(offset))
+    key = seg_of * CHROM_SPAN + ends
+
+    k = np.searchsorted(key, seg * CHROM_SPAN + qs, side='left')
+    inside = k < offset[seg+1]
+    k = np.minimum(k, len(starts)-1)
+
+    return(inside & (starts[k] <= qe) & (qs <= qe))
+
+def _splice_sites(ref, threshold):
+
+    # intronic bases within threshold of an internal exon boundary, as one
+    # or two intervals per intron (one when the intron is short)
+
+    offset = ref['exon_offset']
+    n = np.diff(offset)
+
+    last = np.zeros(len(ref['exon_end']), dtype=bool)
+    last[offset[1:][n > 0] - 1] = True
+
+    a = ref['exon_end'][~last] + 1 # first intronic base
+    b = np.roll(ref['exon_start'], -1)[~last] - 1 # last intronic base
+    tx = np.repeat(np.arange(len(n)), n)[~last]
+
+    keep = a <= b
+    a, b, tx = a[keep], b[keep], tx[keep]
+
+    # left end of each intron (or all of it, if short), then the right end
+    short = (b - a + 1) <= 2 * threshold
+    starts = np.concatenate([a, (b - threshold + 1)[~short]])
+    ends = np.concatenate([np.where(short, b, a + threshold - 1), b[~short]])
+    tx = np.concatenate([tx, tx[~short]])
+
+    order = np.lexsort((starts, tx))
+    counts = np.bincount(tx, minlength=len(n))
+
+    return(np.concatenate([[0], np.cumsum(counts)]), starts[order], ends[order])
+
+def annotate_native(saf, db, build, dist, splicing_threshold=2):
+
+    # ANNOVAR-style variant_function rows (gene_region, gene_desc, chr,
+    # start, end, peak_id) for every peak, in input order
+
+    peaks = pd.read_csv(saf, sep='\t', header=None, usecols=[0,1,2,3], names=['peak_id', 'chr', 'start', 'end'], dtype={'chr':str})
+    ref = load_refgene(db, build)
+
+    # one coordinate axis for all chromosomes; peaks on chromosomes absent
+    # from refGene are placed after the last one and end up intergenic
+
+    chrom_lookup = pd.Series(np.arange(len(ref['chroms'])), index=ref['chroms'])
+    peak_chrom = chrom_lookup.reindex(peaks['chr'].str.replace(r'^chr', '', regex=True).values).fillna(len(ref['chroms'])).values.astype(np.int64)
+
+    ps = peaks['start'].values.astype(np.int64)
+    pe = peaks['end'].values.astype(np.int64)
+    qs = peak_chrom * CHROM_SPAN + ps
+    qe = peak_chrom * CHROM_SPAN + pe
+
+    base = ref['chrom'] * CHROM_SPAN
+    q, t = overlapping_pairs(interval_index(base + ref['tx_start'] - dist, base + ref['tx_end'] + dist), qs, qe)
+
+    # (peak, transcript) pairs within dist of the transcript: flanking or overlapping
+
+    s, e = ps[q], pe[q]
+    tx_s, tx_e = ref['tx_start'][t], ref['tx_end'][t]
+    plus, coding = ref['plus'][t], ref['coding'][t]
+    cds_s, cds_e = ref['cds_start'][t], ref['cds_end'][t]
+
+    before = e < tx_s
+    after = s > tx_e
+    within = ~before & ~after
+
+    offset = ref['exon_offset']
+    ex_s, ex_e = ref['exon_start'], ref['exon_end']
+
+    exon = within & _overlaps_segment(t, offset, ex_s, ex_e, s, e)
+    cds = exon & coding & _overlaps_segment(t, offset, ex_s, ex_e, np.maximum(s, cds_s), np.minimum(e, cds_e))
+    left_utr = exon & coding & ~cds & _overlaps_segment(t, offset, ex_s, ex_e, s, np.minimum(e, cds_s - 1))
+    right_utr = exon & coding & ~cds & _overlaps_segment(t, offset, ex_s, ex_e, np.maximum(s, cds_e + 1), e)
+
+    site_offset, site_s, site_e = _splice_sites(ref, splicing_threshold)
+    splicing = within & _overlaps_segment(t, site_offset, site_s, site_e, s, e)
+
+    hits = np.stack([
+        cds,                                # exonic
+        splicing & coding,                  # splicing
+        exon & ~coding,                     # ncRNA_exonic
+        splicing & ~coding,                 # ncRNA_splicing
+        within & ~exon & ~coding,           # ncRNA_intronic
+        (left_utr & plus) | (right_utr & ~plus),   # UTR5
+        (right_utr & plus) | (left_utr & ~plus),   # UTR3
+        within & ~exon & coding,            # intronic
+        (before & plus) | (after & ~plus),  # upstream
+        (after & plus) | (before & ~plus),  # downstream
+    ])
+
+    region, pair = np.nonzero(hits)
+    pair_dist = np.where(before[pair], tx_s[pair] - e[pair], np.where(after[pair], s[pair] - tx_e[pair], 0))
+
+    hits_df = pd.DataFrame({'peak': q[pair], 'rank': RANKS[region], 'region': region, 'gene': ref['gene'][t[pair]], 'dist': pair_dist})
+
+    # keep the best-ranked regions of each peak, one row per gene (nearest
+    # transcript for up/downstream), genes sorted as ANNOVAR reports them
+
+    hits_df = hits_df[hits_df['rank'] == hits_df.groupby('peak')['rank'].transform('min')]
+    hits_df = hits_df.sort_values(['peak', 'region', 'gene', 'dist']).drop_duplicates(['peak', 'region', 'gene'])
+
+    flank = hits_df['region'] >= REGIONS.index('upstream')
+    hits_df['desc'] = hits_df['gene'].where(~flank, hits_df['gene'] + '(dist=' + hits_df['dist'].astype(str) + ')')
+
+    peak = hits_df['peak'].values
+    region = hits_df['region'].values
+
+    first, region_desc = _join_runs(peak * len(REGIONS) + region, hits_df['desc'].values, ',')
+    region_peak, region_name = peak[first], np.array(REGIONS)[region[first]]
+
+    first, peak_region = _join_runs(region_peak, region_name, ';')
+    _, peak_desc = _join_runs(region_peak, region_desc, ';')
+    annotated = region_peak[first]
+
+    # intergenic: nearest transcript ends/starts on either side
+
+    gene_region = pd.Series('intergenic', index=peaks.index, dtype=object)
+    gene_desc = pd.Series('', index=peaks.index, dtype=object)
+
+    intergenic = np.ones(len(peaks), dtype=bool)
+    intergenic[annotated] = False
+    idx = np.flatnonzero(intergenic)
+
+    ends_order = np.argsort(base + ref['tx_end'], kind='stable')
+    starts_order = np.argsort(base + ref['tx_start'], kind='stable')
+
+    left = np.searchsorted((base + ref['tx_end'])[ends_order], qs[idx], side='left') - 1
+    right = np.searchsorted((base + ref['tx_start'])[starts_order], qe[idx], side='right')
+
+    left_tx = ends_order[np.maximum(left, 0)]
+    right_tx = starts_order[np.minimum(right, len(starts_order)-1)]
+
+    has_left = (left >= 0) & (ref['chrom'][left_tx] == peak_chrom[idx])
+    has_right = (right < len(starts_order)) & (ref['chrom'][right_tx] == peak_chrom[idx])
+
+    left_desc = np.where(has_left, np.char.add(np.char.add(ref['gene'][left_tx], '(dist='), (ps[idx] - ref['tx_end'][left_tx]).astype(str)), 'NONE(dist=NONE')
+    right_desc = np.where(has_right, np.char.add(np.char.add(ref['gene'][right_tx], '(dist='), (ref['tx_start'][right_tx] - pe[idx]).astype(str)), 'NONE(dist=NONE')
+
+    gene_desc.iloc[idx] = np.char.add(np.char.add(left_desc, '),'), np.char.add(right_desc, ')'))
+    gene_region.iloc[annotated] = peak_region
+    gene_desc.iloc[annotated] = peak_desc
+
+    return(pd.DataFrame({'gene_region': gene_region, 'gene_desc': gene_desc, 'chr': peaks['chr'], 'start': peaks['start'], 'end': peaks['end'], 'peak_id': peaks['peak_id']}))
+
+# ANNOVAR regions merged for the peak annotation; others are kept as is
+REGION_GROUPS = {
+    'UTR5': 'promoter-proximal',
+    'upstream': 'promoter-proximal',
+    'downstream': 'UTR3',
+    'ncRNA_exonic': 'exonic',
+    'splicing': 'intronic',
+    'ncRNA_intronic': 'intronic',
+    'ncRNA_splicing': 'intronic',
+}
+
 def regroup_gene_regions(df):
 
+    # one lookup per category rather than per row
+
     peak_annot = df 
 
-    peak_annot['gene_region'] = peak_annot['gene_region'].map(lambda x: 'promoter-proximal' if (x=='UTR5' or x=='upstream') else x)
-    peak_annot['gene_region'] = peak_annot['gene_region'].map(lambda x: 'UTR3' if (x=='UTR3' or x=='downstream') else x)
-    peak_annot['gene_region'] = peak_annot['gene_region'].map(lambda x: 'exonic' if (x=='exonic' or x=='ncRNA_exonic') else x)
-    peak_annot['gene_region'] = peak_annot['gene_region'].map(lambda x: 'intronic' if (x=='intronic' or x=='splicing' or x=='ncRNA_intronic' or x=='ncRNA_splicing') else x)
+    regions = peak_annot['gene_region'].astype('category')
+    grouped = pd.Index([REGION_GROUPS.get(x, x) for x in regions.cat.categories])
+    categories = grouped.unique()
+
+    codes = categories.get_indexer(grouped)[regions.cat.codes.values]
+    codes[regions.isna().values] = -1
+    peak_annot['gene_region'] = pd.Categorical.from_codes(codes, categories=categories)
 
     return(peak_annot)
 
@@ -162,21 +442,33 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    tmpdir = tempfile.mkdtemp(dir=args.output_dir)
+    if args.native:
+
+        print("[ {} ] Annotating peaks.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        annot_df = annotate_native(args.features, args.db, args.build, args.distance, args.splicing_threshold)
 
-    print("[ {} ] Preparing input.".format(datetime.now().strftime("%b %d %H:%M:%S")))   
-    avinput = prepare_avinput(args.features, tmpdir) 
+        print("[ {} ] Formatting Annotation.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        annot_df = format_variant_function(annot_df)
 
-    print("[ {} ] Running ANNOVAR.".format(datetime.now().strftime("%b %d %H:%M:%S")))
-    po, fp = run_gene_annotation(avinput, args.distance, args.build, args.db, tmpdir)
+    else:
 
-    # wait for processes to finish
-    while po.poll() is None:
-        time.sleep(0.5) 
+        tmpdir = tempfile.mkdtemp(dir=args.output_dir)
 
-    print("[ {} ] Formatting Annotation.".format(datetime.now().strftime("%b %d %H:%M:%S")))    
+        print("[ {} ] Preparing input.".format(datetime.now().strftime("%b %d %H:%M:%S")))   
+        avinput = prepare_avinput(args.features, tmpdir) 
+
+        print("[ {} ] Running ANNOVAR.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        po, fp = run_gene_annotation(avinput, args.distance, args.build, args.db, tmpdir)
+
+        # wait for processes to finish
+        while po.poll() is None:
+            time.sleep(0.5) 
+
+        print("[ {} ] Formatting Annotation.".format(datetime.now().strftime("%b %d %H:%M:%S")))    
+
+        annot_df = format_gene_annotation(fp)
+        shutil.rmtree(tmpdir)
 
-    annot_df = format_gene_annotation(fp)
     annot_df = regroup_gene_regions(annot_df)
 
     fn = args.prefix + '.gene_annot.txt' 
@@ -186,8 +478,6 @@ def main():
 
     print("[ {} ] Done.".format(datetime.now().strftime("%b %d %H:%M:%S")))
     print("wrote to: {}".format(outfile)) 
-    
-    shutil.rmtree(tmpdir)
             
 if __name__ == '__main__':
     main()
@@ -0,0 +1,358 @@
+import numpy as np
+import struct
+import os
+from bgzf import iter_blocks
+from common import concat_ranges
+
+# Minimal BAM reader: the header, the .bai index (start and end of each
+# reference's records) and record batches decoded with numpy. A batch holds
+# a few MB of whole records; the fixed-length fields of all records are
+# unpacked at once, and CIGARs, read names and integer tags are gathered on
+# demand for the records a caller keeps.
+
+# fixed-length record fields after block_size
+FIELDS = np.dtype([
+    ('ref_id', '<i4'),
+    ('pos', '<i4'),
+    ('l_read_name', 'u1'),
+    ('mapq', 'u1'),
+    ('bin', '<u2'),
+    ('n_cigar', '<u2'),
+    ('flag', '<u2'),
+    ('l_seq', '<i4'),
+    ('next_ref_id', '<i4'),
+    ('next_pos', '<i4'),
+    ('tlen', '<i4'),
+])
+
+FUNMAP = 0x4
+FMUNMAP = 0x8
+FREAD1 = 0x40
+FSECONDARY = 0x100
+FSUPPLEMENTARY = 0x800
+
+# CIGAR operations consuming the reference (M, D, N, =, X) and those
+# aligning read bases to it (M, =, X)
+REF_OPS = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=bool)
+MATCH_OPS = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=bool)
+
+# aux value sizes and struct codes of the integer types
+AUX_SIZES = {'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4, 'f': 4}
+AUX_INTS = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I'}
+
+def read_header(path):
+
+    # reference names and lengths, the SAM header text and the virtual
+    # offset of the first record
+
+    blocks = iter_blocks(path)
+    data = bytearray()
+    sizes = list()
+
+    def need(n):
+        while len(data) < n:
+            block = next(blocks, None)
+            if block is None:
+                raise ValueError('truncated BAM header: {}'.format(path))
+            sizes.append((block[0], len(block[1])))
+            data.extend(block[1])
+
+    need(8)
+    if data[:4] != b'BAM\x01':
+        raise ValueError('not a BAM file: {}'.format(path))
+
+    l_text, = struct.unpack_from('<i', data, 4)
+    need(12 + l_text)
+    text = bytes(data[8:8+l_text]).rstrip(b'\x00').decode('utf-8')
+    n_ref, = struct.unpack_from('<i', data, 8 + l_text)
+
+    p = 12 + l_text
+    names = list()
+    lengths = list()
+    for _ in range(n_ref):
+        need(p + 4)
+        l_name, = struct.unpack_from('<i', data, p)
+        need(p + 8 + l_name)
+        names.append(bytes(data[p+4:p+3+l_name]).decode('utf-8'))
+        lengths.append(struct.unpack_from('<i', data, p + 4 + l_name)[0])
+        p += 8 + l_name
+
+    # virtual offset of byte p of the decompressed stream
+    for coffset, size in sizes:
+        if p <= size:
+            break
+        p -= size
+    voffset = (coffset << 16) | p
+
+    return({'names': names, 'lengths': lengths, 'text': text, 'voffset': voffset})
+
+def is_coordinate_sorted(header):
+
+    return(any(line.startswith('@HD') and 'SO:coordinate' in line.split('\t') for line in header['text'].split('\n')))
+
+def index_path(path):
+
+    for p in (path + '.bai', os.path.splitext(path)[0] + '.bai'):
+        if os.path.isfile(p):
+            return(p)
+
+    return(None)
+
+def read_index(path):
+
+    # virtual offsets (start, end) of the records of each reference from
+    # the .bai next to the BAM (None for references without records), or
+    # None without an index
+
+    bai = index_path(path)
+    if bai is None:
+        return(None)
+
+    with open(bai, 'rb') as f:
+        data = f.read()
+
+    if data[:4] != b'BAI\x01':
+        raise ValueError('not a BAI index: {}'.format(bai))
+
+    n_ref, = struct.unpack_from('<i', data, 4)
+    p = 8
+
+    spans = list()
+    for _ in range(n_ref):
+
+        n_bin, = struct.unpack_from('<i', data, p)
+        p += 4
+
+        beg, end, meta = None, None, None
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, p)
+            chunks = np.frombuffer(data, dtype='<u8', count=2*n_chunk, offset=p+8)
+            p += 8 + 16 * n_chunk
+
+            # pseudo-bin 37450 holds the reference's own start and end
+            if bin_id == 37450:
+                meta = (int(chunks[0]), int(chunks[1]))
+            elif n_chunk:
+                beg = int(chunks[0::2].min()) if beg is None else min(beg, int(chunks[0::2].min()))
+                end = int(chunks[1::2].max()) if end is None else max(end, int(chunks[1::2].max()))
+
+        n_intv, = struct.unpack_from('<i', data, p)
+        p += 4 + 8 * n_intv
+
+        spans.append(meta if meta is not None else (beg, end) if beg is not None else None)
+
+    return(spans)
+
+class RecordBatch():
+
+    def __init__(self, data, offsets):
+
+        self.data = data
+        self.buffer = np.frombuffer(data, dtype=np.uint8)
+        self.offsets = offsets
+
+        raw = self.buffer[offsets[:,None] + np.arange(4, 4 + FIELDS.itemsize)]
+        fields = np.ascontiguousarray(raw).view(FIELDS).ravel()
+
+        self.ref_id = fields['ref_id']
+        self.pos = fields['pos']
+        self.mapq = fields['mapq']
+        self.flag = fields['flag']
+        self.next_ref_id = fields['next_ref_id']
+        self.next_pos = fields['next_pos']
+        self.tlen = fields['tlen']
+
+        self.l_read_name = fields['l_read_name'].astype(np.int64)
+        self.n_cigar = fields['n_cigar'].astype(np.int64)
+
+        block_size = self.buffer[offsets[:,None] + np.arange(4)].copy().view('<i4').ravel()
+        l_seq = fields['l_seq'].astype(np.int64)
+
+        self.cigar_offset = offsets + 36 + self.l_read_name
+        self.aux_offset = self.cigar_offset + 4 * self.n_cigar + (l_seq + 1) // 2 + l_seq
+        self.end = offsets + 4 + block_size
+
+    def __len__(self):
+        return(len(self.offsets))
+
+    def cigar(self, idx):
+
+        # flattened (op, length) of the records idx, with the number of
+        # operations of each
+
+        counts = self.n_cigar[idx]
+        raw = self.buffer[concat_ranges(self.cigar_offset[idx], 4 * counts)]
+        values = raw.view('<u4').astype(np.int64)
+
+        return(values & 0xf, values >> 4, counts)
+
+    def aligned_blocks(self, idx):
+
+        # reference intervals [start, end) (0-based) aligned to read bases
+        # (M, = and X operations) of the records idx, as (position in idx,
+        # start, end); deletions and skipped regions (D, N) split blocks
+
+        ops, lengths, counts = self.cigar(idx)
+
+        read = np.repeat(np.arange(len(counts)), counts)
+        shift = np.where(REF_OPS[ops], lengths, 0)
+        offset = np.cumsum(shift) - shift
+
+        # reference offset of each operation within its own record
+        nonempty = counts[counts > 0]
+        offset -= np.repeat(offset[np.cumsum(nonempty) - nonempty], nonempty)
+
+        start = self.pos[idx].astype(np.int64)[read] + offset
+
+        match = MATCH_OPS[ops] & (lengths > 0)
+        return(read[match], start[match], start[match] + lengths[match])
+
+    def reference_end(self, idx):
+
+        # end (0-based, exclusive) of the alignment of the records idx
+
+        ops, lengths, counts = self.cigar(idx)
+
+        read = np.repeat(np.arange(len(counts)), counts)
+        span = np.bincount(read, weights=np.where(REF_OPS[ops], lengths, 0), minlength=len(counts))
+
+        return(self.pos[idx].astype(np.int64) + span.astype(np.int64))
+
+    def names(self, idx):
+
+        # read names of the records idx as a fixed-width bytes array
+
+        n = self.l_read_name[idx] - 1
+        width = max(int(n.max()) if len(n) else 1, 1)
+
+        j = np.arange(width)
+        raw = self.buffer[np.minimum(self.offsets[idx,None] + 36 + j, len(self.buffer) - 1)]
+        raw = np.where(j < n[:,None], raw, 0).astype(np.uint8)
+
+        return(np.ascontiguousarray(raw).view('S{}'.format(width)).ravel())
+
+    def tag_int(self, tag, idx):
+
+        # integer aux tag of the records idx (sorted), -1 where absent; only
+        # records whose aux data contains the tag bytes are parsed
+
+        values = np.full(len(idx), -1, dtype=np.int64)
+
+        b = self.buffer
+        hit = np.flatnonzero((b[:-2] == tag[0]) & (b[1:-1] == tag[1]))
+        if not len(hit) or not len(idx):
+            return(values)
+
+        rec = np.searchsorted(self.offsets, hit, side='right') - 1
+        rec = np.unique(rec[hit >= self.aux_offset[rec]])
+
+        k = np.minimum(np.searchsorted(idx, rec), len(idx) - 1)
+        found = idx[k] == rec
+        for r, i in zip(rec[found], k[found]):
+            value = _aux_int(self.data, self.aux_offset[r], self.end[r], tag)
+            if value is not None:
+                values[i] = value
+
+        return(values)
+
+def _aux_int(data, p, end, tag):
+
+    while p + 3 <= end:
+
+        key, typ = data[p:p+2], chr(data[p+2])
+        p += 3
+
+        if typ in AUX_INTS:
+            if key == tag:
+                return(struct.unpack_from('<' + AUX_INTS[typ], data, p)[0])
+            p += AUX_SIZES[typ]
+        elif typ in AUX_SIZES:
+            p += AUX_SIZES[typ]
+        elif typ in 'ZH':
+            p = data.index(b'\x00', p) + 1
+        elif typ == 'B':
+            sub = chr(data[p])
+            n, = struct.unpack_from('<i', data, p + 1)
+            p += 5 + n * AUX_SIZES[sub]
+        else:
+            raise ValueError('invalid aux type {!r}'.format(typ))
+
+    return(None)
+
+def _record_offsets(data):
+
+    # start of each whole record in data, and the number of bytes they use
+
+    offsets = list()
+    unpack = struct.Struct('<i').unpack_from
+
+    o = 0
+    n = len(data)
+    while o + 4 <= n:
+        size = unpack(data, o)[0]
+        if o + 4 + size > n:
+            break
+        offsets.append(o)
+        o += 4 + size
+
+    return(np.array(offsets, dtype=np.int64), o)
+
+def iter_batches(path, voffset=None, batch_size=1 << 22):
+
+    # RecordBatch objects of about batch_size bytes each, from a virtual
+    # offset on (default: the first record)
+
+    if voffset is None:
+        voffset = read_header(path)['voffset']
+
+    data = bytearray()
+    for coffset, block in iter_blocks(path, voffset):
+
+        data += block
+        if len(data) < batch_size:
+            continue
+
+        chunk = bytes(data)
+        offsets, used = _record_offsets(chunk)
+        del data[:used]
+
+        if len(offsets):
+            yield(RecordBatch(chunk, offsets))
+
+    if data:
+        chunk = bytes(data)
+        offsets, used = _record_offsets(chunk)
+        if used != len(chunk):
+            raise ValueError('truncated BAM record at the end of {}'.format(path))
+        yield(RecordBatch(chunk, offsets))
+
+def shards(path, names):
+
+    # work units (reference ids, virtual offset, stop) over the references
+    # of a BAM named in names: one per reference through the .bai index, or
+    # the whole file without one; stop marks coordinate-sorted input, where
+    # reading can end after the last of the reference ids
+
+    header = read_header(path)
+    spans = read_index(path)
+
+    refs = [i for i, name in enumerate(header['names']) if name in names]
+
+    if spans is None:
+        return([(refs, header['voffset'], is_coordinate_sorted(header))] if refs else [])
+
+    return([([i], spans[i][0], True) for i in refs if spans[i] is not None])
+
+def reference_names(path):
+
+    return(read_header(path)['names'])
+
+def iter_shard(path, ref_ids, voffset, stop):
+
+    # record batches of one work unit from shards()
+
+    last = max(ref_ids)
+    for batch in iter_batches(path, voffset):
+        yield(batch)
+        if stop and (batch.ref_id[-1] > last or batch.ref_id[-1] < 0):
+            return
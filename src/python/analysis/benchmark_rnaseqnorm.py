@@ -0,0 +1,148 @@
+import argparse
+import pandas as pd
+import numpy as np
+import scipy.sparse as sparse
+from collections import OrderedDict
+from datetime import datetime
+from rnaseqnorm import normalize_quantiles, edgeR_calcNormFactors, edgeR_cpm, inverse_normal_transform
+import tracemalloc
+import time
+import sys
+import os
+
+parser = argparse.ArgumentParser(prog='Benchmark and parity checks for rnaseqnorm on synthetic count matrices.')
+parser.add_argument('-r', '--reference', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_rnaseqnorm.npz'), help='Stored reference outputs (.npz) for the parity cases.')
+parser.add_argument('--write_reference', action='store_true', help='Regenerate the stored reference outputs from the current implementation.')
+parser.add_argument('--timing', action='store_true', help='Also benchmark the large (timing-only) matrices.')
+parser.add_argument('--rtol', type=float, default=0, help='Relative tolerance for parity (default: exact).')
+parser.add_argument('-n', '--repeat', type=int, default=3, help='Timing repeats (best is reported).')
+parser.add_argument('-o', '--output', type=str, help='Write results table (.tsv).')
+args = parser.parse_args()
+
+# (name, genes, samples, fraction of zeroed entries)
+PARITY_CASES = [
+    ('small_dense', 300, 6, 0.0),
+    ('mid_sparse', 1000, 12, 0.5),
+    ('mid_very_sparse', 1000, 12, 0.9),
+]
+
+TIMING_CASES = [
+    ('peaks_dense', 200000, 24, 0.0),
+    ('peaks_sparse', 200000, 48, 0.8),
+    ('bins_very_sparse', 1000000, 24, 0.95),
+]
+
+def dense(Y):
+    return(pd.DataFrame(Y))
+
+def csc(Y):
+    return(sparse.csc_matrix(Y))
+
+# function name -> (reference key, input preparation, callable on the prepared genes x samples counts)
+FUNCTIONS = OrderedDict([
+    ('normalize_quantiles', ('normalize_quantiles', dense, lambda X: normalize_quantiles(X).values)),
+    ('edgeR_calcNormFactors', ('edgeR_calcNormFactors', dense, edgeR_calcNormFactors)),
+    ('edgeR_calcNormFactors[sparse]', ('edgeR_calcNormFactors', csc, edgeR_calcNormFactors)),
+    ('edgeR_cpm', ('edgeR_cpm', dense, lambda X: edgeR_cpm(X).values)),
+    ('edgeR_cpm[sparse]', ('edgeR_cpm', csc, lambda X: edgeR_cpm(X).toarray())),
+    ('inverse_normal_transform', ('inverse_normal_transform', dense, lambda X: inverse_normal_transform(X).values)),
+])
+
+def synthetic_counts(name, m, n, zero_frac):
+
+    # negative binomial counts with gene-specific means and sample-specific
+    # library sizes; small counts give many ties, and the first rows are
+    # all-zero (dropped by TMM) or constant (fully tied for the rank transform)
+
+    seed = sum(ord(c) for c in name)
+    rng = np.random.default_rng(seed)
+
+    mu = rng.lognormal(mean=2, sigma=1.5, size=(m, 1)) * rng.uniform(0.5, 2, size=(1, n))
+    Y = rng.negative_binomial(2, 2/(2+mu)).astype(np.int64)
+
+    if zero_frac > 0:
+        Y[rng.random(Y.shape) < zero_frac] = 0
+
+    k = max(1, m//100)
+    Y[:k] = 0
+    Y[k:2*k] = 7
+
+    return(Y)
+
+def run_case(fn, X, repeat):
+
+    # best of repeated runs; peak memory from a separate traced run
+
+    times = list()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        res = fn(X)
+        times.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    fn(X)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return(res, min(times), peak / 1e6)
+
+def main():
+
+    if args.write_reference:
+        reference = dict()
+    elif os.path.exists(args.reference):
+        reference = dict(np.load(args.reference))
+    else:
+        sys.exit('reference outputs not found: {} (see --write_reference)'.format(args.reference))
+
+    cases = [c + (True,) for c in PARITY_CASES]
+    if args.timing:
+        cases += [c + (False,) for c in TIMING_CASES]
+
+    rows = list()
+    failed = 0
+
+    for name, m, n, zero_frac, parity in cases:
+
+        print("[ {} ] {} ({} x {}, {:.0%} zeros)".format(datetime.now().strftime("%b %d %H:%M:%S"), name, m, n, zero_frac))
+        Y = synthetic_counts(name, m, n, zero_frac)
+
+        for fn_name, (ref_key, prepare, fn) in FUNCTIONS.items():
+
+            res, t, peak = run_case(fn, prepare(Y), args.repeat)
+
+            key = name + '/' + ref_key
+            max_diff = np.nan
+            status = '-'
+
+            if parity and args.write_reference:
+                reference.setdefault(key, res)
+                status = 'written'
+            elif parity:
+                if key not in reference:
+                    status = 'missing'
+                    failed += 1
+                else:
+                    ok = res.shape == reference[key].shape and np.allclose(res, reference[key], rtol=args.rtol, atol=0, equal_nan=True)
+                    if res.shape == reference[key].shape and res.size:
+                        max_diff = np.nanmax(np.abs(res - reference[key]))
+                    status = 'ok' if ok else 'FAILED'
+                    failed += not ok
+
+            rows.append([name, m, n, zero_frac, fn_name, t, peak, max_diff, status])
+            print('  {:<32}{:>10.4f} s{:>10.1f} MB  {}'.format(fn_name, t, peak, status))
+
+    results_df = pd.DataFrame(rows, columns=['case', 'genes', 'samples', 'zero_frac', 'function', 'time_s', 'peak_mb', 'max_abs_diff', 'parity'])
+
+    if args.output:
+        results_df.to_csv(args.output, sep='\t', index=False)
+        print('wrote to: {}'.format(args.output))
+
+    if args.write_reference:
+        np.savez_compressed(args.reference, **reference)
+        print('wrote reference outputs to: {}'.format(args.reference))
+    elif failed:
+        sys.exit('{} parity check(s) failed.'.format(failed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import concurrent.futures
+import collections
+import struct
+import zlib
+import io
+
+# BGZF (blocked gzip, as used by BAM and tabix): a series of gzip members of
+# at most 64 KiB each, every one carrying its compressed size in a 'BC'
+# extra field, followed by an empty end-of-file member. Any gzip reader
+# (gzip.open, zcat, pandas) reads it as a single stream; the fixed block
+# layout also allows random access by virtual file offset.
+
+BLOCK_SIZE = 0xff00  # uncompressed bytes per block, as in htslib
+MAX_BLOCK_SIZE = 0x10000
+
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def compress_block(data, compresslevel=6):
+
+    # one complete BGZF member for up to BLOCK_SIZE bytes of data
+
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+
+    if len(cdata) + 26 > MAX_BLOCK_SIZE:
+        raise ValueError('BGZF block overflow ({} bytes in)'.format(len(data)))
+
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(cdata) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+    return(header + cdata + footer)
+
+class BgzfWriter(io.RawIOBase):
+
+    # binary writer that cuts the stream into BGZF blocks and compresses
+    # them on a thread pool (zlib releases the GIL), writing the blocks in
+    # order; at most a few blocks per thread are in flight at once
+
+    def __init__(self, path, threads=4, compresslevel=6):
+
+        self.fileobj = open(path, 'wb')
+        self.compresslevel = compresslevel
+        self.threads = max(1, threads)
+
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+
+    def writable(self):
+        return(True)
+
+    def write(self, data):
+
+        if self.closed:
+            raise ValueError('write to closed BGZF file')
+
+        self.buffer += data
+
+        n = len(self.buffer) // BLOCK_SIZE * BLOCK_SIZE
+        for i in range(0, n, BLOCK_SIZE):
+            self.__submit(bytes(self.buffer[i:i+BLOCK_SIZE]))
+        del self.buffer[:n]
+
+        return(len(data))
+
+    def __submit(self, block):
+
+        if self.executor is None:
+            self.fileobj.write(compress_block(block, self.compresslevel))
+            return
+
+        self.pending.append(self.executor.submit(compress_block, block, self.compresslevel))
+        while len(self.pending) > 4 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+
+        # complete blocks only; a partial block is kept until more data or close
+
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        try:
+            if self.buffer:
+                self.__submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.flush()
+            self.fileobj.write(EOF_BLOCK)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            super().close()
+            self.fileobj.close()
+
+def bgzf_open(path, mode='wt', threads=4, compresslevel=6, encoding='utf-8'):
+
+    # write-only counterpart of gzip.open: 'wb' gives the raw block writer,
+    # 'wt' (default) a text wrapper around it
+
+    if mode not in ('w', 'wt', 'wb'):
+        raise ValueError("bgzf_open only supports writing ('wt' or 'wb'), not '{}'".format(mode))
+
+    writer = BgzfWriter(path, threads=threads, compresslevel=compresslevel)
+
+    if mode == 'wb':
+        return(writer)
+
+    return(io.TextIOWrapper(io.BufferedWriter(writer, buffer_size=BLOCK_SIZE), encoding=encoding, newline=''))
+
+def read_block(fileobj):
+
+    # the next BGZF member as (compressed size, decompressed data), or None
+    # at the end of the file
+
+    header = fileobj.read(18)
+    if not header:
+        return(None)
+
+    if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError('not a BGZF block at offset {}'.format(fileobj.tell() - len(header)))
+
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = header[12:] + fileobj.read(xlen - 6)
+
+    bsize = None
+    i = 0
+    while i + 4 <= xlen:
+        slen, = struct.unpack('<H', extra[i+2:i+4])
+        if extra[i:i+2] == b'BC':
+            bsize, = struct.unpack('<H', extra[i+4:i+6])
+        i += 4 + slen
+
+    if bsize is None:
+        raise ValueError('gzip member without a BGZF block size')
+
+    cdata = fileobj.read(bsize - xlen - 19)
+    fileobj.read(8) # crc32, isize
+
+    return(bsize + 1, zlib.decompress(cdata, -15))
+
+def iter_blocks(path, voffset=0):
+
+    # decompressed blocks from a virtual file offset on, as (compressed
+    # offset, data); the first block is trimmed to start at the offset
+
+    coffset, uoffset = voffset >> 16, voffset & 0xffff
+
+    with open(path, 'rb', buffering=1 << 20) as f:
+        f.seek(coffset)
+        while True:
+            block = read_block(f)
+            if block is None:
+                return
+            size, data = block
+            if uoffset:
+                data = data[uoffset:]
+                uoffset = 0
+            yield(coffset, data)
+            coffset += size
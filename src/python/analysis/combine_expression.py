@@ -1,16 +1,263 @@
 #!/usr/bin/env python3
 import numpy as np
 import pandas as pd
-import subprocess
 import argparse
 from datetime import datetime
+from matrixstore import save_matrix
+from bgzf import bgzf_open
+import concurrent.futures
+import hashlib
 import json
-import tempfile
-import shutil
 import glob
-import gzip
+import csv
+import re
 import os
 
+def read_star_counts(path):
+
+    # gene ids and unstranded counts (cols=0,1) from a STAR
+    # ReadsPerGene.out.tab, below its four summary rows
+
+    df = pd.read_csv(path, sep='\t', skiprows=4, header=None, usecols=[0,1])
+
+    return(df[0].values, df[1].values)
+
+def read_tx2gene(gtf, cache=None):
+
+    # transcript -> gene map from the GTF attributes (as rtracklayer::readGFF
+    # then tx2gene in merge_tpm.R); cached as a two-column table, reused
+    # while newer than the GTF
+
+    if cache and os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(gtf):
+        return(pd.read_csv(cache, sep='\t', index_col=0, dtype=str).iloc[:,0])
+
+    df = pd.read_csv(gtf, sep='\t', comment='#', header=None, usecols=[2,8], names=['feature', 'attributes'], dtype=str, quoting=csv.QUOTE_NONE)
+
+    # transcript records are enough when present (avoids scanning every exon)
+    if (df['feature'] == 'transcript').any():
+        df = df[df['feature'] == 'transcript']
+
+    tx = df['attributes'].str.extract(r'transcript_id "([^"]*)"', expand=False)
+    gene = df['attributes'].str.extract(r'gene_id "([^"]*)"', expand=False)
+
+    tx2gene = pd.Series(gene.values, index=pd.Index(tx.values, name='transcript_id'), name='gene_id')
+    tx2gene = tx2gene[tx2gene.index.notna()]
+    tx2gene = tx2gene[~tx2gene.index.duplicated()]
+
+    if cache:
+        tx2gene.to_csv(cache, sep='\t', header=True)
+
+    return(tx2gene)
+
+def summarize_tpm(paths, tx2gene):
+
+    # gene-level TPM from Salmon quant.sf files: transcript TPMs summed per
+    # gene in file order (as tximport/rowsum); transcripts missing from
+    # tx2gene are dropped. All files must list the same transcripts.
+
+    names = None
+
+    for k, p in enumerate(paths):
+
+        df = pd.read_csv(p, sep='\t', usecols=['Name', 'TPM'], float_precision='round_trip')
+
+        if names is None:
+            names = df['Name'].values
+            genes = tx2gene.reindex(names)
+            keep = genes.notna().values
+            codes, gene_ids = pd.factorize(genes.values[keep], sort=True)
+            tpm = np.zeros((len(gene_ids), len(paths)))
+        elif not np.array_equal(df['Name'].values, names):
+            raise ValueError('transcripts in "{}" differ from "{}"'.format(p, paths[0]))
+
+        tpm[:,k] = np.bincount(codes, weights=df['TPM'].values[keep], minlength=len(gene_ids))
+
+    return(pd.DataFrame(tpm, index=gene_ids))
+
+# long double powers of ten, as in R's format.c
+R_TBL = np.array([10.0**k for k in range(28)]).astype(np.longdouble)
+R_KP_MAX = 27
+
+def format_r(x, digits=6):
+
+    # strings of a numeric vector as R's format(x, digits=digits): the
+    # common fixed or scientific notation needed to show every value to
+    # `digits` significant digits, right-justified to a common width
+    # (port of scientific() and formatReal() from R's format.c)
+
+    x = np.asarray(x, dtype=np.float64)
+    R = digits
+
+    fin = np.isfinite(x)
+    r = np.abs(x[fin])
+    nz = r != 0
+
+    kpower = np.zeros(r.shape[0], dtype=np.int64)
+    nsig = np.ones(r.shape[0], dtype=np.int64)
+    widens = np.zeros(r.shape[0], dtype=bool)
+
+    if nz.any():
+        rz = r[nz]
+        kp = np.floor(np.log10(rz)).astype(np.int64) - R + 1
+
+        r_prec = rz.astype(np.longdouble)
+        small = np.abs(kp) < 10
+        r_prec[small & (kp > 0)] /= R_TBL[kp[small & (kp > 0)]]
+        r_prec[small & (kp < 0)] *= R_TBL[-kp[small & (kp < 0)]]
+        tiny = ~small & (kp <= -308)
+        r_prec[tiny] = (rz[tiny] * 1e+303).astype(np.longdouble) / np.power(10.0, (kp[tiny]+303).astype(np.float64)).astype(np.longdouble)
+        large = ~small & ~tiny
+        r_prec[large] /= np.power(10.0, kp[large].astype(np.float64)).astype(np.longdouble)
+
+        lo = r_prec < R_TBL[R-1]
+        r_prec[lo] *= 10.0
+        kp[lo] -= 1
+
+        # significant digits: drop trailing zeros of the rounded mantissa
+        alpha = np.rint(r_prec).astype(np.float64).astype(np.int64)
+        ns = np.full(rz.shape[0], R, dtype=np.int64)
+        div = np.ones(rz.shape[0], dtype=bool)
+        for j in range(R):
+            div &= alpha % 10 == 0
+            ns -= div
+            alpha //= 10
+        kp[ns == 0] += 1
+        ns[ns == 0] = 1
+
+        kpz = kp + R - 1
+        rgt = np.clip(R - kpz, 0, R_KP_MAX)
+        fuzz = 0.5 / R_TBL[rgt]
+        wid = (kpz > 0) & (kpz <= R_KP_MAX)
+        wid[wid] = rz[wid].astype(np.longdouble) < R_TBL[kpz[wid]] - fuzz[wid]
+
+        kpower[nz], nsig[nz], widens[nz] = kpz, ns, wid
+
+    neg_i = (x[fin] < 0).astype(np.int64)
+    neg = int(neg_i.any())
+
+    if r.shape[0]:
+        left = kpower + 1 - widens
+        sleft = neg_i + np.where(left <= 0, 1, left)
+        right = nsig - left
+
+        rgt, mxl, mnl, mxsl, mxns = right.max(), left.max(), left.min(), sleft.max(), nsig.max()
+        if mxl < 0:
+            mxsl = 1 + neg
+        rgt = max(rgt, 0)
+        wF = mxsl + rgt + (rgt != 0)
+
+        e = 2 if (mxl > 100 or mnl <= -99) else 1
+        d = mxns - 1
+        w = neg + (d > 0) + d + 4 + e
+        if wF <= w:
+            e, d, w = 0, rgt, wF
+    else:
+        e, d, w = 0, 0, 0
+
+    def special(v):
+        return('NaN' if np.isnan(v) else ('Inf' if v > 0 else '-Inf'))
+
+    w = max([w] + [len(special(v)) for v in x[~fin]])
+
+    if e:
+        fmt = '%#*.*e' if d else '%*.*e'
+    else:
+        fmt = '%*.*f'
+
+    w, d = int(w), int(d)
+
+    return([fmt % (w, d, v) if np.isfinite(v) else special(v).rjust(w) for v in x])
+
+def file_digest(path):
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return(h.hexdigest())
+
+def scan_manifest(paths, outfile):
+
+    # manifest of input files (size, mtime, content hash) kept next to a
+    # merged matrix; files are only re-hashed when their size or mtime
+    # changed. Returns the updated manifest, the samples whose content
+    # changed (or are new), and the previous manifest if the matrix exists.
+
+    manifest_file = outfile + '.manifest'
+    previous = None
+    if os.path.exists(manifest_file) and os.path.exists(outfile):
+        previous = pd.read_csv(manifest_file, sep='\t', index_col=0, dtype={'path':str, 'sha1':str})
+
+    rows = list()
+    changed = list()
+
+    for sid, p in paths.items():
+
+        st = os.stat(p)
+        old = previous.loc[sid] if previous is not None and sid in previous.index else None
+
+        if old is not None and old['path'] == p and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            digest = old['sha1']
+        else:
+            digest = file_digest(p)
+            if old is None or old['sha1'] != digest:
+                changed.append(sid)
+
+        rows.append([sid, p, st.st_size, st.st_mtime_ns, digest])
+
+    manifest = pd.DataFrame(rows, columns=['sample_id', 'path', 'size', 'mtime_ns', 'sha1']).set_index('sample_id')
+
+    return(manifest, changed, previous)
+
+def splice_matrix(outfile, new_df, sample_ids):
+
+    # reuse the unchanged columns of a previously written matrix verbatim
+    # (as text, so they are not re-formatted) and splice in new columns;
+    # None if the gene index no longer matches
+
+    old_df = pd.read_csv(outfile, sep='\t', skiprows=1, index_col=0, dtype=str, keep_default_na=False)
+
+    if not new_df.shape[1]:
+        return(old_df[list(sample_ids)])
+
+    if not old_df.index.equals(new_df.index.astype(str)):
+        return(None)
+
+    old_df.index = new_df.index
+    old_df = old_df.drop(columns=[c for c in new_df.columns if c in old_df.columns])
+
+    return(pd.concat([old_df, new_df], axis=1)[list(sample_ids)])
+
+def replace_when_written(outfile, write):
+
+    # write(path) to a temporary name next to outfile and move the result
+    # into place only once complete, so an interrupted run never leaves a
+    # truncated file at outfile
+
+    tmpfile = '{}.{}.tmp'.format(outfile, os.getpid())
+
+    try:
+        write(tmpfile)
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+    return(outfile)
+
+def write_matrix(df, outfile, float_format=None, threads=1):
+
+    # BGZF output: blocks are compressed on a thread pool, and the result is
+    # still an ordinary (multi-member) gzip stream for every reader
+
+    def write(path):
+        with bgzf_open(path, 'wt', threads=threads, compresslevel=6) as f:
+            f.write('{0}\t{1}\n'.format(df.shape[0], df.shape[1]))
+            df.to_csv(f, sep='\t', float_format=float_format)
+
+    return(replace_when_written(outfile, write))
+
 class CombineExpression():
     def __init__(self, tpm_counts_json, subset=None):
         with open(tpm_counts_json, 'r') as f:
@@ -30,8 +277,6 @@ class CombineExpression():
             self.CTS[exp] = self.__get_counts_files(dir_name)
             self.TPM[exp] = self.__get_tpm_files(dir_name)
 
-        self.__tmp = tempfile.mkdtemp(dir=args.temp_dir)
-
         if not os.path.exists(args.output_dir):
             os.mkdir(args.output_dir)
 
@@ -57,50 +302,86 @@ class CombineExpression():
 
         return(tpm)
 
-    def __merge_region_counts(self, exp, paths):
+    def __read_region_counts(self, exp, paths):
 
-        skip=lambda x: x in range(4) # header from STAR gct
-        usecols=[0,1] # cols={gene_id, all_counts}
-        sample_ids = paths.index.values
+        sample_ids = list(paths.index.values)
 
-        df = pd.read_csv(paths[0], sep='\t', skiprows=skip, header=None, usecols=usecols, names=['gene_id', sample_ids[0]], index_col=0)
-        df.index = df.index.str.replace(r'\.[0-9]+','')
+        # files are parsed concurrently and checked for identical gene order
+        # against the first one, then copied into a single preallocated matrix
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
 
-        if df[sample_ids[0]].dtype == np.float64:
-            dtype = np.float32
-        elif df[sample_ids[0]].dtype == np.int64:
-            dtype = np.int32
-        else:
-            dtype = df[sample_ids[0]].dtype
+            futures = [executor.submit(read_star_counts, p) for p in paths]
 
-        gct_df = pd.DataFrame(0, index=df.index, columns=list(sample_ids), dtype=dtype)
-        gct_df[sample_ids[0]] = df[sample_ids[0]].astype(dtype)
-        for k, (i,p) in enumerate(zip(sample_ids[1:], paths[1:])):
+            gene_ids, counts = futures[0].result()
+            dtype = {np.dtype(np.float64): np.float32, np.dtype(np.int64): np.int32}.get(counts.dtype, counts.dtype)
 
-            print("\rProcessing '{}': {}/{}".format(exp, (k+2), len(paths)), end='', flush=True)
-            df = pd.read_csv(p, sep='\t', skiprows=skip, header=None, usecols=usecols, names=['gene_id', i], index_col=0)
-            df.index = df.index.str.replace(r'\.[0-9]+','')
-            gct_df[i] = df[i]
-            
-        with gzip.open(os.path.join(args.output_dir, exp+'.gct.gz'), 'wt', compresslevel=6) as f:
-            f.write('{0}\t{1}\n'.format(gct_df.shape[0], gct_df.shape[1]))
-            gct_df.to_csv(f, sep='\t', float_format='%.6g')
+            M = np.empty((len(gene_ids), len(sample_ids)), dtype=dtype)
 
-    def __merge_region_tpm(self, exp, paths):
+            for k, p in enumerate(paths):
 
-        tpms = os.path.join(self.__tmp, exp+'_paths.txt')
-        sample_ids = os.path.join(self.__tmp, exp+'_ids.txt')
+                print("\rProcessing '{}': {}/{}".format(exp, (k+1), len(paths)), end='', flush=True)
+                ids, M[:,k] = futures[k].result()
+                futures[k] = None
 
-        with open(tpms, 'w+') as f:
-            f.write('\n'.join([i for i in paths]))
-        with open(sample_ids, 'w+') as f:
-            f.write('\n'.join([i for i in paths.index.values]))
+                if not np.array_equal(ids, gene_ids):
+                    raise ValueError('gene order in "{}" differs from "{}"'.format(p, paths.iloc[0]))
 
-        exc = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'merge_tpm.R')
-        outfile = os.path.join(args.output_dir, exp+'.gtt.gz')
-        cmd = ' '.join([exc, tpms, sample_ids, args.gtf, '-o', outfile]) 
+        index = pd.Index(gene_ids, name='gene_id').str.replace(r'\.[0-9]+', '', regex=True)
+
+        return(pd.DataFrame(M, index=index, columns=sample_ids, copy=False))
+
+    def __read_region_tpm(self, exp, paths, tx2gene):
+
+        df = summarize_tpm(list(paths), tx2gene)
+        df.columns = list(paths.index.values)
+
+        # strip gene version suffixes and order genes, as in merge_tpm.R
+        df.index = pd.Index([re.sub(r'\.[0-9]+', '', g, count=1) for g in df.index], name='gene_id')
+        df.sort_index(inplace=True)
+
+        # R-formatted text columns (see format_r)
+        return(pd.DataFrame({c: format_r(df[c].values) for c in df.columns}, index=df.index))
+
+    def __merge_region(self, exp, paths, outfile, read, dtype, float_format=None):
+
+        # only samples whose files changed since the last run (per the
+        # manifest) are read and spliced into the existing matrix
+
+        manifest, changed, previous = scan_manifest(paths, outfile)
+        binfile = outfile[:-len('.gz')] + '.bmat'
+
+        df = None
+        if previous is not None and not args.rebuild:
+
+            if not changed and set(previous.index) == set(paths.index) and not (args.binary and not os.path.exists(binfile)):
+                print("\n'{}' is up to date.".format(exp))
+                return
 
-        subprocess.check_call(cmd, shell=True)
+            print("\n'{}': {} new or changed sample(s).".format(exp, len(changed)))
+            new_df = read(exp, paths[changed]) if changed else pd.DataFrame()
+            df = splice_matrix(outfile, new_df, paths.index)
+
+        if df is None:
+            df = read(exp, paths)
+
+        # the manifest is written last: it only ever describes complete outputs
+        write_matrix(df, outfile, float_format=float_format, threads=args.threads)
+
+        if args.binary:
+            replace_when_written(binfile, lambda path: save_matrix(df, path, dtype=dtype))
+
+        replace_when_written(outfile + '.manifest', lambda path: manifest.to_csv(path, sep='\t'))
+
+    def __merge_region_counts(self, exp, paths):
+
+        outfile = os.path.join(args.output_dir, exp+'.gct.gz')
+        self.__merge_region(exp, paths, outfile, self.__read_region_counts, np.int32, float_format='%.6g')
+
+    def __merge_region_tpm(self, exp, paths, tx2gene):
+
+        outfile = os.path.join(args.output_dir, exp+'.gtt.gz')
+        read = lambda exp, paths: self.__read_region_tpm(exp, paths, tx2gene)
+        self.__merge_region(exp, paths, outfile, read, np.float64)
 
     def merge_region_counts(self):
 
@@ -113,21 +394,24 @@ class CombineExpression():
 
         print("[ {} ] Merging TPM.".format(datetime.now().strftime("%b %d %H:%M:%S")))
 
+        # parse the GTF once for all experiments
+        cache = os.path.join(args.temp_dir, os.path.basename(args.gtf) + '.tx2gene.txt')
+        tx2gene = read_tx2gene(args.gtf, cache=cache)
+
         for k, (i, p) in enumerate(self.TPM.items()):
 
             print("\rProcessing '{}': {}/{}".format(i, k+1, len(self.TPM.keys())),end='',flush=True)
-            self.__merge_region_tpm(i, p)
-
-    def __del__(self):
-        if os.path.exists(self.__tmp):
-            shutil.rmtree(self.__tmp)
+            self.__merge_region_tpm(i, p, tx2gene)
 
 parser = argparse.ArgumentParser(description='Run pipeline from RNA-Seq JSON file')
 parser.add_argument('json', type=str, help='Path to the JSON file')
 parser.add_argument('gtf', type=str, help='Path to the gtf file')
 parser.add_argument('--subset', type=str, help='Subset of experiments.')
 parser.add_argument('--mode', required=True, choices=['cts','tpm'], type=str, help='Merge counts or tpm expression.')
-parser.add_argument('--temp_dir',type=str, default='./',help='Temporary directory')
+parser.add_argument('-t', '--threads', type=int, default=8, help='Threads for parsing count files and compressing the output.')
+parser.add_argument('--rebuild', action='store_true', help='Ignore sample manifests and rebuild every matrix from scratch.')
+parser.add_argument('--binary', action='store_true', help='Also write each matrix as a memory-mappable binary matrix store (.gct.bmat/.gtt.bmat).')
+parser.add_argument('--temp_dir',type=str, default='./',help='Temporary directory (caches the GTF transcript-to-gene map).')
 
 parser.add_argument('-o','--output_dir',type=str, default='.',help='File with sample subset to process')
 
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
 import re
 
 def get_motif_name(homer_motif_id):
@@ -109,4 +110,107 @@ def explode(df, lst_cols, fill_value='', preserve_index=False):
         res = res.reset_index(drop=True)
     return res
 
+def concat_ranges(starts, counts):
 
+    # concatenated aranges [starts[i], starts[i]+counts[i])
+
+    ends = np.cumsum(counts)
+    return(np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts) + np.repeat(starts, counts))
+
+def interval_index(starts, ends):
+
+    # intervals [start, end] (inclusive) bucketed by length (powers of two),
+    # each bucket sorted by start with its maximum length, so a query only
+    # generates candidates within that length of its start
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    lengths = ends - starts + 1
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+
+    index = list()
+    for b in np.unique(buckets):
+        idx = np.flatnonzero(buckets == b)
+        idx = idx[np.argsort(starts[idx], kind='stable')]
+        index.append((idx, starts[idx], ends[idx], lengths[idx].max()))
+
+    return(index)
+
+def overlapping_pairs(index, qs, qe):
+
+    # all (query, interval) pairs that overlap, for query intervals [qs, qe]
+    # against an interval_index
+
+    pairs_q = [np.zeros(0, dtype=np.int64)]
+    pairs_t = [np.zeros(0, dtype=np.int64)]
+
+    for idx, s, e, max_length in index:
+
+        lo = np.searchsorted(s, qs - max_length + 1, side='left')
+        hi = np.searchsorted(s, qe, side='right')
+        counts = np.maximum(hi - lo, 0)
+
+        q = np.repeat(np.arange(len(qs)), counts)
+        k = concat_ranges(lo, counts)
+
+        hit = e[k] >= qs[q]
+        pairs_q.append(q[hit])
+        pairs_t.append(idx[k[hit]])
+
+    return(np.concatenate(pairs_q), np.concatenate(pairs_t))
+
+def sample_groups(columns, pat=r'\w+(?=[0-9]+$)'):
+
+    # column indices of each group, the group being the sample id without
+    # its trailing replicate number
+
+    groups = OrderedDict()
+    for i,sid in enumerate(list(columns)):
+        groups.setdefault(re.search(pat, sid).group(0), []).append(i)
+
+    return(groups)
+
+def group_aggregate(df, groups=None, how='mean', log2=False):
+
+    # mean, median or sum across the columns of each group (default:
+    # sample_groups of the columns), on the whole matrix at once rather than
+    # row by row, optionally as log2(x+1); missing values are skipped as in
+    # DataFrame.mean
+
+    if groups is None:
+        groups = sample_groups(df.columns)
+
+    X = np.asarray(df.values)
+    if X.dtype.kind != 'f':
+        X = X.astype(np.float64)
+
+    missing = np.isnan(X)
+    if missing.any():
+        X = np.where(missing, 0, X)
+    else:
+        missing = None
+
+    if how not in ('mean', 'median', 'sum'):
+        raise ValueError("unknown aggregation '{}' (mean, median or sum)".format(how))
+
+    M = np.zeros((len(X), len(groups)), dtype=X.dtype)
+
+    for j, idc in enumerate(groups.values()):
+
+        if how == 'median':
+            block = X[:, idc] if missing is None else np.where(missing[:, idc], np.nan, X[:, idc])
+            M[:,j] = np.median(block, axis=1) if missing is None else np.nanmedian(block, axis=1)
+            continue
+
+        M[:,j] = X[:, idc].sum(axis=1)
+
+        if how == 'mean':
+            n = len(idc) if missing is None else (~missing[:, idc]).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                M[:,j] /= n
+
+    if log2:
+        M = np.log2(M + 1)
+
+    return(pd.DataFrame(M, index=df.index, columns=list(groups.keys())))
@@ -0,0 +1,444 @@
+import numpy as np
+import pandas as pd
+import struct
+import json
+import sys
+import os
+
+# Binary per-base coverage store (.bcov)
+#
+# The per-base depth of one sample over a set of reference regions (what
+# `bedtools coverage -d` writes as one text line per base), as a single
+# contiguous array with the regions as an index:
+#
+#   magic (8 bytes) | index offset (uint64) | index length (uint64) |
+#   padding | values | index
+#
+# The values of each region are stored back to back in region order, so
+# region i covers values[offset[i]:offset[i] + end[i] - start[i]]; the
+# offsets follow from the region lengths and are not stored. The index (at
+# the end, so the values can be written in one streaming pass) is a JSON
+# header line followed by the regions as tab-delimited chr, start, end,
+# name lines (0-based, half-open BED coordinates). The values start on a
+# 64-byte boundary and are memory-mapped by readers.
+
+MAGIC = b'\x93BCOV\x01\x00\x00'
+ALIGN = 64
+DATA_OFFSET = ALIGN
+
+REGION_COLUMNS = ['chr', 'start', 'end', 'name']
+
+def is_coverage_store(path):
+
+    if not os.path.isfile(path):
+        return(False)
+
+    with open(path, 'rb') as f:
+        return(f.read(len(MAGIC)) == MAGIC)
+
+def _encode_index(regions, dtype):
+
+    header = {'version': 1, 'dtype': np.dtype(dtype).str, 'n_regions': len(regions), 'length': int((regions['end'] - regions['start']).sum())}
+
+    names = [str(x) for x in regions['name']]
+    if any('\t' in x or '\n' in x for x in names):
+        raise ValueError('region names cannot contain tabs or newlines')
+
+    lines = ['{}\t{}\t{}\t{}'.format(c, s, e, n) for c, s, e, n in zip(regions['chr'], regions['start'], regions['end'], names)]
+
+    return((json.dumps(header) + '\n' + '\n'.join(lines)).encode('utf-8'))
+
+def _regions_frame(regions):
+
+    # chr, start, end, name columns from a DataFrame or (chr, start, end,
+    # name) tuples
+
+    if not isinstance(regions, pd.DataFrame):
+        regions = pd.DataFrame(list(regions), columns=REGION_COLUMNS)
+
+    regions = regions[REGION_COLUMNS].reset_index(drop=True)
+    regions['start'] = regions['start'].astype(np.int64)
+    regions['end'] = regions['end'].astype(np.int64)
+
+    if (regions['end'] < regions['start']).any():
+        raise ValueError('regions with end before start')
+
+    return(regions)
+
+def _write_prefix(f, index_offset, index_nbytes):
+
+    f.seek(0)
+    f.write(MAGIC)
+    f.write(struct.pack('<QQ', index_offset, index_nbytes))
+
+def create_coverage(path, regions, dtype=np.uint32):
+
+    # write the index for the regions and return a writable memory map of
+    # the (zero-filled) values for the caller to fill, region by region or
+    # in any order
+
+    regions = _regions_frame(regions)
+    dtype = np.dtype(dtype)
+
+    index = _encode_index(regions, dtype)
+    n = int((regions['end'] - regions['start']).sum())
+    index_offset = DATA_OFFSET + n * dtype.itemsize
+
+    with open(path, 'wb') as f:
+        _write_prefix(f, index_offset, len(index))
+        f.write(b'\x00' * (DATA_OFFSET - f.tell()))
+        f.truncate(index_offset)
+        f.seek(index_offset)
+        f.write(index)
+
+    if not n:
+        return(np.zeros(0, dtype=dtype))
+
+    return(np.memmap(path, mode='r+', dtype=dtype, offset=DATA_OFFSET, shape=(n,)))
+
+class CoverageWriter():
+
+    # sequential writer: regions and their values are appended in order and
+    # the index is written on close
+
+    def __init__(self, path, dtype=np.uint32):
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.regions = list()
+
+        self.fileobj = open(path, 'wb')
+        _write_prefix(self.fileobj, 0, 0)
+        self.fileobj.write(b'\x00' * (DATA_OFFSET - self.fileobj.tell()))
+
+    def add(self, chrom, start, end, name, values):
+
+        values = np.asarray(values)
+        if len(values) != end - start:
+            raise ValueError('region {} has {} values for {} bases'.format(name, len(values), end - start))
+
+        self.fileobj.write(values.astype(self.dtype, copy=False).tobytes())
+        self.regions.append((chrom, start, end, name))
+
+    def write(self, values):
+
+        # values of regions registered with add_region, for callers that
+        # produce them in chunks not aligned to regions
+
+        self.fileobj.write(np.asarray(values).astype(self.dtype, copy=False).tobytes())
+
+    def add_region(self, chrom, start, end, name):
+
+        self.regions.append((chrom, start, end, name))
+
+    def close(self):
+
+        if self.fileobj is None:
+            return
+
+        regions = _regions_frame(self.regions)
+        index_offset = self.fileobj.tell()
+
+        if index_offset != DATA_OFFSET + int((regions['end'] - regions['start']).sum()) * self.dtype.itemsize:
+            self.fileobj.close()
+            self.fileobj = None
+            raise ValueError('{}: number of values does not match the regions'.format(self.path))
+
+        index = _encode_index(regions, self.dtype)
+        self.fileobj.write(index)
+        _write_prefix(self.fileobj, index_offset, len(index))
+
+        self.fileobj.close()
+        self.fileobj = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_index(path):
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a binary coverage store: {}'.format(path))
+        index_offset, index_nbytes = struct.unpack('<QQ', f.read(16))
+        f.seek(index_offset)
+        blob = f.read(index_nbytes).decode('utf-8')
+
+    line, _, body = blob.partition('\n')
+    header = json.loads(line)
+
+    if header['version'] != 1:
+        raise ValueError('unsupported coverage store version {} in {}'.format(header['version'], path))
+
+    rows = [x.split('\t') for x in body.split('\n')] if header['n_regions'] else []
+    regions = pd.DataFrame(rows, columns=REGION_COLUMNS).astype({'start': np.int64, 'end': np.int64})
+    regions['name'] = regions['name'].astype(object)
+
+    lengths = (regions['end'] - regions['start']).values
+    regions['offset'] = np.cumsum(lengths) - lengths
+    regions.index = pd.Index(regions['name'].values, name='region_id')
+
+    return(header, regions)
+
+def open_coverage(path, mode='r'):
+
+    # memory-mapped values and the regions (chr, start, end, name, offset,
+    # indexed by region id); nothing but the index is read until the values
+    # are touched
+
+    header, regions = read_index(path)
+    dtype = np.dtype(header['dtype'])
+
+    if header['length']:
+        values = np.memmap(path, mode=mode, dtype=dtype, offset=DATA_OFFSET, shape=(header['length'],))
+    else:
+        values = np.zeros(0, dtype=dtype)
+
+    return(values, regions)
+
+def region_slice(regions, name, start=None, end=None):
+
+    # slice of the values for region `name`, optionally restricted to the
+    # 1-based positions [start, end] within it (as in bedtools -d)
+
+    r = regions.loc[name]
+    if isinstance(r, pd.DataFrame):
+        r = r.iloc[0]
+
+    length = r['end'] - r['start']
+
+    a = 0 if start is None else max(start - 1, 0)
+    b = length if end is None else min(end, length)
+
+    return(slice(r['offset'] + a, r['offset'] + max(a, b)))
+
+def region_positions(regions):
+
+    # for every base of the regions (in order), its region row and 0-based
+    # position within the region
+
+    lengths = (regions['end'] - regions['start']).values
+    n = lengths.sum()
+
+    rep = np.repeat(np.arange(len(regions)), lengths)
+    pos = np.arange(n) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    return(rep, pos)
+
+def _frame(values, regions):
+
+    rep, pos = region_positions(regions)
+
+    return(pd.DataFrame({
+        'chr': regions['chr'].values[rep],
+        'start': regions['start'].values[rep],
+        'end': regions['end'].values[rep],
+        'name': regions['name'].values[rep],
+        'pos': pos + 1,
+        'depth': np.asarray(values[regions['offset'].values[rep] + pos]),
+    }))
+
+def coverage_frame(path, names=None):
+
+    # the store as the columns `bedtools coverage -d` writes (chr, start,
+    # end, name, 1-based position, depth), for all regions or only those
+    # in names (in store order)
+
+    values, regions = open_coverage(path)
+
+    if names is not None:
+        regions = regions[regions['name'].isin(set(names))]
+
+    return(_frame(values, regions))
+
+def segment_summits(values, lengths):
+
+    # for consecutive segments of values (lengths > 0), the 0-based position
+    # of the maximum within each; with k tied maxima the ((k-1)//2)-th,
+    # i.e. the middle one (the left of the two middle ones for even k)
+
+    starts = np.cumsum(lengths) - lengths
+
+    peak = np.maximum.reduceat(values, starts)
+    tie = values == np.repeat(peak, lengths)
+
+    k = np.add.reduceat(tie.astype(np.int64), starts)
+    pos = np.flatnonzero(tie)
+
+    return(pos[np.cumsum(k) - k + (k - 1) // 2] - starts, peak)
+
+def region_summits(values, regions, chunk_size=1 << 24):
+
+    # summit (1-based position, as in bedtools -d, and depth) of each
+    # non-empty region of a store, reading about chunk_size values at a time;
+    # returns the region rows, positions and depths
+
+    lengths = (regions['end'] - regions['start']).values
+    offsets = regions['offset'].values
+    rows = np.flatnonzero(lengths > 0)
+
+    pos = np.zeros(len(rows), dtype=np.int64)
+    depth = np.zeros(len(rows), dtype=values.dtype)
+
+    # regions are stored back to back, so a run of regions is one slice
+    cum = np.cumsum(lengths[rows])
+    a = 0
+    while a < len(rows):
+        b = max(np.searchsorted(cum, cum[a] - lengths[rows[a]] + chunk_size, side='right'), a + 1)
+        r = rows[a:b]
+        v = np.asarray(values[offsets[r[0]]:offsets[r[-1]] + lengths[r[-1]]])
+        pos[a:b], depth[a:b] = segment_summits(v, lengths[r])
+        a = b
+
+    return(rows, pos + 1, depth)
+
+def read_base_coverage(path, names):
+
+    # per-base coverage from either a `bedtools coverage -d` text file or a
+    # binary store, as a DataFrame with the given six column names
+
+    if is_coverage_store(path):
+        df = coverage_frame(path)
+        df.columns = names
+        return(df)
+
+    return(pd.read_csv(path, sep='\t', header=None, names=names))
+
+def _text_columns(path):
+
+    # column numbers of the region (chr, start, end, name), position and
+    # depth in a `bedtools coverage -d` file; further BED columns are ignored
+
+    with open(path) as fp:
+        ncol = len(fp.readline().rstrip('\n').split('\t'))
+
+    if ncol < 6:
+        raise ValueError('{}: expected coverage of named regions (BED4+, then position and depth), found {} columns'.format(path, ncol))
+
+    return([0, 1, 2, 3, ncol - 2, ncol - 1])
+
+def read_coverage_values(path):
+
+    # per-base coverage as (values, regions), as from open_coverage: for a
+    # store the values are memory-mapped; a text file is parsed once into the
+    # same layout, and must list every base of each region in order
+
+    if is_coverage_store(path):
+        return(open_coverage(path))
+
+    df = pd.read_csv(path, sep='\t', header=None, usecols=_text_columns(path), dtype={0: str, 3: str})
+    df.columns = REGION_COLUMNS + ['pos', 'depth']
+
+    regions = _regions_frame(df.loc[df['pos'].values == 1, REGION_COLUMNS])
+
+    lengths = (regions['end'] - regions['start']).values
+    if lengths.sum() != len(df) or not np.array_equal(region_positions(regions)[1] + 1, df['pos'].values):
+        raise ValueError('{}: not per-base coverage of whole regions (as from bedtools coverage -d)'.format(path))
+
+    regions['offset'] = np.cumsum(lengths) - lengths
+    regions.index = pd.Index(regions['name'].values, name='region_id')
+
+    return(df['depth'].values, regions)
+
+def aligned_values(values, regions, reference, keys=REGION_COLUMNS):
+
+    # values of one sample on the bases of the reference regions, matching
+    # regions on the key columns: the values themselves when the regions are
+    # the same (the usual case, samples covered over one region set), else
+    # realigned by (keys, position) with NaN for bases the sample lacks
+
+    lengths = (regions['end'] - regions['start']).values
+
+    if len(regions) == len(reference) and np.array_equal(lengths, (reference['end'] - reference['start']).values) \
+        and all(np.array_equal(regions[k].values, reference[k].values) for k in keys):
+        return(np.asarray(values))
+
+    def base_index(r):
+        rep, pos = region_positions(r)
+        return(pd.MultiIndex.from_arrays([r[k].values[rep] for k in keys] + [pos + 1]))
+
+    # (values are stored back to back in region order)
+    return(pd.Series(np.asarray(values), index=base_index(regions)).reindex(base_index(reference)).values)
+
+def iter_base_coverage(path, names, chunk_size=1000000):
+
+    # read_base_coverage in blocks of chunk_size rows (the last one shorter),
+    # so files of the same regions can be read in lock-step whatever their
+    # format
+
+    if not is_coverage_store(path):
+        for chunk in pd.read_csv(path, sep='\t', header=None, names=names, chunksize=chunk_size):
+            yield(chunk)
+        return
+
+    values, regions = open_coverage(path)
+
+    lengths = (regions['end'] - regions['start']).values
+    offsets = regions['offset'].values
+    region_end = offsets + lengths
+
+    for r in range(0, len(values), chunk_size):
+
+        rows = np.arange(r, min(r + chunk_size, len(values)))
+        k = np.searchsorted(region_end, rows, side='right')
+
+        yield(pd.DataFrame({
+            names[0]: regions['chr'].values[k],
+            names[1]: regions['start'].values[k],
+            names[2]: regions['end'].values[k],
+            names[3]: regions['name'].values[k],
+            names[4]: rows - offsets[k] + 1,
+            names[5]: np.asarray(values[r:r+len(rows)]),
+        }))
+
+def text_to_coverage(infile, outfile, dtype=np.uint32, chunk_size=1000000):
+
+    # stream a `bedtools coverage -d` file into the store; the first four
+    # region columns are kept, any further BED columns are dropped
+
+    usecols = _text_columns(infile)
+
+    with CoverageWriter(outfile, dtype=dtype) as writer:
+
+        for chunk in pd.read_csv(infile, sep='\t', header=None, usecols=usecols, chunksize=chunk_size, dtype={0: str, 3: str}):
+
+            chunk.columns = REGION_COLUMNS + ['pos', 'depth']
+
+            for c, s, e, n in chunk.loc[chunk['pos'] == 1, REGION_COLUMNS].itertuples(index=False):
+                writer.add_region(c, s, e, n)
+
+            writer.write(chunk['depth'].values)
+
+    return(outfile)
+
+def coverage_to_text(infile, outfile):
+
+    # write the store back out in the `bedtools coverage -d` layout
+
+    values, regions = open_coverage(infile)
+
+    with open(outfile, 'w') as f:
+        for k in range(0, len(regions), 10000):
+            _frame(values, regions.iloc[k:k+10000]).to_csv(f, sep='\t', header=False, index=False)
+
+    return(outfile)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='Convert per-base coverage between `bedtools coverage -d` text and the binary coverage store (.bcov).')
+    parser.add_argument('infile', type=str, help='Input coverage (.bed text from bedtools coverage -d, or .bcov).')
+    parser.add_argument('outfile', type=str, help='Output coverage; .bcov writes the binary store, anything else writes text.')
+    args = parser.parse_args()
+
+    if args.outfile.endswith('.bcov'):
+        if is_coverage_store(args.infile):
+            sys.exit('{} is already a binary coverage store.'.format(args.infile))
+        text_to_coverage(args.infile, args.outfile)
+    else:
+        coverage_to_text(args.infile, args.outfile)
+
+    print('wrote to: {}'.format(args.outfile))
@@ -1,8 +1,7 @@
 import argparse
-from Bio.Alphabet import generic_dna
-from Bio import SeqIO
 from collections import defaultdict, OrderedDict
 from common import get_motif_name
+from genomestore import is_genome_store, open_genome
 import pandas as pd
 import numpy as np
 import pickle
@@ -14,7 +13,7 @@ import os
 parser = argparse.ArgumentParser(prog='')
 parser.add_argument('peak_bed', type=str, help='BED file with peaks of interest.')
 parser.add_argument('peak_motifs', type=str, help='Output file from HOMER findMotifsGenome.pl ... "-find $MOTIF_FILE"')
-parser.add_argument('fasta', type=str, help='Pickled FASTA file')
+parser.add_argument('fasta', type=str, help='Genome store (.gstore, from genomestore.py), or a pickled SeqIO FASTA dictionary.')
 parser.add_argument('-p', '--peak_ids', type=str, help='List of peak IDs to subset BED.')
 parser.add_argument('-f','--flank_size', type=int , default=100, help='Length to extend query peak regions')
 parser.add_argument('-w','--window_size', type=int , default=40, help='Length to extend motif center by in BED file')
@@ -59,6 +58,24 @@ def motif_peak_dictionary(fp, peak_ids):
 
     return(motif_df.to_dict(orient='index', into=OrderedDict()))
 
+def read_genome(fp):
+
+    # the memory-mapped store opens without reading the sequences; the
+    # pickled SeqRecord dictionary is loaded whole
+
+    if is_genome_store(fp):
+        return(open_genome(fp))
+
+    with open(fp, 'rb') as f:
+        return(pickle.load(f)) # SeqIO::SeqRecord() object
+
+def peak_sequence(genome, chrom, start, end):
+
+    if hasattr(genome, 'sequence'):
+        return(genome.sequence(chrom, start, end))
+
+    return(str(genome[chrom][start:end].seq))
+
 def motif_coordinate_dictionary(motifs, genome_coordinates, peak_location, flank_size):
 
     motif_loc = defaultdict(dict) 
@@ -75,22 +92,22 @@ def motif_coordinate_dictionary(motifs, genome_coordinates, peak_location, flank
             loc_start = loc['start'] - flank_size
             loc_end = loc['end'] + flank_size
     
-            ps = genome_coordinates[loc['chr']][loc_start:loc_end].seq 
+            ps = peak_sequence(genome_coordinates, loc['chr'], loc_start, loc_end)
             ms = motif_instance['seq'] 
     
             if last_pid != peak_id:
                 last_index = 0
                 last_offset = None
     
-            mh = re.search(ms, ps.__str__()[last_index:])
+            mh = re.search(ms, ps[last_index:])
     
             # repeat region motif hit
             masked_region = False
     
             if not mh:
 
-                if re.search(ms, ps.__str__()[last_index:], re.IGNORECASE):
-                    mh = re.search(ms, ps.__str__()[last_index:], re.IGNORECASE)
+                if re.search(ms, ps[last_index:], re.IGNORECASE):
+                    mh = re.search(ms, ps[last_index:], re.IGNORECASE)
                     masked_region = True
                 elif (last_pid == peak_id) and (motif_instance['offset'] == last_offset): 
                     warnings.warn('"{}" in "{}" has identical position match of another motif. Skipping...'.format(motif_id, peak_id)) 
@@ -179,8 +196,7 @@ def main():
     motifs = motif_peak_dictionary(args.peak_motifs, list(peak_loc.keys()))
 
     print("reading genome...")
-    with open(args.fasta, 'rb') as fp:
-        genome_coord = pickle.load(fp) # SeqIO::SeqRecord() object 
+    genome_coord = read_genome(args.fasta)
     print('done reading.')
 
     motif_loc = motif_coordinate_dictionary(motifs, genome_coordinates=genome_coord, peak_location=peak_loc, flank_size=args.flank_size) 
@@ -1,6 +1,7 @@
 import argparse
 from read_coverage import run_coverage
 from common import bsub
+from genomestore import fasta_to_genome
 import concurrent.futures
 import subprocess
 import tempfile
@@ -12,7 +13,7 @@ import os
 parser = argparse.ArgumentParser(prog='')
 parser.add_argument('peak_bed', type=str, help='BED file with peaks of interest.')
 parser.add_argument('peak_motif_list', type=str, help='Directory with atac bams.')
-parser.add_argument('fasta', type=str, help='Pickled FASTA in binary format.')
+parser.add_argument('fasta', type=str, help='Genome store (.gstore), FASTA (built into a store once for all jobs) or pickled FASTA in binary format.')
 parser.add_argument('-p', '--peak_ids', type=str, help='List of peak IDs to subset BED.')
 parser.add_argument('-o', '--output_dir', default='.', help='')
 args = parser.parse_args()
@@ -26,15 +27,26 @@ def run_find_motif_bed(find_motif_file):
     cmd = 'python3 ' + script \
         + ' ' + args.peak_bed \
         + ' ' + find_motif_file \
-        + ' ' + args.fasta 
+        + ' ' + args.fasta \
         + ' -o ' + args.output_dir
          
-    cmd = bsub(cmd, mem=8, gtmp=4, docker_image='apollodorus/bioinf:pr', 'motif_scan')
+    cmd = bsub(cmd, mem=8, gtmp=4, docker_image='apollodorus/bioinf:pr', job_name='motif_scan')
     print(cmd)
 #    subprocess.check_call(cmd, shell=True)
 
 def main():
 
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # every job memory-maps the same store rather than loading its own copy
+    # of the genome; the store only appears at its path once fully built
+    if re.search(r'\.(fa|fasta|fna)(\.gz)?$', args.fasta):
+        store = os.path.join(args.output_dir, re.sub(r'\.(fa|fasta|fna)(\.gz)?$', '.gstore', os.path.basename(args.fasta)))
+        if not os.path.exists(store):
+            print('building genome store: {}'.format(store))
+            fasta_to_genome(args.fasta, store)
+        args.fasta = store
 
     with open(args.peak_motif_list) as fp:
         motif_files = fp.read().strip().split('\n')
@@ -3,9 +3,9 @@ import seaborn as sn
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from collections import OrderedDict
 import json
-import re
+from coveragestore import read_coverage_values, aligned_values, region_positions
+from common import group_aggregate
 import os
 
 parser = argparse.ArgumentParser(prog='')
@@ -24,32 +24,29 @@ def coverage_dictionary(paths):
     sample_files = [(sample_id(fp), fp) for group, l in paths.items() for fp in l] 
     sample_files.sort(key=lambda x: x[0])
     
-    df = pd.read_csv(sample_files[0][1], sep='\t', header=None, names=['chr', 'start', 'end', 'motif_id', 'pos', sample_files[0][0]], index_col=['motif_id','chr','start','end','pos'])
+    # samples are read as value arrays over the first sample's regions (the
+    # same regions in the usual case, so no per-base index is built)
+    values, regions = read_coverage_values(sample_files[0][1])
 
-    counts_df = pd.DataFrame(0, index=df.index, columns=[s[0] for s in sample_files], dtype=np.float32) 
-    counts_df[sample_files[0][0]] = df
+    counts = np.empty((len(values), len(sample_files)), dtype=np.float64)
+    counts[:,0] = values
 
-    for i,p in sample_files[1:]:
-
-        df = pd.read_csv(p, sep='\t', header=None, names=['chr', 'start', 'end', 'motif_id', 'pos', i], index_col=['motif_id','chr','start','end','pos'])
-
-        counts_df[i] = df[i] 
-
-    pat = r'\w+(?=[0-9]+$)' # regex for groups from sample ids
-
-    groups = OrderedDict()
-    for i,sid in enumerate(list(counts_df.columns)):
-        groups.setdefault(re.search(pat, sid).group(0), []).append(i)
+    for k, (i,p) in enumerate(sample_files[1:], 1):
+        counts[:,k] = aligned_values(*read_coverage_values(p), regions)
 
     # get mean across group indices
-    mu_counts_df = pd.DataFrame(0, index=counts_df.index, columns=groups.keys())
-
-    for grp, idc in groups.items():
-        group_cols = counts_df.columns[idc]
-        mu_counts_df[grp] = counts_df[group_cols].apply(np.mean, axis=1)
-
-    mu_counts_df.reset_index(inplace=True)
-    mu_counts_df[['start', 'end']] = mu_counts_df[['start', 'end']].astype(np.int32)
+    mu_counts_df = group_aggregate(pd.DataFrame(counts, columns=[s[0] for s in sample_files]))
+
+    rep, pos = region_positions(regions)
+    keys_df = pd.DataFrame({
+        'motif_id': regions['name'].values[rep],
+        'chr': regions['chr'].values[rep],
+        'start': regions['start'].values[rep].astype(np.int32),
+        'end': regions['end'].values[rep].astype(np.int32),
+        'pos': pos + 1,
+    })
+
+    mu_counts_df = pd.concat([keys_df, mu_counts_df], axis=1)
 
     return(mu_counts_df)
 
@@ -1,10 +1,9 @@
 import argparse
-import subprocess
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import shutil
-import tempfile
+from collections import OrderedDict
+import concurrent.futures
 import json
 import os
 
@@ -12,69 +11,171 @@ parser = argparse.ArgumentParser(prog='Merge peaks across replicates and generat
 parser.add_argument('json', type=str, help='Path to input json listing .bam and .narrowPeak input files.')
 parser.add_argument('-w', '--window_size', type=int, default=10, help='Window size for merging intra and inter replicate peaks.')
 parser.add_argument('-o', '--output_dir', default='.', help='Window size for merging intra and inter replicate peaks.')
+parser.add_argument('-p', '--processes', type=int, default=4, help='Worker processes for the per-replicate and per-group merges.')
+parser.add_argument('--precision', type=int, default=5, help='Significant digits of merged mean values (as bedtools merge -prec).')
 parser.add_argument('--debug', action='store_true', help='')
 args = parser.parse_args()
 
-def intra_rep_peak_merge(narrow_peak, tmpdir, debug=args.debug):
+# Peaks are merged in-process with the semantics of `sort -k1,1 -k2,2n |
+# bedtools merge -d <window>`: records are ordered by chromosome, start and
+# then the whole line (sort's last-resort key, C locale), and a record joins
+# the current merged interval if it starts at most <window> bp after the
+# furthest end so far. Each stage keeps the records as they would have been
+# written to text, so collapsed names, tie order and mean values match the
+# shell pipelines, including the pandas round trip of every intermediate file.
 
-    # keep peak name and mean_signal (cols=4,7) 
+def read_records(path, skiprows=0):
 
-    prefix = os.path.split(narrow_peak)[1].split('_')[0]
-    outfile = os.path.join(tmpdir, prefix + 'intra_rep_merge.narrowPeak')
+    # bed-like records as text; track/browser/comment lines are skipped as
+    # in bedtools
+
+    df = pd.read_csv(path, sep='\t', header=None, skiprows=skiprows, dtype=object, keep_default_na=False)
+    df = df[~df[0].str.startswith(('track', 'browser', '#'))].reset_index(drop=True)
+
+    return(df)
+
+def record_lines(df, columns):
+
+    text = df[columns].astype(str)
+    return(text.iloc[:,0].str.cat([text.iloc[:,i] for i in range(1, text.shape[1])], sep='\t').values.astype(str))
+
+def sort_records(df, columns):
+
+    # order of `sort -k1,1 -k2,2n` in the C locale; only records tied on
+    # chromosome and start need their text line (columns, tab-joined) for
+    # sort's last-resort comparison
+
+    chrom = pd.factorize(df['chr'], sort=True)[0].astype(np.int64)
+    start = df['start'].values.astype(np.int64)
+
+    # a stable sort on one (chromosome, start) key, so records tied on it
+    # keep their input order for the text comparison below
+    order = np.argsort(chrom * (start.max() + 1 if len(start) else 1) + start, kind='stable')
+
+    tie = np.r_[False, (chrom[order][1:] == chrom[order][:-1]) & (start[order][1:] == start[order][:-1])]
+
+    if tie.any():
+        idx = np.flatnonzero(tie | np.r_[tie[1:], False])
+        group = np.cumsum(~tie)[idx]
+        lines = record_lines(df.iloc[order[idx]], columns)
+        order[idx] = order[idx][np.lexsort((lines, group))]
+
+    return(df.iloc[order].reset_index(drop=True))
+
+def format_mean(x):
+
+    # bedtools prints means to --precision significant digits, and the
+    # pipelines read them back and rewrite them with pandas (as integers
+    # if every value in the column is integral, else as floats); the
+    # values are kept as that text
+
+    codes, uniques = pd.factorize(x)
+    text = ['%.*g' % (args.precision, v) for v in uniques]
+
+    if not all(t.lstrip('-').isdigit() for t in text):
+        text = [repr(float(t)) for t in text]
+
+    return(np.array(text, dtype=object)[codes])
+
+def _join_runs(values, first, counts, sep):
+
+    # only merged intervals of several records need a join
+
+    joined = values[first].astype(object)
+    values = list(values)
+
+    for j in np.flatnonzero(counts > 1):
+        joined[j] = sep.join(values[first[j]:first[j]+counts[j]])
 
-    cmd='tail -n+2 ' + narrow_peak \
-      + ' | sort -k1,1 -k2,2n' \
-      + ' | bedtools merge -i -' \
-      + ' -d ' + str(args.window_size) \
-      + ' -c 4,5,7' \
-      + ' -o collapse,mean,mean' \
-      + ' -delim ' + '","' \
-      + ' > ' + outfile 
+    return(joined)
 
-    if debug:
-        print('* '+cmd)
+def _segment_means(x, first, counts):
 
-    subprocess.check_call(cmd, shell=True)
+    # sequential sums per merged interval (in input order, as bedtools
+    # accumulates them), one vectorized step per position in the interval
 
-    df = pd.read_csv(outfile, sep='\t', header=None, names=['chr', 'start', 'end', 'peak_names', 'score', 'signalValue']) 
+    sums = x[first].copy()
+    for k in range(1, counts.max() if len(counts) else 0):
+        m = counts > k
+        sums[m] += x[first[m] + k]
 
-    df['peak_names'] = df['peak_names'].apply(lambda x: prefix + '_' + '_'.join([peak_ids.split('_')[1] for peak_ids in x.split(',')])) 
+    return(sums / counts)
 
-    df.to_csv(outfile, sep='\t', header=False, index=False)
-    return(outfile)
+def merge_records(df, window, ops):
 
-def inter_rep_peak_merge(beds, group, tmpdir, debug=args.debug): 
+    # sweep over records sorted by sort_records; ops maps output columns to
+    # (input column, 'collapse' | 'mean' | 'count')
 
-    tmp1 = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) 
-    subprocess.check_call('cat ' + ' '.join(beds) + ' > ' + tmp1.name, shell=True)
+    start = df['start'].values.astype(np.int64)
+    end = df['end'].values.astype(np.int64)
 
-    tmp2 = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) 
+    # one coordinate axis for all chromosomes, spaced so no interval is
+    # ever merged across a chromosome boundary
+    chrom_code = pd.factorize(df['chr'])[0].astype(np.int64)
+    span = (end.max() if len(end) else 0) + abs(window) + 1
+    s = chrom_code * span + start
+    e = chrom_code * span + end
 
-    cmd='sort -k1,1 -k2,2n ' + tmp1.name \
-      + ' | bedtools merge -i -' \
-      + ' -d ' + str(args.window_size) \
-      + ' -c 4,1,5,6' \
-      + ' -o collapse,count,mean,mean' \
-      + ' -delim '+ '","' \
-      + ' > ' + tmp2.name 
+    running_end = np.maximum.accumulate(e) if len(e) else e
+    new = np.r_[True, s[1:] > running_end[:-1] + window] if len(s) else np.zeros(0, dtype=bool)
 
-    if debug:
-        print('* '+cmd)
+    first = np.flatnonzero(new)
+    counts = np.diff(np.r_[first, len(s)])
 
-    subprocess.check_call(cmd, shell=True)
+    merged = pd.DataFrame({
+        'chr': df['chr'].values[first],
+        'start': start[first],
+        'end': np.maximum.reduceat(end, first) if len(first) else end[:0],
+    })
 
-    df = pd.read_csv(tmp2.name, sep='\t', header=None, names=['chr', 'start', 'end', 'peak_id', 'count', 'score','signalValue'])
+    for col, (src, op) in ops.items():
+        if op == 'collapse':
+            merged[col] = _join_runs(df[src].values, first, counts, ',')
+        elif op == 'mean':
+            merged[col] = format_mean(_segment_means(df[src].values.astype(np.float64), first, counts))
+        elif op == 'count':
+            merged[col] = counts
+        else:
+            raise ValueError('unknown merge operation: {}'.format(op))
+
+    return(merged)
+
+def intra_rep_peak_merge(narrow_peak):
+
+    # keep peak name and mean_signal (cols=4,7) 
+
+    prefix = os.path.split(narrow_peak)[1].split('_')[0]
+
+    df = read_records(narrow_peak, skiprows=1)
+    df = df.rename(columns={0:'chr', 1:'start', 2:'end', 3:'name', 4:'score', 6:'signalValue'})
+    df['start'] = df['start'].astype(np.int64)
+    df['end'] = df['end'].astype(np.int64)
+
+    df = sort_records(df, list(df.columns))
+
+    # peak names reduced to their second '_' field, joined per merged peak
+    df['name'] = [x.split('_')[1] for x in df['name']]
+
+    df = merge_records(df, args.window_size, {'peak_names': ('name', 'collapse'), 'score': ('score', 'mean'), 'signalValue': ('signalValue', 'mean')})
+    df['peak_names'] = prefix + '_' + df['peak_names'].str.replace(',', '_', regex=False)
+
+    return(df)
+
+def inter_rep_peak_merge(rep_dfs, group): 
+
+    df = pd.concat(rep_dfs, ignore_index=True)
+    df = sort_records(df, ['chr', 'start', 'end', 'peak_names', 'score', 'signalValue'])
+    df = merge_records(df, args.window_size, {'peak_id': ('peak_names', 'collapse'), 'count': ('chr', 'count'), 'score': ('score', 'mean'), 'signalValue': ('signalValue', 'mean')})
 
     # filter for peaks with at least one replicate support
 
-    mask = df['count'].map(lambda x: x >= 2)
-    df = df[mask]
+    df = df[df['count'] >= 2]
 
     # use narrowPeak format for visualization
 
     df['strand'] = '.'
 
-    df = df[['chr', 'start', 'end', 'peak_id', 'score', 'strand', 'signalValue']]
+    df = df[['chr', 'start', 'end', 'peak_id', 'score', 'strand', 'signalValue']].reset_index(drop=True)
 
     outfile = os.path.join(args.output_dir, group + '_consensus_peaks.narrowPeak')   
 
@@ -84,29 +185,13 @@ def inter_rep_peak_merge(beds, group, tmpdir, debug=args.debug):
         fp.write(desc)
         df.to_csv(fp, sep='\t', header=False, index=False)
 
-    return(outfile)
-
-def generate_peak_features(consensus_peak_files, tmpdir, debug=args.debug):
-
-    tmp1 = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) 
-    subprocess.check_call('cat ' + ' '.join(consensus_peak_files) + ' > ' + tmp1.name, shell=True)
-
-    tmp2 = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) 
-
-    cmd='sort -k1,1 -k2,2n ' + tmp1.name \
-      + ' | bedtools merge -i -' \
-      + ' -d ' + str(args.window_size) \
-      + ' -c 4' \
-      + ' -o collapse' \
-      + ' -delim '+ '","' \
-      + ' > ' + tmp2.name 
+    return(df)
 
-    if debug:
-        print('* '+cmd)
+def generate_peak_features(consensus_dfs):
 
-    subprocess.check_call(cmd, shell=True)
-
-    df = pd.read_csv(tmp2.name, sep='\t', header=None, names=['chr', 'start', 'end', 'peak_id'])
+    df = pd.concat(consensus_dfs, ignore_index=True)
+    df = sort_records(df, ['chr', 'start', 'end', 'peak_id', 'score', 'strand', 'signalValue'])
+    df = merge_records(df, args.window_size, {'peak_id': ('peak_id', 'collapse')})
 
     # format as saf annotation file
     df['strand'] = '.'
@@ -125,34 +210,31 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    tmp_dir = tempfile.mkdtemp(dir=args.output_dir)
-        
-    rep_consensus_peak_files = list()
-
-    for group, paths in peak_data.items():
-
-        np_files = paths.get('narrowPeaks')
+    # replicates and groups are independent until the feature merge: all
+    # replicates go to the pool at once, and each group's consensus is
+    # submitted as soon as its replicates are merged; results are collected
+    # in input order, so the output does not depend on scheduling
 
-        intra_rep_merged_peak_files = list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
 
-        print("[ {} ] Merging +/- {} bp peaks for {}.".format(datetime.now().strftime("%b %d %H:%M:%S"), args.window_size, group))
+        print("[ {} ] Merging +/- {} bp peaks for {}.".format(datetime.now().strftime("%b %d %H:%M:%S"), args.window_size, ', '.join(peak_data.keys())))
 
-        for npf in np_files:
+        intra_rep_merged_peaks = OrderedDict()
+        for group, paths in peak_data.items():
+            intra_rep_merged_peaks[group] = [executor.submit(intra_rep_peak_merge, npf) for npf in paths.get('narrowPeaks')]
 
-            rep_peak_file = intra_rep_peak_merge(npf, tmp_dir)
-            intra_rep_merged_peak_files.append(rep_peak_file)
+        rep_consensus_peaks = OrderedDict()
+        for group, futures in intra_rep_merged_peaks.items():
+            rep_consensus_peaks[group] = executor.submit(inter_rep_peak_merge, [f.result() for f in futures], group)
+            print("[ {} ] Making consensus peak set for {}.".format(datetime.now().strftime("%b %d %H:%M:%S"), group))
 
-        print("[ {} ] Making consensus peak set for {}.".format(datetime.now().strftime("%b %d %H:%M:%S"), group))
-
-        rep_consensus_peaks = inter_rep_peak_merge(intra_rep_merged_peak_files, group, tmp_dir)
-        rep_consensus_peak_files.append(rep_consensus_peaks)
+        rep_consensus_peaks = [f.result() for f in rep_consensus_peaks.values()]
 
     print("[ {} ] Generating peak features (.saf) file.".format(datetime.now().strftime("%b %d %H:%M:%S")))
 
-    saf = generate_peak_features(rep_consensus_peak_files, tmp_dir)
+    saf = generate_peak_features(rep_consensus_peaks)
 
     print('wrote to: '+ saf)
 
 if __name__ == '__main__':
     main()
-
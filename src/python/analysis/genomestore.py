@@ -0,0 +1,177 @@
+import numpy as np
+import struct
+import gzip
+import json
+import sys
+import os
+
+# Memory-mapped genome store (.gstore)
+#
+# The sequences of a FASTA file as one flat byte array with an index of
+# chromosome names and lengths, built once and memory-mapped by readers:
+#
+#   magic (8 bytes) | index offset (uint64) | index length (uint64) |
+#   padding | sequences | index
+#
+# Sequences are stored back to back, one byte per base exactly as in the
+# FASTA (case and ambiguity codes are kept: soft-masked repeats are lower
+# case, which the motif search relies on). The index is a JSON header line
+# followed by tab-delimited name, length lines; offsets follow from the
+# lengths. Opening a store only reads the index, and fetching a region is a
+# slice of the map, so processes reading the same genome share its pages
+# through the page cache instead of each holding a copy.
+
+MAGIC = b'\x93GSEQ\x01\x00\x00'
+ALIGN = 64
+DATA_OFFSET = ALIGN
+
+def is_genome_store(path):
+
+    if not os.path.isfile(path):
+        return(False)
+
+    with open(path, 'rb') as f:
+        return(f.read(len(MAGIC)) == MAGIC)
+
+def _write_prefix(f, index_offset, index_nbytes):
+
+    f.seek(0)
+    f.write(MAGIC)
+    f.write(struct.pack('<QQ', index_offset, index_nbytes))
+
+def fasta_to_genome(infile, outfile):
+
+    # stream a (optionally gzipped) FASTA file into the store; records are
+    # named by the first word of their header line, as in SeqIO.to_dict.
+    # The store is written under a temporary name next to outfile and moved
+    # into place once complete, so an interrupted build leaves no store
+
+    opener = gzip.open if infile.endswith('.gz') else open
+    tmpfile = '{}.{}.tmp'.format(outfile, os.getpid())
+
+    names = list()
+    seen = set()
+    lengths = list()
+
+    try:
+        with opener(infile, 'rb') as fp, open(tmpfile, 'wb') as f:
+
+            _write_prefix(f, 0, 0)
+            f.write(b'\x00' * (DATA_OFFSET - f.tell()))
+
+            for line in fp:
+
+                line = line.rstrip(b'\r\n')
+
+                if line.startswith(b'>'):
+                    name = line[1:].split(None, 1)[0].decode('utf-8') if line[1:].strip() else ''
+                    if name in seen:
+                        raise ValueError('duplicate sequence name in {}: {}'.format(infile, name))
+                    seen.add(name)
+                    names.append(name)
+                    lengths.append(0)
+                    continue
+
+                if not names:
+                    if line.strip():
+                        raise ValueError('{} does not start with a FASTA header'.format(infile))
+                    continue
+
+                line = line.replace(b' ', b'')
+                f.write(line)
+                lengths[-1] += len(line)
+
+            header = {'version': 1, 'n_sequences': len(names), 'length': sum(lengths)}
+            index = (json.dumps(header) + '\n' + '\n'.join('{}\t{}'.format(n, l) for n, l in zip(names, lengths))).encode('utf-8')
+
+            index_offset = f.tell()
+            f.write(index)
+            _write_prefix(f, index_offset, len(index))
+
+        os.replace(tmpfile, outfile)
+
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+    return(outfile)
+
+def read_index(path):
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a genome store: {}'.format(path))
+        index_offset, index_nbytes = struct.unpack('<QQ', f.read(16))
+        f.seek(index_offset)
+        blob = f.read(index_nbytes).decode('utf-8')
+
+    line, _, body = blob.partition('\n')
+    header = json.loads(line)
+
+    if header['version'] != 1:
+        raise ValueError('unsupported genome store version {} in {}'.format(header['version'], path))
+
+    rows = [x.split('\t') for x in body.split('\n')] if header['n_sequences'] else []
+
+    return(header, [n for n, l in rows], [int(l) for n, l in rows])
+
+class GenomeStore():
+
+    # read-only view of a store: genome[chrom] is the chromosome's bytes as
+    # a uint8 array (a slice of the map, sliced like the sequence itself) and
+    # genome.sequence(chrom, start, end) the region as a string
+
+    def __init__(self, path):
+
+        self.path = path
+
+        header, self.names, self.lengths = read_index(path)
+
+        if header['length']:
+            self.values = np.memmap(path, mode='r', dtype=np.uint8, offset=DATA_OFFSET, shape=(header['length'],))
+        else:
+            self.values = np.zeros(0, dtype=np.uint8)
+
+        offsets = np.cumsum(self.lengths) - self.lengths
+        self.index = {n: (int(o), int(o) + l) for n, o, l in zip(self.names, offsets, self.lengths)}
+
+    def __contains__(self, chrom):
+        return(chrom in self.index)
+
+    def __len__(self):
+        return(len(self.names))
+
+    def __iter__(self):
+        return(iter(self.names))
+
+    def keys(self):
+        return(list(self.names))
+
+    def __getitem__(self, chrom):
+
+        a, b = self.index[chrom]
+        return(self.values[a:b])
+
+    def sequence(self, chrom, start=None, end=None):
+
+        return(self[chrom][start:end].tobytes().decode('ascii'))
+
+def open_genome(path):
+
+    return(GenomeStore(path))
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='Build a memory-mapped genome store (.gstore) from a FASTA file.')
+    parser.add_argument('fasta', type=str, help='Genome FASTA (.fa/.fasta, optionally gzipped).')
+    parser.add_argument('outfile', type=str, help='Output genome store (.gstore).')
+    args = parser.parse_args()
+
+    if is_genome_store(args.fasta):
+        sys.exit('{} is already a genome store.'.format(args.fasta))
+
+    fasta_to_genome(args.fasta, args.outfile)
+
+    print('wrote to: {}'.format(args.outfile))
@@ -0,0 +1,256 @@
+import numpy as np
+import pandas as pd
+import struct
+import gzip
+import json
+import sys
+import os
+
+# Binary columnar matrix store (.bmat)
+#
+# A single file holding one typed numeric block with its row and column
+# labels, laid out so readers can memory-map the values without parsing:
+#
+#   magic (8 bytes) | header length (uint32) | JSON header |
+#   row labels | column labels | padding | values (column-major)
+#
+# The JSON header records the dtype, shape, index name and the byte offset
+# and length of each section. String labels are newline-joined UTF-8 and
+# numeric labels a raw little-endian array. Values are stored in Fortran
+# order so a sample (column) is one contiguous slice, which is how the
+# normalization code walks the matrix. The values start on a 64-byte
+# boundary.
+
+MAGIC = b'\x93BMAT\x01\x00\x00'
+ALIGN = 64
+
+def is_matrix_store(path):
+
+    if not os.path.isfile(path):
+        return(False)
+
+    with open(path, 'rb') as f:
+        return(f.read(len(MAGIC)) == MAGIC)
+
+def _encode_labels(labels, dtype):
+
+    if dtype != 'object':
+        return(np.asarray(labels, dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+
+    labels = [str(x) for x in labels]
+    if any('\n' in x for x in labels):
+        raise ValueError('matrix labels cannot contain newlines')
+
+    return('\n'.join(labels).encode('utf-8'))
+
+def _decode_labels(blob, n, dtype, name=None):
+
+    if dtype != 'object':
+        labels = np.frombuffer(blob, dtype=np.dtype(dtype).newbyteorder('<'), count=n).astype(dtype)
+        return(pd.Index(labels, name=name))
+
+    labels = blob.decode('utf-8').split('\n') if n else []
+    return(pd.Index(labels, name=name, dtype=object))
+
+def _label_dtype(labels):
+
+    # integer or float labels (e.g. numeric peak ids) are stored as a raw
+    # array and restored as such; anything else is read back as strings
+
+    dtype = pd.Index(labels).dtype
+    return(str(dtype) if dtype.kind in 'iuf' else 'object')
+
+def create_matrix(path, index, columns, dtype=np.float64):
+
+    # write the header and labels, and return a writable column-major
+    # memory map of the values for the caller to fill (e.g. chunk by chunk)
+
+    index = pd.Index(index)
+    columns = pd.Index(columns)
+    dtype = np.dtype(dtype)
+
+    if dtype.kind not in 'biuf':
+        raise ValueError('unsupported matrix dtype: {}'.format(dtype))
+
+    rows_blob = _encode_labels(index, _label_dtype(index))
+    cols_blob = _encode_labels(columns, _label_dtype(columns))
+
+    header = {
+        'version': 1,
+        'dtype': dtype.str,
+        'shape': [len(index), len(columns)],
+        'index_name': index.name,
+        'index_dtype': _label_dtype(index),
+        'columns_dtype': _label_dtype(columns),
+    }
+
+    # offsets depend on the header length, which depends on the offsets;
+    # fixed-width offset fields make one pass enough
+
+    prefix = len(MAGIC) + 4
+    header.update({'rows_offset': 0, 'rows_nbytes': len(rows_blob), 'columns_offset': 0, 'columns_nbytes': len(cols_blob), 'data_offset': 0})
+    width = len(json.dumps(header)) + 3 * 20
+
+    rows_offset = prefix + width
+    cols_offset = rows_offset + len(rows_blob)
+    data_offset = -(-(cols_offset + len(cols_blob)) // ALIGN) * ALIGN
+
+    header.update({'rows_offset': rows_offset, 'columns_offset': cols_offset, 'data_offset': data_offset})
+    header_blob = json.dumps(header).encode('utf-8').ljust(width)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', width))
+        f.write(header_blob)
+        f.write(rows_blob)
+        f.write(cols_blob)
+        f.write(b'\x00' * (data_offset - f.tell()))
+        nbytes = len(index) * len(columns) * dtype.itemsize
+        if nbytes:
+            f.truncate(data_offset + nbytes)
+
+    if not len(index) * len(columns):
+        return(np.empty((len(index), len(columns)), dtype=dtype, order='F'))
+
+    return(np.memmap(path, mode='r+', dtype=dtype, offset=data_offset, shape=(len(index), len(columns)), order='F'))
+
+def read_header(path):
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a binary matrix store: {}'.format(path))
+        width, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(width).decode('utf-8'))
+
+    if header['version'] != 1:
+        raise ValueError('unsupported matrix store version {} in {}'.format(header['version'], path))
+
+    return(header)
+
+def open_matrix(path, mode='r'):
+
+    # memory-mapped values plus the row and column labels; nothing but the
+    # labels is read until the values are touched
+
+    header = read_header(path)
+    m, n = header['shape']
+
+    with open(path, 'rb') as f:
+        f.seek(header['rows_offset'])
+        index = _decode_labels(f.read(header['rows_nbytes']), m, header['index_dtype'], header['index_name'])
+        f.seek(header['columns_offset'])
+        columns = _decode_labels(f.read(header['columns_nbytes']), n, header['columns_dtype'])
+
+    dtype = np.dtype(header['dtype'])
+    if m * n:
+        values = np.memmap(path, mode=mode, dtype=dtype, offset=header['data_offset'], shape=(m, n), order='F')
+    else:
+        values = np.empty((m, n), dtype=dtype, order='F')
+
+    return(values, index, columns)
+
+def load_matrix(path, mode='r'):
+
+    # DataFrame view on the memory map (no copy); use mode='c' for a
+    # copy-on-write view that can be modified without touching the file
+
+    values, index, columns = open_matrix(path, mode=mode)
+    return(pd.DataFrame(values, index=index, columns=columns, copy=False))
+
+def save_matrix(df, path, dtype=None):
+
+    values = np.asarray(df.values) if dtype is None else np.asarray(df.values, dtype=dtype)
+    M = create_matrix(path, df.index, df.columns, dtype=values.dtype)
+    M[:] = values
+
+    if isinstance(M, np.memmap):
+        M.flush()
+
+    return(path)
+
+def _is_gct(path):
+
+    return(path.endswith(('.gct', '.gct.gz', '.gtt', '.gtt.gz')))
+
+def read_matrix(path, gct=None, **kwargs):
+
+    # any matrix the pipeline writes: the binary store (memory-mapped),
+    # a GCT/GTT with its dimension line, or a plain tab-delimited .pct/.txt;
+    # gct=None decides by the file extension
+
+    if is_matrix_store(path):
+        return(load_matrix(path))
+
+    skiprows = 1 if (_is_gct(path) if gct is None else gct) else None
+    return(pd.read_csv(path, sep='\t', skiprows=skiprows, index_col=0, **kwargs))
+
+def text_to_matrix(infile, outfile, dtype=None, chunk_size=100000):
+
+    # stream a GCT/PCT into the binary store without holding the full matrix;
+    # without a dtype the first chunk decides, and later chunks must fit it
+
+    skiprows = 1 if _is_gct(infile) else None
+
+    index = pd.read_csv(infile, sep='\t', skiprows=skiprows, index_col=0, usecols=[0]).index
+    columns = pd.read_csv(infile, sep='\t', skiprows=skiprows, index_col=0, nrows=0).columns
+
+    M = None
+    r = 0
+    dtypes = None if dtype is None else {c: dtype for c in columns}
+    for chunk in pd.read_csv(infile, sep='\t', skiprows=skiprows, index_col=0, chunksize=chunk_size, dtype=dtypes, float_precision='round_trip'):
+
+        if M is None:
+            M = create_matrix(outfile, index, columns, dtype=np.result_type(*chunk.dtypes) if dtype is None else dtype)
+
+        if dtype is None and not all(np.can_cast(t, M.dtype) for t in chunk.dtypes):
+            raise ValueError('rows {}-{} of {} do not fit {}; pass an explicit dtype'.format(r, r+chunk.shape[0], infile, M.dtype))
+
+        M[r:r+chunk.shape[0],:] = chunk.values
+        r += chunk.shape[0]
+
+    if M is None:
+        M = create_matrix(outfile, index, columns, dtype=np.float64 if dtype is None else dtype)
+
+    if isinstance(M, np.memmap):
+        M.flush()
+
+    return(outfile)
+
+def matrix_to_text(infile, outfile, chunk_size=100000, float_format=None):
+
+    # write the binary store back out as a GCT/GTT (dimension line, gzipped
+    # for .gz) or a plain tab-delimited matrix, a block of rows at a time
+
+    values, index, columns = open_matrix(infile)
+    opener = gzip.open if outfile.endswith('.gz') else open
+
+    with opener(outfile, 'wt') as f:
+
+        if _is_gct(outfile):
+            f.write('{0}\t{1}\n'.format(values.shape[0], values.shape[1]))
+
+        for r in range(0, max(values.shape[0], 1), chunk_size):
+            df = pd.DataFrame(np.asarray(values[r:r+chunk_size,:]), index=index[r:r+chunk_size], columns=columns)
+            df.to_csv(f, sep='\t', header=(r == 0), float_format=float_format)
+
+    return(outfile)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='Convert matrices between GCT/PCT text and the binary matrix store (.bmat).')
+    parser.add_argument('infile', type=str, help='Input matrix (.gct[.gz], .gtt[.gz], .pct, .txt or .bmat).')
+    parser.add_argument('outfile', type=str, help='Output matrix; .bmat writes the binary store, anything else writes text.')
+    parser.add_argument('--dtype', type=str, help='Value type for the binary store (e.g. int32, float32; default: inferred).')
+    parser.add_argument('--chunk_size', type=int, default=100000, help='Rows per block while converting.')
+    args = parser.parse_args()
+
+    if args.outfile.endswith('.bmat'):
+        if is_matrix_store(args.infile):
+            sys.exit('{} is already a binary matrix store.'.format(args.infile))
+        text_to_matrix(args.infile, args.outfile, dtype=args.dtype, chunk_size=args.chunk_size)
+    else:
+        matrix_to_text(args.infile, args.outfile, chunk_size=args.chunk_size)
+
+    print('wrote to: {}'.format(args.outfile))
@@ -1,17 +1,18 @@
 import argparse
 import subprocess
-import pandas as pd
 import numpy as np
-from rnaseqnorm import edgeR_cpm 
-from collections import OrderedDict
-import re
+from rnaseqnorm import edgeR_cpm, edgeR_calcNormFactors, edgeR_tmm_reference
+from matrixstore import read_matrix
+from common import group_aggregate
 import os
 
 parser = argparse.ArgumentParser(prog='Normalize gene count matrix using TMM procedure and take mean across replicates.')
-parser.add_argument('count_matrix', type=str, help='Path to gene count matrix.')
+parser.add_argument('count_matrix', type=str, help='Path to gene count matrix (.gct[.gz], or a .bmat binary matrix store).')
 parser.add_argument('groups', type=str, help='List of group levels for each sample column.')
 parser.add_argument('prefix', type=str, help='Prefix for outfile.')
 parser.add_argument('-o', '--output_dir', default='.', help='')
+parser.add_argument('--save_reference', type=str, help='Save the TMM reference library profile (.npz) for normalizing later samples.')
+parser.add_argument('--apply_reference', type=str, help='Normalize against a TMM reference saved with --save_reference.')
 parser.add_argument('--debug', action='store_true', help='')
 args = parser.parse_args()
 
@@ -20,25 +21,23 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    counts_df = pd.read_csv(args.count_matrix, sep='\t', skiprows=1, index_col=0)
+    counts_df = read_matrix(args.count_matrix, gct=True)
 
     print("Normalizing...")
 
-    norm_counts_df = edgeR_cpm(counts_df)
+    if args.apply_reference:
+        reference = np.load(args.apply_reference)
+    elif args.save_reference:
+        reference = edgeR_tmm_reference(counts_df)
+        np.savez(args.save_reference, **reference)
+    else:
+        reference = None
 
-    print("Averaging replicate counts...")
-
-    pat = r'\w+(?=[0-9]+$)' # regex for groups from sample ids 
-    groups = OrderedDict()
-    for i,sid in enumerate(list(norm_counts_df.columns)):
-        groups.setdefault(re.search(pat, sid).group(0), []).append(i)
+    tmm = edgeR_calcNormFactors(counts_df, reference=reference)
+    norm_counts_df = edgeR_cpm(counts_df, tmm=tmm)
 
-    # get mean across group indices
-    mu_norm_counts_df = pd.DataFrame(0, index=norm_counts_df.index, columns=groups.keys())
-
-    for grp, idc in groups.items():
-        group_cols = norm_counts_df.columns[idc]
-        mu_norm_counts_df[grp] = norm_counts_df[group_cols].apply(np.mean, axis=1)
+    print("Averaging replicate counts...")
+    mu_norm_counts_df = group_aggregate(norm_counts_df)
 
     outfile = os.path.join(args.output_dir, args.prefix+'mean_expression.tmm.txt')
     mu_norm_counts_df.to_csv(outfile, sep='\t')
@@ -2,50 +2,114 @@ import argparse
 import subprocess
 import pandas as pd
 import numpy as np
-from rnaseqnorm import normalize_quantiles
-from collections import OrderedDict
-import re
+from rnaseqnorm import normalize_quantiles, normalize_quantiles_memmap, quantile_reference
+from matrixstore import is_matrix_store, open_matrix, read_matrix
+from common import sample_groups, group_aggregate
+import tempfile
+import shutil
 import os
 
 parser = argparse.ArgumentParser(prog='Quantile normalize peak count matrix and take mean across replicates.')
-parser.add_argument('count_matrix', type=str, help='Path to count matrix.')
+parser.add_argument('count_matrix', type=str, help='Path to count matrix (.pct, or a .bmat binary matrix store).')
 parser.add_argument('groups', type=str, help='List of group levels for each sample column.')
 parser.add_argument('prefix', type=str, help='Prefix for outfile.')
 parser.add_argument('-o', '--output_dir', default='.', help='Window size for merging intra and inter replicate peaks.')
+parser.add_argument('--memmap', action='store_true', help='Normalize out-of-core from a memory-mapped copy of the count matrix.')
+parser.add_argument('--chunk_size', type=int, default=100000, help='Rows per block when streaming the matrix in --memmap mode.')
+parser.add_argument('--save_reference', type=str, help='Save the reference quantile vector (.npz) for normalizing later samples.')
+parser.add_argument('--apply_reference', type=str, help='Normalize against a reference quantile vector saved with --save_reference.')
 parser.add_argument('--debug', action='store_true', help='')
 args = parser.parse_args()
 
+def reference_quantiles(M):
+
+    # frozen reference distribution to normalize against, if any
+
+    if args.apply_reference:
+        return(np.load(args.apply_reference)['quantiles'])
+
+    quantiles = quantile_reference(M)
+    if args.save_reference:
+        np.savez(args.save_reference, quantiles=quantiles)
+
+    return(quantiles)
+
+def memmap_normalize(count_matrix, tmpdir, chunk_size):
+
+    # stream the text matrix into a column-major memory map (a binary
+    # matrix store is already one), normalize it column by column, and
+    # return the row/column index with the memory-mapped result for
+    # blockwise writing
+
+    if is_matrix_store(count_matrix):
+        M, index, columns = open_matrix(count_matrix)
+        shape = M.shape
+
+    else:
+        header = pd.read_csv(count_matrix, sep='\t', index_col=0, nrows=0)
+        index = pd.read_csv(count_matrix, sep='\t', index_col=0, usecols=[0]).index
+        columns = header.columns
+
+        shape = (len(index), len(columns))
+        M = np.lib.format.open_memmap(os.path.join(tmpdir, 'counts.npy'), mode='w+', dtype=np.float64, shape=shape, fortran_order=True)
+
+        r = 0
+        for chunk in pd.read_csv(count_matrix, sep='\t', index_col=0, chunksize=chunk_size):
+            M[r:r+chunk.shape[0],:] = chunk.values
+            r += chunk.shape[0]
+        M.flush()
+
+    N = np.lib.format.open_memmap(os.path.join(tmpdir, 'quant_norm.npy'), mode='w+', dtype=np.float64, shape=shape, fortran_order=True)
+    normalize_quantiles_memmap(M, N, quantiles=reference_quantiles(M))
+
+    return(index, columns, N)
+
 def main():
     
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    count_matrix_df = pd.read_csv(args.count_matrix, sep='\t', index_col=0)
+    mu_outfile = os.path.join(args.output_dir, args.prefix+'.accessibility.txt')
+    norm_outfile = os.path.join(args.output_dir, args.prefix+'.quant_norm.pct')
+
+    if args.memmap:
+
+        tmpdir = tempfile.mkdtemp(dir=args.output_dir)
+
+        # the memory-mapped copies are removed whether or not this completes
+        try:
+            print("Normalizing (memory-mapped)...")
+            index, columns, N = memmap_normalize(args.count_matrix, tmpdir, args.chunk_size)
+            groups = sample_groups(columns)
+
+            print("Averaging replicate counts...")
+            for r in range(0, N.shape[0], args.chunk_size):
+
+                norm_matrix_df = pd.DataFrame(np.asarray(N[r:r+args.chunk_size,:]), index=index[r:r+args.chunk_size], columns=columns)
 
-    print("Normalizing...")
-    norm_matrix_df = normalize_quantiles(count_matrix_df)
-    print(norm_matrix_df.head())
+                mode, header = ('w', True) if r == 0 else ('a', False)
+                group_aggregate(norm_matrix_df, groups).to_csv(mu_outfile, sep='\t', mode=mode, header=header)
+                norm_matrix_df.to_csv(norm_outfile, sep='\t', mode=mode, header=header)
 
+            del N
 
-    print("Averaging replicate counts...")
+        finally:
+            shutil.rmtree(tmpdir)
 
-    pat = r'\w+(?=[0-9]+$)' # regex for groups from sample ids 
-    groups = OrderedDict()
-    for i,sid in enumerate(list(norm_matrix_df.columns)):
-        groups.setdefault(re.search(pat, sid).group(0), []).append(i)
+    else:
 
-    # get mean across group indices
-    mu_norm_matrix_df = pd.DataFrame(0, index=norm_matrix_df.index, columns=groups.keys())
+        count_matrix_df = read_matrix(args.count_matrix)
 
-    for grp, idc in groups.items():
-        group_cols = norm_matrix_df.columns[idc]
-        mu_norm_matrix_df[grp] = norm_matrix_df[group_cols].apply(np.mean, axis=1)
+        print("Normalizing...")
+        quantiles = reference_quantiles(count_matrix_df.values)
+        norm_matrix_df = normalize_quantiles(count_matrix_df, quantiles=quantiles)
+        print(norm_matrix_df.head())
 
-    outfile = os.path.join(args.output_dir, args.prefix+'.accessibility.txt')
-    mu_norm_matrix_df.to_csv(outfile, sep='\t')
+        print("Averaging replicate counts...")
+        mu_norm_matrix_df = group_aggregate(norm_matrix_df)
 
-    outfile = os.path.join(args.output_dir, args.prefix+'.quant_norm.pct')
-    norm_matrix_df.to_csv(outfile, sep='\t')
+        mu_norm_matrix_df.to_csv(mu_outfile, sep='\t')
+        norm_matrix_df.to_csv(norm_outfile, sep='\t')
 
     print("wrote to *.accessibility (averaged) and *.quant_norm.pct (w/ replicates) to: {}".format(args.output_dir)) 
     
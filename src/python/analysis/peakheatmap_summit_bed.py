@@ -1,41 +1,56 @@
 import argparse
 import pandas as pd
-from collections import defaultdict
+import numpy as np
+from coveragestore import read_base_coverage, is_coverage_store, open_coverage, region_summits, segment_summits
 
 parser = argparse.ArgumentParser(prog='Callable from peakheatmap_summit_coverage.py')
-parser.add_argument('peak_covereage_file', type=str, help='BED file with peaks of interest.')
+parser.add_argument('peak_covereage_file', type=str, help='Peak coverage from bedtools coverage -d (text or binary .bcov store).')
 parser.add_argument('-w','--window_size', type=int , default=1000, help='Length which to extend peak summit.') 
 parser.add_argument('-o', '--outfile', default='out.bed', help='')
 args = parser.parse_args()
 
-def get_peak_summit_df(peak_coverage_file, outfile):
+def frame_summits(df):
+
+    # chr, start, 1-pos and peak_id of each peak's summit from per-base
+    # rows; the rows of a peak are taken in file order
+
+    codes, peak_ids = pd.factorize(df['peak_id'], sort=True)
+    order = np.argsort(codes, kind='stable')
+    lengths = np.bincount(codes, minlength=len(peak_ids))
+
+    pos, _ = segment_summits(df['reads'].values[order], lengths)
+    rows = order[np.cumsum(lengths) - lengths + pos]
+
+    return(pd.DataFrame({'chr': df['chr'].values[rows], 'start': df['start'].values[rows], '1-pos': df['1-pos'].values[rows], 'peak_id': peak_ids}))
 
-    df = pd.read_csv(peak_coverage_file, sep='\t', header=None, names=['chr', 'start', 'end', 'peak_id', '1-pos', 'reads'])
-    idx = df.groupby('peak_id')['reads'].transform(max) == df['reads']
-    summit_pos_groups = df[idx].groupby('peak_id')
+def store_summits(path):
 
-    summit_pos_dict = defaultdict(lambda: defaultdict())
-    for peak_id, group in summit_pos_groups:
+    # the same from a binary coverage store, without expanding it to rows
 
-        if len(group) == 1:
-            summit_row = group.iloc[0] 
-        elif (len(group) % 2) == 0:
-            summit_row = group.iloc[int(len(group)/2) - 1]
-        else: 
-            summit_row = group.iloc[int(len(group)/2)]
+    values, regions = open_coverage(path)
+
+    if regions['name'].duplicated().any():
+        return(frame_summits(read_base_coverage(path, names=['chr', 'start', 'end', 'peak_id', '1-pos', 'reads'])))
+
+    rows, pos, _ = region_summits(values, regions)
+    df = pd.DataFrame({'chr': regions['chr'].values[rows], 'start': regions['start'].values[rows], '1-pos': pos, 'peak_id': regions['name'].values[rows]})
+
+    return(df.sort_values('peak_id', kind='stable'))
+
+def get_peak_summit_df(peak_coverage_file, outfile):
 
-        # 0-start 1-end bed
-        summit_pos_dict[peak_id] = {'summit_pos': (summit_row['start'] - 1) + summit_row['1-pos'], 
-                                    'chr' : summit_row['chr']} 
+    # summit of each peak: the base with the most reads, the middle one of
+    # tied maxima; peaks in sorted peak_id order
 
-        summit_pos_dict[peak_id]['start'] = summit_pos_dict[peak_id]['summit_pos'] - args.window_size 
-        summit_pos_dict[peak_id]['end'] = summit_pos_dict[peak_id]['summit_pos'] + args.window_size 
+    if is_coverage_store(peak_coverage_file):
+        df = store_summits(peak_coverage_file)
+    else:
+        df = frame_summits(read_base_coverage(peak_coverage_file, names=['chr', 'start', 'end', 'peak_id', '1-pos', 'reads']))
 
-    peak_summit_df = pd.DataFrame.from_dict(summit_pos_dict, orient='index')
-    peak_summit_df.index.name = 'peak_id'
-    peak_summit_df.reset_index(inplace=True)
-    peak_summit_df = peak_summit_df[['chr', 'start', 'end', 'peak_id']]
+    # 0-start 1-end bed
+    summit_pos = (df['start'].values - 1) + df['1-pos'].values
 
+    peak_summit_df = pd.DataFrame({'chr': df['chr'].values, 'start': summit_pos - args.window_size, 'end': summit_pos + args.window_size, 'peak_id': df['peak_id'].values})
     peak_summit_df.to_csv(outfile, sep='\t', index=False, header=False)
  
 def main():
@@ -1,7 +1,11 @@
 import argparse
-from read_coverage import run_coverage
+import pandas as pd
+import numpy as np
+from read_coverage import run_coverage, read_regions, index_regions, region_depth, region_values
+from coveragestore import segment_summits
 from common import bsub
 import concurrent.futures
+import bam as bamfile
 import subprocess
 import tempfile
 import shutil
@@ -14,6 +18,9 @@ parser.add_argument('peak_bed', type=str, help='BED file with peaks of interest.
 parser.add_argument('atac_bam_dir', type=str, help='Directory with atac bams.')
 parser.add_argument('-p', '--peak_ids', type=str, help='List of peak IDs to subset BED.')
 parser.add_argument('-o', '--output_dir', default='.', help='')
+parser.add_argument('-w', '--window_size', type=int, default=1000, help='Length which to extend peak summit.')
+parser.add_argument('--native', action='store_true', help='Compute coverage and summits in-process, one streaming pass per BAM, instead of two bsub jobs per sample.')
+parser.add_argument('--processes', type=int, default=4, help='Samples processed at once with --native.')
 parser.add_argument('-d', '--debug', action='store_true', help='')
 args = parser.parse_args()
 
@@ -49,6 +56,80 @@ def peak_summit_routine(bam, refset, sample_id, tmpdir):
 
     print('Finished peak summit BED for "{}"'.format(sample_id))
 
+def peak_summits(bam, regions, index):
+
+    # 1-based summit position within each peak (0 where the peak is empty):
+    # the base with the most reads, the middle one of tied maxima, as in
+    # peakheatmap_summit_bed.py; peaks sharing an id are searched together,
+    # in file order
+
+    names = bamfile.reference_names(bam)
+    ref_ids = {name: i for i, name in enumerate(names)}
+
+    depth = dict()
+    for shard_refs, voffset, stop in bamfile.shards(bam, index):
+        depth.update(region_depth(bam, {i: index[names[i]] for i in shard_refs}, voffset, stop))
+
+    lengths = (regions['end'] - regions['start']).values
+    dup = regions['peak_id'].duplicated(keep=False).values
+
+    pos = np.zeros(len(regions), dtype=np.int64)
+    shared = dict()
+
+    for chrom, entry in index.items():
+
+        d = depth.get(ref_ids.get(chrom))
+        if d is None:
+            d = np.zeros(entry[2][-1] + entry[1][-1] - entry[0][-1], dtype=np.int64)
+
+        v = region_values(d, entry)
+        length, rows = entry[4], entry[6]
+        first = np.cumsum(length) - length
+
+        ok = length > 0
+        pos[rows[ok]] = segment_summits(v, length[ok])[0] + 1
+
+        for r, a, n in zip(rows[dup[rows]], first[dup[rows]], length[dup[rows]]):
+            shared[r] = v[a:a+n]
+
+    if shared:
+
+        rows = np.array(sorted(shared))
+        codes = pd.factorize(regions['peak_id'].values[rows])[0]
+        rows = rows[np.argsort(codes, kind='stable')]
+        codes = np.sort(codes, kind='stable')
+
+        n = lengths[rows]
+        group_n = np.bincount(codes, weights=n).astype(np.int64)
+        keep = group_n > 0
+
+        offset = np.cumsum(n) - n
+        group_start = np.cumsum(group_n) - group_n
+
+        target = group_start[keep] + segment_summits(np.concatenate([shared[r] for r in rows]), group_n[keep])[0]
+        k = np.searchsorted(offset, target, side='right') - 1
+
+        pos[rows] = 0
+        pos[rows[k]] = target - offset[k] + 1
+
+    return(pos)
+
+def native_summit_routine(bam, regions, index, sample_id):
+
+    # depth over the peaks, summits and the summit-window BED in one pass
+
+    pos = peak_summits(bam, regions, index)
+
+    df = regions[pos > 0].assign(pos=pos[pos > 0]).sort_values('peak_id', kind='stable')
+
+    # 0-start 1-end bed
+    summit_pos = (df['start'].values - 1) + df['pos'].values
+
+    peak_summit_outfile = os.path.join(args.output_dir, sample_id+".summitCoverage.bed")
+    pd.DataFrame({'chr': df['chr'].values, 'start': summit_pos - args.window_size, 'end': summit_pos + args.window_size, 'peak_id': df['peak_id'].values}).to_csv(peak_summit_outfile, sep='\t', index=False, header=False)
+
+    return('Finished peak summit BED for "{}"'.format(sample_id))
+
 def main():
 
     if not os.path.exists(args.output_dir):
@@ -61,6 +142,19 @@ def main():
 
     read_dict = {sid(bf): os.path.join(os.path.abspath(args.atac_bam_dir), bf) for bf in bams}
 
+    if args.native:
+
+        regions = read_regions(args.peak_bed).rename(columns={'name': 'peak_id'})
+        index = index_regions(regions)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as launch:
+            processes = [launch.submit(native_summit_routine, bam, regions, index, sample_id) for sample_id, bam in read_dict.items()]
+            for po in concurrent.futures.as_completed(processes):
+                print(po.result())
+
+        print('Done.')
+        return
+
     tmpdir = tempfile.mkdtemp(dir=args.output_dir)
 
     # parallelization
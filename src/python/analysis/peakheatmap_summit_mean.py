@@ -2,18 +2,57 @@ import argparse
 import subprocess
 import pandas as pd
 import numpy as np
-from collections import OrderedDict
-from common import bsub
+from common import bsub, sample_groups, group_aggregate
+from coveragestore import read_coverage_values, aligned_values, region_positions, iter_base_coverage
+from itertools import zip_longest
 import json
 import time
-import re
 import os
 
 parser = argparse.ArgumentParser(prog='')
 parser.add_argument('summit_coverage_files', type=str, help='List of summit coverage files')
 parser.add_argument('-o', '--output_dir', default='.', help='')
+parser.add_argument('--stream', action='store_true', help='Stream the coverage files in lock-step and write the group means block by block (float32, constant memory).')
+parser.add_argument('--chunk_size', type=int, default=1000000, help='Rows per block in --stream mode.')
 args = parser.parse_args()
 
+def stream_summit_means(sample_data, pat):
+
+    # all files must list the same (peak_id, pos) rows in the same order;
+    # each block of rows is read from every file, checked against the first
+    # and averaged per group, and the group files are appended to
+
+    groups = sample_groups([s[0] for s in sample_data], pat)
+    readers = [iter_base_coverage(p, names=['chr', 'start', 'end', 'peak_id', 'pos', i], chunk_size=args.chunk_size) for i,p in sample_data]
+
+    outfiles = {grp: open(os.path.join(args.output_dir, grp+'_peakSummitCoverage.txt'), 'w') for grp in groups.keys()}
+
+    try:
+        for chunks in zip_longest(*readers):
+
+            if any(c is None for c in chunks) or any(len(c) != len(chunks[0]) for c in chunks):
+                raise ValueError('summit coverage files do not have the same number of rows')
+
+            keys = chunks[0][['peak_id', 'pos']].reset_index(drop=True)
+            for (i,p), c in zip(sample_data[1:], chunks[1:]):
+                if not (np.array_equal(c['pos'].values, keys['pos'].values) and np.array_equal(c['peak_id'].values, keys['peak_id'].values)):
+                    raise ValueError('{}: rows do not match those of {}'.format(p, sample_data[0][1]))
+
+            counts = np.empty((len(keys), len(sample_data)), dtype=np.float32)
+            for j, ((i,p), c) in enumerate(zip(sample_data, chunks)):
+                counts[:,j] = c[i].values
+
+            # log2 read density
+            mu_summit_df = group_aggregate(pd.DataFrame(counts, columns=[s[0] for s in sample_data]), groups, log2=True)
+
+            for grp, f in outfiles.items():
+                keys.assign(**{grp: mu_summit_df[grp].values}).to_csv(f, index=False, header=False, sep='\t')
+    finally:
+        for f in outfiles.values():
+            f.close()
+
+    return(groups)
+
 def main():
 
     if not os.path.exists(args.output_dir):
@@ -30,35 +69,36 @@ def main():
     sample_files.sort(key=lambda x: sid(x)) 
     sample_data = [(sid(x), x) for x in sample_files] 
 
-    df = pd.read_csv(sample_data[0][1], sep='\t', header=None, names=['chr', 'start', 'end', 'peak_id', 'pos', sample_data[0][0]], index_col=['peak_id', 'pos'])
+    if args.stream:
+        stream_summit_means(sample_data, pat)
+        print('wrote to: {}'.format(args.output_dir))
+        return
 
-    group_summit_df = pd.DataFrame(0, index=df.index, columns = [s[0] for s in sample_data])
-    group_summit_df[sample_data[0][0]] = df[sample_data[0][0]]
+    # samples are read as value arrays over the first sample's regions (the
+    # same regions in the usual case, so no per-base index is built)
+    values, regions = read_coverage_values(sample_data[0][1])
 
-    for i,p in sample_data[1:]:
+    counts = np.empty((len(values), len(sample_data)), dtype=np.float64)
+    counts[:,0] = values
 
-        df = pd.read_csv(p, sep='\t', header=None, names=['chr', 'start', 'end', 'peak_id', 'pos', i], usecols=['peak_id', 'pos', i], index_col=['peak_id', 'pos'])
-        group_summit_df[i] = df[i] 
+    for k, (i,p) in enumerate(sample_data[1:], 1):
+        counts[:,k] = aligned_values(*read_coverage_values(p), regions, keys=['name'])
 
-    group_summit_df.dropna(axis=1, inplace=True)
-    group_summit_df.astype(np.int32)
+    # samples missing any of the first sample's bases are left out
+    keep = ~np.isnan(counts).any(axis=0)
+    sample_ids = [s[0] for s, k in zip(sample_data, keep) if k]
 
-    groups = OrderedDict()
-    for i,sample_id in enumerate(list(group_summit_df.columns)):
-        groups.setdefault(re.search(pat, sample_id).group(0), []).append(i)
+    groups = sample_groups(sample_ids, pat)
 
-    mu_summit_df = pd.DataFrame(0, index=group_summit_df.index, columns=groups.keys())
-    for grp, idc in groups.items():
-        group_cols = group_summit_df.columns[idc]
-        mu_summit_df[grp] = group_summit_df[group_cols].apply(np.mean, axis=1)
-        
     # log2 read density
-    mu_summit_df = mu_summit_df.applymap(lambda x: np.log2(x+1))
-    mu_summit_df.reset_index(inplace=True)
+    mu_summit_df = group_aggregate(pd.DataFrame(counts[:,keep], columns=sample_ids), groups, log2=True)
+
+    rep, pos = region_positions(regions)
+    peak_ids = regions['name'].values[rep]
 
     for grp in groups.keys():
         outfile = os.path.join(args.output_dir, grp+'_peakSummitCoverage.txt')
-        mu_summit_df[['peak_id', 'pos', grp]].to_csv(outfile, index=False, header=False, sep='\t')
+        pd.DataFrame({'peak_id': peak_ids, 'pos': pos + 1, grp: mu_summit_df[grp].values}).to_csv(outfile, index=False, header=False, sep='\t')
 
     print('wrote to: {}'.format(args.output_dir))
 
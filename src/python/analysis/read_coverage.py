@@ -1,7 +1,12 @@
 import argparse
 import subprocess
+import pandas as pd
+import numpy as np
 from datetime import datetime
-from common import bsub
+from common import bsub, concat_ranges
+from coveragestore import text_to_coverage, coverage_to_text, create_coverage, open_coverage
+import concurrent.futures
+import bam as bamfile
 import time
 import tempfile
 import shutil
@@ -31,12 +36,150 @@ def run_coverage(bam, ref_set, outfile, tmpdir, sort=False, mem=25, gtmp=4, dock
 
     return(po)
 
+# native coverage (--native): per-base depth over the reference regions,
+# as `bedtools coverage -d` counts it (every mapped alignment over its full
+# reference span, deletions and skipped regions included), streamed from
+# the BAM in one pass. The depth is accumulated as +1/-1 steps on the
+# concatenated bases of the (merged) regions of each chromosome, so the
+# record order does not matter: coordinate-sorted BAMs are split into one
+# task per chromosome through the .bai index, and unsorted or unindexed
+# BAMs are read whole, in one pass, without sorting or a temporary BAM.
+# Memory is bounded by the region bases and one record batch.
+
+def read_regions(ref_set):
+
+    # chr, start, end, name of the BED regions, in file order (regions
+    # without a name are named chr:start-end)
+
+    df = pd.read_csv(ref_set, sep='\t', header=None, comment='#', dtype={0: str})
+    if df.shape[1] < 4:
+        df[3] = df[0] + ':' + df[1].astype(str) + '-' + df[2].astype(str)
+
+    df = df[[0, 1, 2, 3]]
+    df.columns = ['chr', 'start', 'end', 'name']
+
+    return(df)
+
+def index_regions(regions):
+
+    # per chromosome: the regions merged into disjoint segments (start, end,
+    # offset of the segment in the concatenated region bases), and each
+    # region's start, length, offset in the coverage store and row
+
+    lengths = (regions['end'] - regions['start']).values
+    store_offset = np.cumsum(lengths) - lengths
+
+    index = dict()
+    for chrom, idx in regions.groupby('chr', sort=False).indices.items():
+
+        start = regions['start'].values[idx].astype(np.int64)
+        end = regions['end'].values[idx].astype(np.int64)
+
+        order = np.argsort(start, kind='stable')
+        s, e = start[order], end[order]
+        reach = np.maximum.accumulate(e)
+
+        first = np.r_[True, s[1:] > reach[:-1]]
+        seg_start = s[first]
+        seg_end = np.maximum.reduceat(e, np.flatnonzero(first))
+        seg_offset = np.cumsum(seg_end - seg_start) - (seg_end - seg_start)
+
+        index[chrom] = (seg_start, seg_end, seg_offset, start, lengths[idx], store_offset[idx], idx)
+
+    return(index)
+
+def _concatenated(x, seg_start, seg_end, seg_offset):
+
+    # index of the first region base at or after position x in the
+    # concatenated bases of the segments
+
+    total = seg_offset[-1] + seg_end[-1] - seg_start[-1]
+
+    k = np.searchsorted(seg_end, x, side='right')
+    kc = np.minimum(k, len(seg_end) - 1)
+
+    within = np.maximum(x - seg_start[kc], 0)
+    return(np.where(k < len(seg_end), seg_offset[kc] + within, total))
+
+def region_depth(bam, refs, voffset, stop):
+
+    # per-base depth over the concatenated region bases of the reference
+    # sequences refs ({ref_id: index_regions entry}) of one BAM, from one
+    # work unit of bam.shards()
+
+    steps = {i: np.zeros(r[2][-1] + r[1][-1] - r[0][-1] + 1, dtype=np.int64) for i, r in refs.items()}
+
+    for batch in bamfile.iter_shard(bam, list(refs), voffset, stop):
+
+        keep = (batch.flag & bamfile.FUNMAP == 0) & (batch.n_cigar > 0) & np.isin(batch.ref_id, list(refs))
+        idx = np.flatnonzero(keep)
+        if not len(idx):
+            continue
+
+        end = batch.reference_end(idx)
+
+        for ref_id in np.unique(batch.ref_id[idx]):
+            sel = batch.ref_id[idx] == ref_id
+            seg_start, seg_end, seg_offset = refs[ref_id][:3]
+            n = len(steps[ref_id])
+            steps[ref_id] += np.bincount(_concatenated(batch.pos[idx[sel]].astype(np.int64), seg_start, seg_end, seg_offset), minlength=n)
+            steps[ref_id] -= np.bincount(_concatenated(end[sel], seg_start, seg_end, seg_offset), minlength=n)
+
+    return({i: np.cumsum(x[:-1]) for i, x in steps.items()})
+
+def region_values(depth, entry):
+
+    # the depth of each region of one chromosome, back to back in the
+    # chromosome's region order
+
+    seg_start, seg_end, seg_offset, start, length = entry[:5]
+    return(depth[concat_ranges(_concatenated(start, seg_start, seg_end, seg_offset), length)])
+
+def coverage_shard(bam, refs, voffset, stop, store):
+
+    # per-base depth over the regions of one work unit, written into the
+    # sample's coverage store
+
+    depth = region_depth(bam, refs, voffset, stop)
+    values = open_coverage(store, mode='r+')[0]
+
+    for ref_id, entry in refs.items():
+        values[concat_ranges(entry[5], entry[4])] = region_values(depth[ref_id], entry)
+
+    values.flush()
+
+def native_coverage(bams, ref_set, processes):
+
+    # coverage stores for (bam, store path) pairs over the BED regions,
+    # one task per BAM and chromosome
+
+    regions = read_regions(ref_set)
+    index = index_regions(regions)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+
+        futures = list()
+        for bam, store in bams:
+            create_coverage(store, regions)
+            names = bamfile.reference_names(bam)
+            for ref_ids, voffset, stop in bamfile.shards(bam, index):
+                futures.append(executor.submit(coverage_shard, bam, {i: index[names[i]] for i in ref_ids}, voffset, stop, store))
+
+        for k, future in enumerate(concurrent.futures.as_completed(futures)):
+            print('\rProcessing {}/{}'.format(k+1, len(futures)), end='', flush=True)
+            future.result()
+
+    print('')
+
 def parse_args():
 
     parser = argparse.ArgumentParser(prog='Make genome-wide accessibility coverage files.')
     parser.add_argument('json', type=str, help='Path to input json listing .bam and .narrowPeak input files.')
     parser.add_argument('ref_set', type=str, help='BED file with peak set to find coverage against.')
     parser.add_argument('-o', '--output_dir', default='.', help='')
+    parser.add_argument('--binary', action='store_true', help='Store coverage as memory-mappable binary stores (.bcov) instead of bedtools -d text.')
+    parser.add_argument('--native', action='store_true', help='Compute coverage in-process from the BAMs instead of submitting bedtools jobs.')
+    parser.add_argument('-p', '--processes', type=int, default=4, help='Worker processes for --native (one task per BAM and chromosome).')
     parser.add_argument('--debug', action='store_true', help='')
 
     return(parser.parse_args())
@@ -53,6 +196,32 @@ def main():
 
     tmpdir = tempfile.mkdtemp(dir=args.output_dir)
 
+    if args.native:
+
+        # the intermediate stores are removed whether or not this completes
+        try:
+            bams = list()
+            for group, paths in peak_data.items():
+                for bam in paths.get('bams'):
+                    outfile = os.path.join(args.output_dir, os.path.split(bam)[1].split('_')[0] + '_coverage.bed')
+                    bams.append((bam, outfile[:-len('.bed')] + '.bcov' if args.binary else os.path.join(tmpdir, os.path.split(outfile)[1] + '.bcov'), outfile))
+
+            print("[ {} ] Computing base-pair coverage over BED reference.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+            native_coverage([(bam, store) for bam, store, _ in bams], args.ref_set, args.processes)
+
+            if not args.binary:
+                for bam, store, outfile in bams:
+                    coverage_to_text(store, outfile)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+        print("[ {} ] Done.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        print("wrote to: {}".format(args.output_dir))
+
+        return
+
+    outfiles = list()
     processes = list()
     for group, paths in peak_data.items():
 
@@ -63,6 +232,7 @@ def main():
             outfile = os.path.split(bam)[1].split('_')[0] + '_coverage.bed'
             outfile = os.path.join(args.output_dir, outfile)
             processes.append(run_coverage(bam, args.ref_set, outfile, tmpdir))
+            outfiles.append(outfile)
 
     print("[ {} ] Running base-pair coverage over BED reference.".format(datetime.now().strftime("%b %d %H:%M:%S")))
 
@@ -72,6 +242,14 @@ def main():
         while po.poll() is None:
             time.sleep(0.5)
 
+    if args.binary:
+
+        print("[ {} ] Converting coverage to binary stores.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+
+        for outfile in outfiles:
+            text_to_coverage(outfile, outfile[:-len('.bed')] + '.bcov')
+            os.remove(outfile)
+
     print("[ {} ] Done.".format(datetime.now().strftime("%b %d %H:%M:%S")))
     print("wrote to: {}".format(args.output_dir))
 
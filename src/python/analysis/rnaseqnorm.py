@@ -3,9 +3,12 @@
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+import scipy.sparse as sparse
+import concurrent.futures
+import collections
 import warnings
 
-def normalize_quantiles(df):
+def normalize_quantiles(df, quantiles=None):
     """
     Quantile normalization to the average empirical distribution
     Note: replicates behavior of R function normalize.quantiles from library("preprocessCore")
@@ -14,55 +17,176 @@ def normalize_quantiles(df):
      [1] Bolstad et al., Bioinformatics 19(2), pp. 185-193, 2003
 
     Adapted from https://github.com/andrewdyates/quantile_normalize
+
+    If a reference quantile vector is given (see quantile_reference), the
+    columns of df are normalized against it instead of their own average
+    distribution, so new samples can be added without renormalizing a cohort.
     """
-    M = df.values.copy()
+    M = np.asarray(df.values, dtype=np.float64)
+    quantiles = _check_quantiles(M, quantiles)
+    N = _apply_quantiles(M, quantiles, np.empty(M.shape))
+    return pd.DataFrame(N, index=df.index, columns=df.columns)
 
-    Q = M.argsort(axis=0)
-    m,n = M.shape
 
-    # compute quantile vector
+def normalize_quantiles_memmap(M, out, quantiles=None):
+    """
+    Out-of-core variant of normalize_quantiles for matrices that do not fit in memory
+
+    M and out are (memory-mapped) arrays of identical shape, e.g. from
+    np.lib.format.open_memmap; both are processed one column at a time, so
+    column-major (Fortran-ordered) files avoid strided reads and writes.
+    Peak memory is a few vectors of length M.shape[0].
+    """
+    quantiles = _check_quantiles(M, quantiles)
+    _apply_quantiles(M, quantiles, out)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def quantile_reference(M):
+    """
+    Reference distribution for quantile normalization: the mean of the sorted
+    columns of M, accumulated one column at a time
+    """
+    m,n = M.shape
     quantiles = np.zeros(m)
     for i in range(n):
-        quantiles += M[Q[:,i],i]
-    quantiles = quantiles / n
+        quantiles += np.sort(np.asarray(M[:,i], dtype=np.float64))
+    return quantiles / n
+
+
+def _check_quantiles(M, quantiles):
+    if quantiles is None:
+        return quantile_reference(M)
+    if quantiles.shape[0] != M.shape[0]:
+        raise ValueError('Reference quantile vector has {} values; matrix has {} rows.'.format(quantiles.shape[0], M.shape[0]))
+    return quantiles
+
+
+def _apply_quantiles(M, quantiles, out):
+    """
+    Replace each column of M with the quantile vector, in rank order
+    """
+    for i in range(M.shape[1]):
+        x = np.asarray(M[:,i], dtype=np.float64)
+        q = x.argsort()
+        col = np.empty(x.shape[0])
+        col[q] = _quantile_ranks(x[q], quantiles)
+        out[:,i] = col
+    return out
+
+
+def _quantile_ranks(s, quantiles):
+    """
+    Map sorted column values onto the quantile vector, assigning each run of
+    tied values the median of the quantiles it spans (i.e., the quantile at
+    the average rank, as in preprocessCore)
+    """
+    first, last = _tie_runs(s)
+    # median of the spanned quantiles; exact for singletons and odd-sized runs
+    return 0.5 * (quantiles[(first+last)//2] + quantiles[(first+last+1)//2])
+
+
+def _tie_runs(s, groups=None):
+    """
+    First and last position of the run of equal values containing each
+    element of s, which is sorted along axis 0 (within groups, if given)
+    """
+    m = s.shape[0]
+    idx = np.arange(m).reshape((m,) + (1,)*(s.ndim-1))
+    if m == 0:
+        return idx, idx
+
+    brk = np.empty(s.shape, dtype=bool)
+    brk[0] = True
+    np.not_equal(s[1:], s[:-1], out=brk[1:])
+    if groups is not None:
+        brk[1:] |= groups[1:] != groups[:-1]
+    first = np.maximum.accumulate(np.where(brk, idx, 0), axis=0)
+    brk[:-1] = brk[1:]
+    brk[-1] = True
+    last = np.minimum.accumulate(np.where(brk, idx, m-1)[::-1], axis=0)[::-1]
+    return first, last
 
-    for i in range(n):
-        # Get equivalence classes; unique values == 0
-        dupes = np.zeros(m, dtype=np.int)
-        for j in range(m-1):
-            if M[Q[j,i],i]==M[Q[j+1,i],i]:
-                dupes[j+1] = dupes[j]+1
 
-        # Replace column with quantile ranks
-        M[Q[:,i],i] = quantiles
+def _rank_segments(x, seg, start):
+    """
+    Ranks of x within contiguous segments (seg: non-decreasing segment
+    index of each element, start: offset of each segment), ties averaged
+    as in stats.rankdata
+    """
+    # segments are contiguous, so sorting each in place keeps seg aligned
+    Q = np.empty(x.shape[0], dtype=np.intp)
+    for i in range(len(start)-1):
+        Q[start[i]:start[i+1]] = x[start[i]:start[i+1]].argsort() + start[i]
+    first, last = _tie_runs(x[Q], groups=seg)
+    R = np.empty(x.shape[0])
+    R[Q] = (first+last)/2 + 1 - start[seg]
+    return R
 
-        # Average together equivalence classes
-        j = m-1
-        while j >= 0:
-            if dupes[j] == 0:
-                j -= 1
-            else:
-                idxs = Q[j-dupes[j]:j+1,i]
-                M[idxs,i] = np.median(M[idxs,i])
-                j -= 1 + dupes[j]
-        assert j == -1
 
-    return pd.DataFrame(M, index=df.index, columns=df.columns)
+def _rank_rows(X):
+    """
+    Row-wise ranks of X, ties averaged
+    """
+    Q = X.argsort(axis=1)
+    first, last = _tie_runs(np.take_along_axis(X, Q, axis=1).T)
+    R = np.empty(X.shape)
+    np.put_along_axis(R, Q, ((first+last)/2 + 1).T, axis=1)
+    return R
 
 
-def inverse_normal_transform(M):
+def inverse_normal_transform(M, dtype=np.float64, out=None, block_size=10000, n_jobs=1, use_processes=False):
     """
     Transform rows to a standard normal distribution
+
+    Rows are ranked (ties averaged) and transformed in blocks of block_size
+    rows, on a pool of n_jobs threads (or processes, if use_processes), and
+    written into out, e.g. a preallocated or memory-mapped array, in the
+    requested dtype. Sparse (scipy.sparse) inputs are densified one block at
+    a time; the transformed matrix is dense.
     """
-    R = stats.mstats.rankdata(M, axis=1)  # ties are averaged
-    if isinstance(M, pd.DataFrame):
-        Q = pd.DataFrame(stats.norm.ppf(R/(M.shape[1]+1)), index=M.index, columns=M.columns)
+    X = M.values if isinstance(M, pd.DataFrame) else M
+    if sparse.issparse(X):
+        X = X.tocsr()
+    if out is None:
+        out = np.empty(X.shape, dtype=dtype)
+
+    blocks = range(0, X.shape[0], block_size)
+    if n_jobs > 1:
+        if use_processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs)
+        with executor:
+            # bounded number of blocks in flight
+            pending = collections.deque()
+            for r in blocks:
+                pending.append((r, executor.submit(_inverse_normal_rows, X[r:r+block_size])))
+                if len(pending) >= 2*n_jobs:
+                    r, f = pending.popleft()
+                    out[r:r+block_size] = f.result()
+            while pending:
+                r, f = pending.popleft()
+                out[r:r+block_size] = f.result()
     else:
-        Q = stats.norm.ppf(R/(M.shape[1]+1))
-    return Q
+        for r in blocks:
+            out[r:r+block_size] = _inverse_normal_rows(X[r:r+block_size])
+
+    if isinstance(M, pd.DataFrame):
+        return pd.DataFrame(out, index=M.index, columns=M.columns, copy=False)
+    return out
 
 
-def edgeR_calcNormFactors(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05, acutoff=-1e10, verbose=False):
+def _inverse_normal_rows(X):
+    if sparse.issparse(X):
+        X = X.toarray()
+    R = _rank_rows(np.asarray(X))
+    return stats.norm.ppf(R/(X.shape[1]+1))
+
+
+def edgeR_calcNormFactors(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05, acutoff=-1e10, verbose=False, n_jobs=1, reference=None, dtype=None):
     """
     Calculate TMM (Trimmed Mean of M values) normalization.
     Reproduces edgeR::calcNormFactors.default
@@ -71,6 +195,18 @@ def edgeR_calcNormFactors(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05,
 
     Effective library size: TMM scaling factor * library size
 
+    All samples are trimmed and weighted in a single vectorized pass; for very
+    wide matrices, n_jobs > 1 distributes blocks of samples over a process pool.
+
+    If a frozen reference is given (see edgeR_tmm_reference), factors are
+    computed against the saved reference library and rescaled by the saved
+    cohort scale, so new samples can be added without renormalizing a cohort.
+
+    counts_df may be a DataFrame, an array or a scipy.sparse matrix; sparse
+    counts are processed over their nonzero entries only (the only entries
+    with finite log-ratios). dtype=np.float32 computes the per-gene
+    log-ratios and weights in single precision.
+
     References:
      [1] Robinson & Oshlack, 2010
      [2] R functions:
@@ -78,9 +214,70 @@ def edgeR_calcNormFactors(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05,
           edgeR:::.calcFactorWeighted
           edgeR:::.calcFactorQuantile
     """
+    if reference is not None:
+        Y = _counts(counts_df)
+        if reference['profile'].shape[0] != Y.shape[0]:
+            raise ValueError('Reference library has {} genes; matrix has {}.'.format(reference['profile'].shape[0], Y.shape[0]))
+        tmm = _tmm_factors(Y, reference['profile'], logratio_trim, sum_trim, acutoff, n_jobs, dtype)
+        return tmm / reference['scale']
+
+    Y, ref = _tmm_reference_sample(counts_df, ref, verbose)
+    tmm = _tmm_factors(Y, _column(Y, ref), logratio_trim, sum_trim, acutoff, n_jobs, dtype)
+
+    tmm = tmm / np.exp(np.mean(np.log(tmm)))
+    return tmm
+
+
+def edgeR_tmm_reference(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05, acutoff=-1e10, verbose=False, n_jobs=1, dtype=None):
+    """
+    Frozen TMM reference for edgeR_calcNormFactors(..., reference=...)
+
+    Returns a dict with the reference library profile (counts of the reference
+    sample for every gene in counts_df) and the cohort scale (geometric mean
+    of the unscaled factors), e.g. for storage with np.savez.
+    """
+    Y, ref = _tmm_reference_sample(counts_df, ref, verbose)
+    tmm = _tmm_factors(Y, _column(Y, ref), logratio_trim, sum_trim, acutoff, n_jobs, dtype)
+    return {'profile': _column(_counts(counts_df), ref), 'scale': np.exp(np.mean(np.log(tmm)))}
+
+
+def _counts(counts_df):
+    """
+    Count matrix as an array, or as a CSC matrix if sparse
+    """
+    if sparse.issparse(counts_df):
+        return sparse.csc_matrix(counts_df)
+    if isinstance(counts_df, pd.DataFrame):
+        return np.asarray(counts_df.values)
+    return np.asarray(counts_df)
+
+
+def _column(Y, i):
+    if sparse.issparse(Y):
+        return Y[:,i].toarray().ravel()
+    return Y[:,i]
+
+
+def _tmm_reference_sample(counts_df, ref, verbose):
+    """
+    Counts without all-zero genes, and the reference sample index (upper
+    quartile closest to the mean upper quartile, unless given)
+    """
+    Y = _counts(counts_df)
+
+    if sparse.issparse(Y):
+        # all-zero genes never have finite log-ratios and are kept; they are
+        # only dropped (one densified sample at a time) for the upper quartiles
+        if ref is None:
+            expressed = np.flatnonzero(np.asarray((Y>0).sum(axis=1)).ravel())
+            N = np.asarray(Y.sum(axis=0)).ravel()
+            f75 = np.array([np.percentile(_column(Y, i)[expressed]/N[i], 75) for i in range(Y.shape[1])])
+            ref = np.argmin(np.abs(f75-np.mean(f75)))
+            if verbose:
+                print('Reference sample index: '+str(ref))
+        return Y, ref
 
     # discard genes with all-zero counts
-    Y = counts_df.values.copy()
     allzero = np.sum(Y>0,axis=1)==0
     if np.any(allzero):
         Y = Y[~allzero,:]
@@ -92,46 +289,125 @@ def edgeR_calcNormFactors(counts_df, ref=None, logratio_trim=0.3, sum_trim=0.05,
         if verbose:
             print('Reference sample index: '+str(ref))
 
+    return Y, ref
+
+
+def _tmm_factors(Y, y_ref, logratio_trim, sum_trim, acutoff, n_jobs, dtype=None):
+    if dtype is not None:
+        Y = Y.astype(dtype)
+        y_ref = y_ref.astype(dtype)
+    calc = _calc_factor_weighted_sparse if sparse.issparse(Y) else _calc_factor_weighted
+
+    ns = Y.shape[1]
+    if n_jobs > 1 and ns > 1:
+        blocks = np.array_split(np.arange(ns), min(n_jobs, ns))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+            futures = [executor.submit(calc, Y[:,b], y_ref, logratio_trim, sum_trim, acutoff) for b in blocks]
+            return np.concatenate([f.result() for f in futures])
+    return calc(Y, y_ref, logratio_trim, sum_trim, acutoff)
+
+
+def _calc_factor_weighted(Y, y_ref, logratio_trim=0.3, sum_trim=0.05, acutoff=-1e10):
+    """
+    Unscaled TMM factors of each column of Y relative to the reference library y_ref
+    (edgeR:::.calcFactorWeighted, batched over samples)
+    """
     N = np.sum(Y, axis=0)  # total reads in each library
+    n_ref = np.sum(y_ref)
 
     # with np.errstate(divide='ignore'):
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
-        logR = np.log2((Y/N).T / (Y[:,ref]/N[ref])).T  # log fold change; Mg in [1]
-        absE = 0.5*(np.log2(Y/N).T + np.log2(Y[:,ref]/N[ref])).T  # average log relative expression; Ag in [1]
+        logR = np.log2((Y/N).T / (y_ref/n_ref)).T  # log fold change; Mg in [1]
+        absE = 0.5*(np.log2(Y/N).T + np.log2(y_ref/n_ref)).T  # average log relative expression; Ag in [1]
         v = (N-Y)/N/Y
-        v = (v.T + v[:,ref]).T  # w in [1]
+        v = (v.T + (n_ref-y_ref)/n_ref/y_ref).T  # w in [1]
 
-    ns = Y.shape[1]
+    # finite entries, in column-major order
+    fin = (np.isfinite(logR) & np.isfinite(absE) & (absE > acutoff)).T
+    col = np.nonzero(fin)[0]
+    return _trimmed_factors(col, logR.T[fin], absE.T[fin], v.T[fin], Y.shape[1], logratio_trim, sum_trim)
+
+
+def _calc_factor_weighted_sparse(Y, y_ref, logratio_trim=0.3, sum_trim=0.05, acutoff=-1e10):
+    """
+    _calc_factor_weighted over the nonzero entries of a CSC count matrix
+    """
+    Y = sparse.csc_matrix(Y)
+    Y.sum_duplicates()
+
+    N = np.asarray(Y.sum(axis=0)).ravel()  # total reads in each library
+    n_ref = np.sum(y_ref)
+
+    # per-entry sample index and reference counts, in column-major order
+    col = np.repeat(np.arange(Y.shape[1]), np.diff(Y.indptr))
+    y = Y.data
+    r = y_ref[Y.indices]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        logR = np.log2((y/N[col]) / (r/n_ref))  # log fold change; Mg in [1]
+        absE = 0.5*(np.log2(y/N[col]) + np.log2(r/n_ref))  # average log relative expression; Ag in [1]
+        v = (N[col]-y)/N[col]/y + (n_ref-r)/n_ref/r  # w in [1]
+
+    fin = np.isfinite(logR) & np.isfinite(absE) & (absE > acutoff)
+    return _trimmed_factors(col[fin], logR[fin], absE[fin], v[fin], Y.shape[1], logratio_trim, sum_trim)
+
+
+def _trimmed_factors(col, logR, absE, v, ns, logratio_trim, sum_trim):
+    """
+    Trimmed, weighted mean log-ratio of each sample, from the finite
+    entries of all samples (col: sample index of each entry, non-decreasing)
+    """
+    n = np.bincount(col, minlength=ns)
+    start = np.concatenate([[0], np.cumsum(n)])
+
+    loL = np.floor(n*logratio_trim)+1
+    hiL = n + 1 - loL
+    loS = np.floor(n*sum_trim)+1
+    hiS = n + 1 - loS
+    rankR = _rank_segments(logR, col, start)
+    rankE = _rank_segments(absE, col, start)
+    keep = (rankR >= loL[col]) & (rankR <= hiL[col]) & (rankE >= loS[col]) & (rankE <= hiS[col])
+
+    # weighted sums are reduced per sample over the kept genes only,
+    # preserving the summation order of the rankdata-based reference code
     tmm = np.zeros(ns)
     for i in range(ns):
-        fin = np.isfinite(logR[:,i]) & np.isfinite(absE[:,i]) & (absE[:,i] > acutoff)
-        n = np.sum(fin)
-
-        loL = np.floor(n*logratio_trim)+1
-        hiL = n + 1 - loL
-        loS = np.floor(n*sum_trim)+1
-        hiS = n + 1 - loS
-        rankR = stats.rankdata(logR[fin,i])
-        rankE = stats.rankdata(absE[fin,i])
-        keep = (rankR >= loL) & (rankR <= hiL) & (rankE >= loS) & (rankE <= hiS)
+        k = np.flatnonzero(keep[start[i]:start[i+1]]) + start[i]
         # in [1], w erroneously defined as 1/v ?
-        tmm[i] = 2**(np.nansum(logR[fin,i][keep]/v[fin,i][keep]) / np.nansum(1/v[fin,i][keep]))
-
-    tmm = tmm / np.exp(np.mean(np.log(tmm)))
+        tmm[i] = 2**(np.nansum(logR[k]/v[k]) / np.nansum(1/v[k]))
     return tmm
 
 
-def edgeR_cpm(counts_df, tmm=None, normalized_lib_sizes=True):
+def edgeR_cpm(counts_df, tmm=None, normalized_lib_sizes=True, dtype=None):
     """
     Return edgeR normalized/rescaled CPM (counts per million)
 
     Reproduces edgeR::cpm.DGEList
+
+    scipy.sparse inputs are rescaled in place of their nonzero entries and
+    returned in the same sparse format.
     """
-    lib_size = counts_df.sum(axis=0)
+    if sparse.issparse(counts_df):
+        lib_size = np.asarray(counts_df.sum(axis=0)).ravel()
+    else:
+        lib_size = counts_df.sum(axis=0)
     if normalized_lib_sizes:
         if tmm is None:
-            tmm = edgeR_calcNormFactors(counts_df)
+            tmm = edgeR_calcNormFactors(counts_df, dtype=dtype)
         lib_size = lib_size * tmm
-    return counts_df / lib_size * 1e6
+
+    if sparse.issparse(counts_df):
+        Y = sparse.csc_matrix(counts_df)
+        col = np.repeat(np.arange(Y.shape[1]), np.diff(Y.indptr))
+        cpm = sparse.csc_matrix((Y.data / lib_size[col] * 1e6, Y.indices, Y.indptr), shape=Y.shape)
+        if dtype is not None:
+            cpm = cpm.astype(dtype)
+        return cpm.asformat(counts_df.format)
+
+    cpm = counts_df / lib_size * 1e6
+    if dtype is not None:
+        cpm = cpm.astype(dtype)
+    return cpm
 
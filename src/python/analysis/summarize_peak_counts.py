@@ -3,7 +3,11 @@ import subprocess
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from common import bsub
+from common import bsub, concat_ranges, interval_index, overlapping_pairs
+from matrixstore import save_matrix
+import concurrent.futures
+import bam as bamfile
+import hashlib
 import time
 import tempfile
 import shutil
@@ -21,6 +25,7 @@ def run_feature_counts(bam, saf, tmpdir, mem=25, gtmp=8, docker_image="genomicpa
       + ' -a ' + saf \
       + ' -F SAF' \
       + ' -s 0' \
+      + (' -p' if args.paired else '') \
       + ' -o ' + outfile + ' ' \
       + bam 
 
@@ -29,6 +34,47 @@ def run_feature_counts(bam, saf, tmpdir, mem=25, gtmp=8, docker_image="genomicpa
 
     return((sample_id, outfile), po)
 
+def read_count_column(path):
+
+    # the count column of one featureCounts output with a digest of its peak
+    # id column, parsed from the raw bytes in one pass (below the comment
+    # and header lines: peak id up to the first tab, count after the last)
+
+    with open(path, 'rb') as f:
+        b = np.frombuffer(f.read(), dtype=np.uint8)
+
+    ends = np.flatnonzero(b == ord('\n'))
+    if len(b) and b[-1] != ord('\n'):
+        ends = np.append(ends, len(b))
+
+    starts = np.append(0, ends[:-1] + 1)[2:]
+    ends = ends[2:]
+
+    tabs = np.append(np.flatnonzero(b == ord('\t')), len(b))
+    first = tabs[np.searchsorted(tabs, starts)]
+    last = tabs[np.maximum(np.searchsorted(tabs, ends) - 1, 0)]
+
+    if ((first >= ends) | (last < starts)).any():
+        raise ValueError('{}: lines without tab-delimited columns'.format(path))
+
+    # ids with their delimiting tab, so the digest separates them
+    digest = hashlib.sha1(b[concat_ranges(starts, first - starts + 1)].tobytes()).hexdigest()
+
+    n = ends - last - 1
+    idx = concat_ranges(last + 1, n)
+    digits = b[idx].astype(np.int64) - ord('0')
+
+    if (n == 0).any() or (n > 10).any() or ((digits < 0) | (digits > 9)).any():
+        raise ValueError('{}: count column is not a non-negative integer'.format(path))
+
+    place = 10 ** (np.repeat(ends, n) - idx - 1)
+    counts = np.add.reduceat(digits * place, np.cumsum(n) - n) if len(n) else np.zeros(0, dtype=np.int64)
+
+    if (counts > np.iinfo(np.int32).max).any():
+        raise ValueError('{}: counts out of int32 range'.format(path))
+
+    return(digest, counts.astype(np.int32))
+
 def combine_counts(id_count_files):
 
     sample_ids = np.array([x[0] for x in id_count_files]) 
@@ -38,38 +84,232 @@ def combine_counts(id_count_files):
     sample_ids = sample_ids[i]
     paths = paths[i]
 
-    colnames = ['peak_id', 'chr', 'start', 'end', 'strand', 'length', sample_ids[0]]
-    df = pd.read_csv(paths[0], sep='\t', skiprows=2, header=None, index_col=0, names=colnames)
+    # every sample was counted against the same SAF, so the peaks should be
+    # in the same order in each file: the peak ids are read once, each file's
+    # ids are checked against the first file's by digest, and the count
+    # columns are read in parallel straight into a preallocated matrix
+
+    index = pd.read_csv(paths[0], sep='\t', skiprows=2, header=None, usecols=[0], index_col=0, names=['peak_id']).index
+    digest = None
+    M = np.zeros((len(index), len(paths)), dtype=np.int32)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+
+        chunksize = max(1, len(paths) // (4 * args.processes))
+        for k, (peaks, counts) in enumerate(executor.map(read_count_column, paths, chunksize=chunksize)):
+
+            print('\rProcessing {}/{}'.format(k+1, len(paths)), end='', flush=True)
+
+            if len(counts) != len(index):
+                raise ValueError('{} has {} peaks, expected {} as in {}'.format(paths[k], len(counts), len(index), paths[0]))
 
-    pct_df = pd.DataFrame(0, index=df.index, columns=list(sample_ids), dtype=np.int32)
-    pct_df[sample_ids[0]] = df[sample_ids[0]].astype(np.int32)
+            digest = peaks if digest is None else digest
+            if peaks != digest:
+                raise ValueError('peak ids in {} differ from (or are ordered differently than) those in {}'.format(paths[k], paths[0]))
 
-    for k, (i, p) in enumerate(zip(sample_ids[1:], paths[1:])):
+            M[:,k] = counts
 
-        print('\rProcessing {}/{}'.format(k+2, len(paths)), end='', flush=True)
+    return(write_counts(pd.DataFrame(M, index=index, columns=list(sample_ids), copy=False)))
 
-        df = pd.read_csv(p, sep='\t', skiprows=2, header=None, usecols=[0,6], index_col=0, names=['peak_id', i], dtype={'peak_id':str, i:np.int32})
-        pct_df[i] = df[i]
+def write_counts(pct_df):
 
     # filter peaks features with total counts under threshold 
 
-    idx = (pct_df.sum(axis=1) >= args.count_threshold)
-    print('\nfiltered {} peaks with low fragment counts.'.format(str(sum([not i for i in idx]))))
+    idx = pct_df.values.sum(axis=1, dtype=np.int64) >= args.count_threshold
+    print('\nfiltered {} peaks with low fragment counts.'.format(np.count_nonzero(~idx)))
 
     pct_df = pct_df[idx]
 
     outfile = os.path.join(os.path.abspath(args.output_dir), args.prefix + '.pct')
     pct_df.to_csv(outfile, sep='\t') 
 
+    if args.binary:
+        save_matrix(pct_df, outfile[:-len('.pct')] + '.bmat')
+
     
     return(outfile) 
 
+# native counting (--native): featureCounts' default assignment (-s 0, at
+# least 1 bp overlap of an aligned read base, reads overlapping more than
+# one peak feature and multi-mapping reads (NH > 1) left unassigned;
+# unmapped, secondary and supplementary alignments skipped), and with
+# --paired one count per fragment from the union of both mates' overlaps,
+# as featureCounts -p. Each (BAM, chromosome) pair is a task: the worker
+# seeks to the chromosome through the .bai index (or reads the whole BAM
+# without one) and returns per-peak counts, added into the count matrix as
+# tasks finish.
+
+def index_features(saf):
+
+    # peak ids in order of first appearance, and per chromosome an interval
+    # index of its features with the peak (meta-feature) of each
+
+    with open(saf) as fp:
+        skiprows = 1 if fp.readline().startswith('GeneID\t') else None
+
+    df = pd.read_csv(saf, sep='\t', header=None, skiprows=skiprows, usecols=[0,1,2,3], names=['peak_id', 'chr', 'start', 'end'], dtype={'peak_id':str, 'chr':str})
+    meta, peak_ids = pd.factorize(df['peak_id'], sort=False)
+
+    features = dict()
+    for chrom, idx in df.groupby('chr', sort=False).indices.items():
+        features[chrom] = (interval_index(df['start'].values[idx], df['end'].values[idx]), meta[idx])
+
+    return(pd.Index(peak_ids, name='peak_id', dtype=object), features)
+
+def _assign(group, meta):
+
+    # groups (reads or fragments) overlapping exactly one peak, as peak ids
+
+    if not len(group):
+        return(np.zeros(0, dtype=np.int64))
+
+    m = np.int64(meta.max()) + 1
+    key = np.unique(group.astype(np.int64) * m + meta)
+    group = key // m
+
+    first = np.r_[True, group[1:] != group[:-1]]
+    n = np.diff(np.r_[np.flatnonzero(first), len(key)])
+
+    return((key % m)[first][n == 1])
+
+def count_shard(bam, refs, voffset, stop, paired):
+
+    # counts of the reads (or fragments) of one BAM on the reference
+    # sequences refs ({ref_id: (interval index, peak ids)}), decoded from
+    # voffset on; with stop (coordinate-sorted input) decoding ends at the
+    # first record past the last of refs. Returns the assigned peak ids with
+    # their counts, and the (read name, peak id) hits of paired reads whose
+    # mate lies on another chromosome, for the caller to resolve.
+
+    ref_ids = np.array(sorted(refs), dtype=np.int64)
+    span = np.int64(1) << 32
+
+    assigned = [np.zeros(0, dtype=np.int64)]
+    deferred = [(np.zeros(0, dtype='S1'), np.zeros(0, dtype=np.int64))]
+
+    # hits of paired reads whose mate (same chromosome) may still follow:
+    # read name, peak id, whether read 1, and the mate's (ref, pos) key
+    pool = (np.zeros(0, dtype='S1'), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64))
+
+    for batch in bamfile.iter_shard(bam, ref_ids, voffset, stop):
+
+        keep = np.isin(batch.ref_id, ref_ids) & (batch.flag & (bamfile.FUNMAP | bamfile.FSECONDARY | bamfile.FSUPPLEMENTARY) == 0) & (batch.n_cigar > 0)
+        idx = np.flatnonzero(keep)
+        idx = idx[batch.tag_int(b'NH', idx) <= 1]
+
+        # (record, peak id) pairs over the aligned blocks of each chromosome
+        rec = [np.zeros(0, dtype=np.int64)]
+        meta = [np.zeros(0, dtype=np.int64)]
+        for ref_id in np.unique(batch.ref_id[idx]):
+            sub = idx[batch.ref_id[idx] == ref_id]
+            index, peaks = refs[ref_id]
+            read, start, end = batch.aligned_blocks(sub)
+            q, t = overlapping_pairs(index, start + 1, end)
+            rec.append(sub[read[q]])
+            meta.append(peaks[t])
+
+        rec = np.concatenate(rec)
+        meta = np.concatenate(meta)
+
+        if not paired:
+            assigned.append(_assign(rec, meta))
+
+        else:
+            flag = batch.flag[rec]
+            mate = (flag & 0x1 != 0) & (flag & bamfile.FMUNMAP == 0)
+            other = mate & (batch.next_ref_id[rec] != batch.ref_id[rec])
+            same = mate & ~other
+
+            # single reads and pairs with an unmapped mate count by themselves
+            assigned.append(_assign(rec[~mate], meta[~mate]))
+
+            if other.any():
+                deferred.append((batch.names(rec[other]), meta[other]))
+
+            pool = tuple(np.concatenate([a, b]) for a, b in zip(pool, (
+                batch.names(rec[same]).astype(object), meta[same],
+                flag[same] & bamfile.FREAD1 != 0,
+                batch.next_ref_id[rec[same]] * span + batch.next_pos[rec[same]])))
+
+            # a fragment is complete once both mates were seen, or the mate's
+            # position has been passed (it had no hits of its own)
+            last = batch.ref_id[-1] * span + batch.pos[-1] if stop else -1
+            group = pd.factorize(pool[0], sort=False)[0]
+            n_group = group.max() + 1 if len(group) else 0
+            first = np.bincount(group, weights=pool[2], minlength=n_group) > 0
+            second = np.bincount(group, weights=~pool[2], minlength=n_group) > 0
+            behind = np.bincount(group, weights=pool[3] < last, minlength=n_group) > 0
+            done = ((first & second) | behind)[group]
+
+            assigned.append(_assign(group[done], pool[1][done]))
+            pool = tuple(a[~done] for a in pool)
+
+    if paired and len(pool[0]):
+        assigned.append(_assign(pd.factorize(pool[0], sort=False)[0], pool[1]))
+
+    peaks, counts = np.unique(np.concatenate(assigned), return_counts=True)
+    names = np.concatenate([d[0].astype(object) for d in deferred])
+    metas = np.concatenate([d[1] for d in deferred])
+
+    return(peaks, counts, names, metas)
+
+def shard_bam(bam, features):
+
+    # (refs, voffset, stop) tasks for one BAM: one per chromosome with peaks
+    # through the index, or the whole file without one
+
+    names = bamfile.reference_names(bam)
+    return([({i: features[names[i]] for i in ref_ids}, voffset, stop) for ref_ids, voffset, stop in bamfile.shards(bam, features)])
+
+def count_native(count_files, saf, processes, paired):
+
+    # count matrix (peaks x samples, int32) for (sample id, bam) pairs
+
+    peak_ids, features = index_features(saf)
+    sample_ids = [x[0] for x in count_files]
+
+    M = np.zeros((len(peak_ids), len(count_files)), dtype=np.int32)
+    deferred = [list() for _ in count_files]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+
+        futures = dict()
+        for j, (sample_id, bam) in enumerate(count_files):
+            for refs, voffset, stop in shard_bam(bam, features):
+                futures[executor.submit(count_shard, bam, refs, voffset, stop, paired)] = j
+
+        for k, future in enumerate(concurrent.futures.as_completed(futures)):
+
+            print('\rProcessing {}/{}'.format(k+1, len(futures)), end='', flush=True)
+
+            j = futures[future]
+            peaks, counts, names, metas = future.result()
+            M[peaks, j] += counts.astype(np.int32)
+            deferred[j].append((names, metas))
+
+    print('')
+
+    # fragments with mates on different chromosomes, across shards
+    for j, hits in enumerate(deferred):
+        names = np.concatenate([h[0] for h in hits])
+        metas = np.concatenate([h[1] for h in hits])
+        if len(names):
+            peaks = _assign(pd.factorize(names, sort=False)[0], metas)
+            M[:,j] += np.bincount(peaks, minlength=len(peak_ids)).astype(np.int32)
+
+    order = np.argsort(np.array(sample_ids))
+    return(pd.DataFrame(M[:,order], index=peak_ids, columns=list(np.array(sample_ids)[order])))
+
 parser = argparse.ArgumentParser(prog='Make read count matrix for peak feature set.')
 parser.add_argument('json', type=str, help='Path to input json listing .bam and .narrowPeak input files.')
 parser.add_argument('peak_features', type=str, help='Path to peak features in .saf format for featureCounts.')
 parser.add_argument('prefix', type=str, help='Prefix for outfile.')
 parser.add_argument('-t', '--count_threshold', type=int, default=5, help='Total fragment count threshold for containing a peak feature.')
 parser.add_argument('-o', '--output_dir', default='.', help='Window size for merging intra and inter replicate peaks.')
+parser.add_argument('--binary', action='store_true', help='Also write the count matrix as a memory-mappable binary matrix store (.bmat).')
+parser.add_argument('--native', action='store_true', help='Count reads in-process from the BAMs instead of submitting featureCounts jobs.')
+parser.add_argument('--paired', action='store_true', help='Count fragments (read pairs) instead of reads, as featureCounts -p.')
+parser.add_argument('-p', '--processes', type=int, default=4, help='Worker processes for --native counting (one task per BAM and chromosome) and for reading featureCounts outputs.')
 parser.add_argument('--debug', action='store_true', help='')
 args = parser.parse_args()
 
@@ -81,6 +321,19 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
+    if args.native:
+
+        bams = [(os.path.split(bam)[1].split('_')[0], bam) for paths in peak_data.values() for bam in paths.get('bams')]
+
+        print("[ {} ] Counting reads in peak features.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        pct_df = count_native(bams, args.peak_features, args.processes, args.paired)
+
+        outfile = write_counts(pct_df)
+
+        print("[ {} ] Done.".format(datetime.now().strftime("%b %d %H:%M:%S")))
+        print("wrote to: {}".format(outfile))
+        return
+
     tmpdir = tempfile.mkdtemp(dir=args.output_dir)
 
     count_files = list()
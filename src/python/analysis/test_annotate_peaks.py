@@ -0,0 +1,83 @@
+import pandas as pd
+import sys
+
+# annotate_peaks parses its command line on import
+argv, sys.argv = sys.argv, ['annotate_peaks.py', 'peaks.saf', 'db', 'hg38', 'test', '--native']
+try:
+    from annotate_peaks import annotate_native, format_variant_function, regroup_gene_regions
+finally:
+    sys.argv = argv
+
+# refGene rows (0-based starts, as in UCSC): A and C on the + strand, B on
+# the - strand, all coding, and N non-coding (cdsStart == cdsEnd)
+REFGENE = [
+    ('NM_1', 'chr1', '+', 1000, 5000, 1500, 4500, 2, '1000,3000,', '2000,5000,', 'A'),
+    ('NM_3', 'chr1', '+', 6000, 7000, 6200, 6800, 1, '6000,', '7000,', 'C'),
+    ('NM_2', 'chr1', '-', 20000, 24000, 20500, 23500, 1, '20000,', '24000,', 'B'),
+    ('NR_1', 'chr1', '+', 40000, 41000, 41000, 41000, 2, '40000,40700,', '40300,41000,', 'N'),
+]
+
+# peaks (1-based, inclusive, as passed to ANNOVAR) with the region and
+# gene description ANNOVAR reports for them at -neargene 1000
+PEAKS = [
+    ('utr5', 'chr1', 1100, 1200, 'UTR5', 'A'),
+    ('exonic', 'chr1', 1600, 1700, 'exonic', 'A'),
+    ('intronic', 'chr1', 2500, 2600, 'intronic', 'A'),
+    ('splicing', 'chr1', 2001, 2001, 'splicing', 'A'),
+    ('upstream_plus', 'chr1', 500, 600, 'upstream', 'A(dist=401)'),
+    ('flanking', 'chr1', 5200, 5300, 'upstream;downstream', 'C(dist=701);A(dist=200)'),
+    ('intergenic', 'chr1', 10000, 10100, 'intergenic', 'C(dist=3000),B(dist=9901)'),
+    ('downstream_minus', 'chr1', 19800, 19900, 'downstream', 'B(dist=101)'),
+    ('utr3_minus', 'chr1', 20100, 20200, 'UTR3', 'B'),
+    ('upstream_minus', 'chr1', 24100, 24200, 'upstream', 'B(dist=100)'),
+    ('ncrna_intronic', 'chr1', 40400, 40500, 'ncRNA_intronic', 'N'),
+    ('ncrna_exonic', 'chr1', 40100, 40200, 'ncRNA_exonic', 'N'),
+    ('unplaced', 'chr2', 100, 200, 'intergenic', 'NONE(dist=NONE),NONE(dist=NONE)'),
+]
+
+def write_inputs(tmp_path):
+
+    db = tmp_path / 'db'
+    db.mkdir()
+
+    rows = [(0,) + r[:10] + (0, r[10], 'cmpl', 'cmpl', '0,') for r in REFGENE]
+    pd.DataFrame(rows).to_csv(db / 'hg38_refGene.txt', sep='\t', header=False, index=False)
+
+    saf = tmp_path / 'peaks.saf'
+    pd.DataFrame([p[:4] + ('+',) for p in PEAKS]).to_csv(saf, sep='\t', header=False, index=False)
+
+    return(str(saf), str(db))
+
+def test_annotate_native(tmp_path):
+
+    saf, db = write_inputs(tmp_path)
+
+    df = annotate_native(saf, db, 'hg38', 1000)
+
+    assert df['peak_id'].tolist() == [p[0] for p in PEAKS]
+    assert df['gene_region'].tolist() == [p[4] for p in PEAKS]
+    assert df['gene_desc'].tolist() == [p[5] for p in PEAKS]
+
+def test_annotate_native_regrouped(tmp_path):
+
+    saf, db = write_inputs(tmp_path)
+
+    df = regroup_gene_regions(format_variant_function(annotate_native(saf, db, 'hg38', 1000)))
+    calls = {(p, g): (str(r), d) for p, g, r, d in zip(df['peak_id'], df['gene'], df['gene_region'], df['dist'])}
+
+    # flanking genes are split into one row each and NONE rows dropped
+    assert calls == {
+        ('utr5', 'A'): ('promoter-proximal', 0),
+        ('exonic', 'A'): ('exonic', 0),
+        ('intronic', 'A'): ('intronic', 0),
+        ('splicing', 'A'): ('intronic', 0),
+        ('upstream_plus', 'A'): ('promoter-proximal', 401),
+        ('flanking', 'C'): ('promoter-proximal', 701),
+        ('flanking', 'A'): ('UTR3', 200),
+        ('intergenic', 'C'): ('intergenic', 3000),
+        ('downstream_minus', 'B'): ('UTR3', 101),
+        ('utr3_minus', 'B'): ('UTR3', 0),
+        ('upstream_minus', 'B'): ('promoter-proximal', 100),
+        ('ncrna_intronic', 'N'): ('intronic', 0),
+        ('ncrna_exonic', 'N'): ('exonic', 0),
+    }
@@ -0,0 +1,159 @@
+import numpy as np
+import struct
+import re
+import pytest
+from bgzf import compress_block, EOF_BLOCK
+import bam
+
+# a small hand-built BAM: the header in its own BGZF block and the records
+# of each reference in the next one, so the virtual offsets for the .bai
+# are the block starts
+
+REFERENCES = [('chr1', 10000), ('chr2', 10000), ('chr3', 10000)]
+
+CIGAR_OPS = 'MIDNSHP=X'
+
+def encode_tags(tags):
+
+    data = b''
+    for tag, typ, value in tags:
+        if typ == 'Z':
+            data += tag.encode() + b'Z' + value.encode() + b'\x00'
+        else:
+            data += tag.encode() + typ.encode() + struct.pack('<' + bam.AUX_INTS[typ], value)
+
+    return(data)
+
+def encode_record(name, ref_id, pos, cigar, flag=0, tags=(), next_ref_id=-1, next_pos=-1):
+
+    ops = [(int(n), CIGAR_OPS.index(op)) for n, op in re.findall(r'([0-9]+)([MIDNSHP=X])', cigar)]
+    read_name = name.encode() + b'\x00'
+
+    body = struct.pack('<iiBBHHHiiii', ref_id, pos, len(read_name), 60, 4680, len(ops), flag, 0, next_ref_id, next_pos, 0)
+    body += read_name + b''.join(struct.pack('<I', n << 4 | op) for n, op in ops) + encode_tags(tags)
+
+    return(struct.pack('<i', len(body)) + body)
+
+def write_bam(path, records, sorted_header=True, index=True, meta_bin=True):
+
+    # records are encode_record arguments, written in the order given (one
+    # block per reference); index writes path.bai, with the 37450 pseudo-bin
+    # unless meta_bin is False
+
+    text = '@HD\tVN:1.6\tSO:{}\n'.format('coordinate' if sorted_header else 'unknown').encode()
+    header = b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(REFERENCES))
+    for name, length in REFERENCES:
+        header += struct.pack('<i', len(name) + 1) + name.encode() + b'\x00' + struct.pack('<i', length)
+
+    blocks = [compress_block(header)]
+    spans = [None] * len(REFERENCES)
+
+    for ref_id in sorted(set(r[1] for r in records)):
+        offset = sum(len(b) for b in blocks)
+        data = b''.join(encode_record(*r) for r in records if r[1] == ref_id)
+        blocks.append(compress_block(data))
+        spans[ref_id] = (offset << 16, (offset + len(blocks[-1])) << 16)
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(blocks) + EOF_BLOCK)
+
+    if not index:
+        return(path)
+
+    bai = b'BAI\x01' + struct.pack('<i', len(REFERENCES))
+    for span in spans:
+        if span is None:
+            bai += struct.pack('<ii', 0, 0)
+            continue
+        bins = [(4681, [span])] + ([(37450, [span, (0, 0)])] if meta_bin else [])
+        bai += struct.pack('<i', len(bins))
+        for bin_id, chunks in bins:
+            bai += struct.pack('<Ii', bin_id, len(chunks)) + b''.join(struct.pack('<QQ', *c) for c in chunks)
+        bai += struct.pack('<i', 0)
+
+    with open(path + '.bai', 'wb') as f:
+        f.write(bai)
+
+    return(path)
+
+RECORDS = [
+    ('plain', 0, 149, '50M', 0, [('NH', 'C', 1)]),
+    ('spliced', 0, 179, '10M200N10M', 0, [('RG', 'Z', 'NH:i:2'), ('NH', 'i', 1)]),
+    ('deleted', 0, 189, '5S5M120D5M3I2M', 0x10),
+    ('multi', 0, 300, '20M', 0, [('XS', 's', -5), ('NH', 'S', 3)]),
+    ('secondary', 0, 400, '20M', 0x100),
+    ('unmapped', 0, 400, '', 0x4),
+    ('other', 1, 120, '50M', 0, [('NH', 'c', 1)]),
+]
+
+def batches(path, voffset=None):
+
+    return(list(bam.iter_batches(path, voffset)))
+
+def test_header(tmp_path):
+
+    path = write_bam(str(tmp_path / 'a.bam'), RECORDS)
+    header = bam.read_header(path)
+
+    assert header['names'] == ['chr1', 'chr2', 'chr3']
+    assert header['lengths'] == [10000, 10000, 10000]
+    assert bam.is_coordinate_sorted(header)
+    assert not bam.is_coordinate_sorted(bam.read_header(write_bam(str(tmp_path / 'b.bam'), RECORDS, sorted_header=False)))
+
+def test_record_batch(tmp_path):
+
+    path = write_bam(str(tmp_path / 'a.bam'), RECORDS)
+    batch, = batches(path)
+
+    assert len(batch) == len(RECORDS)
+    assert batch.names(np.arange(len(batch))).tolist() == [r[0].encode() for r in RECORDS]
+    assert batch.flag.tolist() == [r[4] for r in RECORDS]
+    assert batch.ref_id.tolist() == [0, 0, 0, 0, 0, 0, 1]
+
+    # N and D split the aligned blocks; S, I and an empty CIGAR add none
+    read, start, end = batch.aligned_blocks(np.array([0, 1, 2, 5]))
+    assert list(zip(read.tolist(), start.tolist(), end.tolist())) == [(0, 149, 199), (1, 179, 189), (1, 389, 399), (2, 189, 194), (2, 314, 319), (2, 319, 321)]
+    assert batch.reference_end(np.array([0, 1, 2])).tolist() == [199, 399, 321]
+
+def test_tag_int(tmp_path):
+
+    path = write_bam(str(tmp_path / 'a.bam'), RECORDS)
+    batch, = batches(path)
+
+    # 'NH' inside a string tag is not taken for the tag itself
+    assert batch.tag_int(b'NH', np.arange(len(batch))).tolist() == [1, 1, -1, 3, -1, -1, 1]
+    assert batch.tag_int(b'XS', np.array([2, 3])).tolist() == [-1, -5]
+    assert batch.tag_int(b'NM', np.arange(len(batch))).tolist() == [-1] * len(RECORDS)
+
+def test_index(tmp_path):
+
+    path = write_bam(str(tmp_path / 'a.bam'), RECORDS)
+    spans = bam.read_index(path)
+
+    assert spans[2] is None
+    assert [batch.ref_id.tolist() for batch in batches(path, spans[1][0])] == [[1]]
+
+    # without the pseudo-bin the spans come from the bins' chunks
+    assert bam.read_index(write_bam(str(tmp_path / 'b.bam'), RECORDS, meta_bin=False)) == spans
+    assert bam.read_index(write_bam(str(tmp_path / 'c.bam'), RECORDS, index=False)) is None
+
+    with open(path + '.bai', 'r+b') as f:
+        f.write(b'BAM')
+    with pytest.raises(ValueError, match='not a BAI index'):
+        bam.read_index(path)
+
+def test_shards(tmp_path):
+
+    path = write_bam(str(tmp_path / 'a.bam'), RECORDS)
+    spans = bam.read_index(path)
+
+    # one shard per indexed reference with records
+    assert bam.shards(path, {'chr1', 'chr2', 'chr3'}) == [([0], spans[0][0], True), ([1], spans[1][0], True)]
+    assert [b.ref_id.tolist() for b in bam.iter_shard(path, [0], spans[0][0], True)] == [[0, 0, 0, 0, 0, 0, 1]]
+
+    # without an index, the whole file; stop only for sorted input
+    path = write_bam(str(tmp_path / 'b.bam'), RECORDS, index=False)
+    assert bam.shards(path, {'chr2'}) == [([1], bam.read_header(path)['voffset'], True)]
+    path = write_bam(str(tmp_path / 'c.bam'), RECORDS, sorted_header=False, index=False)
+    assert bam.shards(path, {'chr2'}) == [([1], bam.read_header(path)['voffset'], False)]
+    assert bam.shards(str(tmp_path / 'c.bam'), {'chrX'}) == []
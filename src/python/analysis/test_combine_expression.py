@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+import sys
+
+# combine_expression parses its command line on import
+argv, sys.argv = sys.argv, ['combine_expression.py', 'samples.json', 'genes.gtf', '--mode', 'tpm']
+try:
+    from combine_expression import summarize_tpm
+finally:
+    sys.argv = argv
+
+def write_quant(path, names, tpm):
+
+    pd.DataFrame({'Name': names, 'Length': 1000, 'EffectiveLength': 800.0, 'TPM': tpm, 'NumReads': 10.0}).to_csv(path, sep='\t', index=False)
+    return(str(path))
+
+def test_summarize_tpm(tmp_path):
+
+    tx2gene = pd.Series(['G1', 'G1', 'G2'], index=['T1', 'T2', 'T3'])
+
+    a = write_quant(tmp_path / 'a.sf', ['T1', 'T2', 'T3', 'T4'], [1.0, 2.0, 3.0, 4.0])
+    b = write_quant(tmp_path / 'b.sf', ['T1', 'T2', 'T3', 'T4'], [0.5, 0.25, 0.0, 9.0])
+
+    df = summarize_tpm([a, b], tx2gene)
+
+    assert list(df.index) == ['G1', 'G2']
+    assert df.values.tolist() == [[3.0, 0.75], [3.0, 0.0]]
+
+def test_summarize_tpm_transcript_mismatch(tmp_path):
+
+    tx2gene = pd.Series(['G1', 'G1', 'G2'], index=['T1', 'T2', 'T3'])
+
+    a = write_quant(tmp_path / 'a.sf', ['T1', 'T2', 'T3'], [1.0, 2.0, 3.0])
+    b = write_quant(tmp_path / 'b.sf', ['T1', 'T3', 'T2'], [1.0, 2.0, 3.0])
+
+    with pytest.raises(ValueError, match='transcripts in'):
+        summarize_tpm([a, b], tx2gene)
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+from coveragestore import CoverageWriter, create_coverage, open_coverage, read_coverage_values, text_to_coverage, coverage_to_text, region_slice
+
+REGIONS = [('chr1', 100, 104, 'p1'), ('chr1', 200, 201, 'p2'), ('chr2', 0, 3, 'p3')]
+DEPTHS = [[0, 3, 5, 2], [7], [1, 1, 0]]
+
+def set_version(path, version):
+
+    with open(path, 'rb') as f:
+        blob = f.read()
+
+    with open(path, 'wb') as f:
+        f.write(blob.replace(b'"version": 1', '"version": {}'.format(version).encode()))
+
+def test_writer_round_trip(tmp_path):
+
+    path = str(tmp_path / 'a.bcov')
+
+    with CoverageWriter(path, dtype=np.uint16) as writer:
+        for (c, s, e, n), d in zip(REGIONS, DEPTHS):
+            writer.add(c, s, e, n, d)
+
+    values, regions = open_coverage(path)
+
+    assert values.dtype == np.uint16
+    assert values.tolist() == sum(DEPTHS, [])
+    assert list(regions[['chr', 'start', 'end', 'name']].itertuples(index=False, name=None)) == REGIONS
+    assert regions['offset'].tolist() == [0, 4, 5]
+    assert values[region_slice(regions, 'p3')].tolist() == [1, 1, 0]
+
+def test_create_coverage(tmp_path):
+
+    path = str(tmp_path / 'a.bcov')
+
+    M = create_coverage(path, REGIONS)
+    M[:] = sum(DEPTHS, [])
+    M.flush()
+    del M
+
+    values, regions = open_coverage(path)
+
+    assert values.tolist() == sum(DEPTHS, [])
+    assert regions.index.tolist() == ['p1', 'p2', 'p3']
+
+def test_text_round_trip(tmp_path):
+
+    # bedtools coverage -d layout, with an extra BED column that is dropped
+    rows = [(c, s, e, n, '.', i + 1, d) for (c, s, e, n), depths in zip(REGIONS, DEPTHS) for i, d in enumerate(depths)]
+    text = tmp_path / 'a.bed'
+    pd.DataFrame(rows).to_csv(text, sep='\t', header=False, index=False)
+
+    store = text_to_coverage(str(text), str(tmp_path / 'a.bcov'), chunk_size=3)
+    back = coverage_to_text(store, str(tmp_path / 'b.bed'))
+
+    expected = pd.DataFrame(rows).drop(columns=4)
+    assert pd.read_csv(back, sep='\t', header=None).values.tolist() == expected.values.tolist()
+
+    values, regions = read_coverage_values(str(text))
+    assert values.tolist() == sum(DEPTHS, [])
+    assert regions['offset'].tolist() == [0, 4, 5]
+
+def test_writer_value_count(tmp_path):
+
+    path = str(tmp_path / 'a.bcov')
+
+    with pytest.raises(ValueError, match='values for 4 bases'):
+        with CoverageWriter(path) as writer:
+            writer.add('chr1', 100, 104, 'p1', [1, 2, 3])
+
+    writer = CoverageWriter(path)
+    writer.add_region('chr1', 100, 104, 'p1')
+    writer.write([1, 2, 3])
+    with pytest.raises(ValueError, match='does not match the regions'):
+        writer.close()
+
+def test_corrupt_header(tmp_path):
+
+    path = str(tmp_path / 'a.bcov')
+    create_coverage(path, REGIONS)
+
+    set_version(path, 2)
+    with pytest.raises(ValueError, match='unsupported coverage store version 2'):
+        open_coverage(path)
+
+    with open(path, 'r+b') as f:
+        f.write(b'\x00')
+    with pytest.raises(ValueError, match='not a binary coverage store'):
+        open_coverage(path)
+
+def test_text_columns(tmp_path):
+
+    text = tmp_path / 'a.bed'
+    text.write_text('chr1\t100\t1\n')
+
+    with pytest.raises(ValueError, match='found 3 columns'):
+        text_to_coverage(str(text), str(tmp_path / 'a.bcov'))
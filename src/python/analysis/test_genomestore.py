@@ -0,0 +1,77 @@
+import gzip
+import os
+import pytest
+from genomestore import fasta_to_genome, open_genome, is_genome_store
+
+FASTA = '>chr1 first\nACGTacgt\nNNAC\n>chr2\n\nGGT\n>chrM\n'
+
+def set_version(path, version):
+
+    with open(path, 'rb') as f:
+        blob = f.read()
+
+    with open(path, 'wb') as f:
+        f.write(blob.replace(b'"version": 1', '"version": {}'.format(version).encode()))
+
+def test_round_trip(tmp_path):
+
+    fasta = tmp_path / 'genome.fa.gz'
+    with gzip.open(fasta, 'wt') as f:
+        f.write(FASTA)
+
+    path = fasta_to_genome(str(fasta), str(tmp_path / 'genome.gstore'))
+    genome = open_genome(path)
+
+    assert genome.keys() == ['chr1', 'chr2', 'chrM']
+    assert genome.lengths == [12, 3, 0]
+    assert genome.sequence('chr1') == 'ACGTacgtNNAC'
+    assert genome.sequence('chr1', 3, 6) == 'Tac'
+    assert genome.sequence('chr2') == 'GGT'
+    assert genome.sequence('chrM') == ''
+    assert 'chr2' in genome and 'chr3' not in genome
+
+def test_corrupt_header(tmp_path):
+
+    fasta = tmp_path / 'genome.fa'
+    fasta.write_text(FASTA)
+    path = fasta_to_genome(str(fasta), str(tmp_path / 'genome.gstore'))
+
+    set_version(path, 2)
+    with pytest.raises(ValueError, match='unsupported genome store version 2'):
+        open_genome(path)
+
+    with open(path, 'r+b') as f:
+        f.write(b'\x00')
+    with pytest.raises(ValueError, match='not a genome store'):
+        open_genome(path)
+
+def test_rebuild(tmp_path):
+
+    # a failed build leaves the previous store in place and no temporary
+    # file; a successful one replaces it
+
+    path = str(tmp_path / 'genome.gstore')
+
+    fasta = tmp_path / 'genome.fa'
+    fasta.write_text(FASTA)
+    fasta_to_genome(str(fasta), path)
+
+    bad = tmp_path / 'duplicate.fa'
+    bad.write_text('>chr1\nAC\n>chr1\nGT\n')
+    with pytest.raises(ValueError, match='duplicate sequence name'):
+        fasta_to_genome(str(bad), path)
+
+    bad = tmp_path / 'headless.fa'
+    bad.write_text('ACGT\n')
+    with pytest.raises(ValueError, match='does not start with a FASTA header'):
+        fasta_to_genome(str(bad), path)
+
+    assert sorted(os.listdir(tmp_path)) == ['duplicate.fa', 'genome.fa', 'genome.gstore', 'headless.fa']
+    assert open_genome(path).sequence('chr1') == 'ACGTacgtNNAC'
+
+    fasta.write_text('>chrX\nTTTT\n')
+    fasta_to_genome(str(fasta), path)
+
+    assert is_genome_store(path)
+    assert open_genome(path).keys() == ['chrX']
+    assert sorted(os.listdir(tmp_path)) == ['duplicate.fa', 'genome.fa', 'genome.gstore', 'headless.fa']
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from matrixstore import save_matrix, load_matrix, read_matrix, text_to_matrix, matrix_to_text, create_matrix
+
+def set_version(path, version):
+
+    with open(path, 'rb') as f:
+        blob = f.read()
+
+    with open(path, 'wb') as f:
+        f.write(blob.replace(b'"version": 1', '"version": {}'.format(version).encode()))
+
+def test_round_trip(tmp_path):
+
+    path = str(tmp_path / 'a.bmat')
+
+    df = pd.DataFrame([[1.5, 0.0], [2.25, np.nan], [0.0, 7.0]], index=pd.Index(['g1', 'g2', 'g3'], name='Name'), columns=['s1', 's2'])
+    save_matrix(df, path)
+
+    # string labels are read back as object, whatever pandas infers for df
+    result = load_matrix(path)
+    pd.testing.assert_frame_equal(result, df, check_index_type=False, check_column_type=False)
+    assert result.values.flags['F_CONTIGUOUS']
+
+    # numeric labels are restored as such
+    df = pd.DataFrame(np.arange(6, dtype=np.int32).reshape(3, 2), index=[10, 20, 30], columns=['s1', 's2'])
+    save_matrix(df, path)
+
+    pd.testing.assert_frame_equal(read_matrix(path), df, check_column_type=False)
+
+def test_text_round_trip(tmp_path):
+
+    df = pd.DataFrame([[1, 0], [2, 5], [0, 7]], index=pd.Index(['g1', 'g2', 'g3'], name='Name'), columns=['s1', 's2'])
+
+    gct = str(tmp_path / 'a.gct')
+    with open(gct, 'w') as f:
+        f.write('3\t2\n')
+        df.to_csv(f, sep='\t')
+
+    store = text_to_matrix(gct, str(tmp_path / 'a.bmat'), chunk_size=2)
+    pd.testing.assert_frame_equal(load_matrix(store), df, check_index_type=False, check_column_type=False)
+
+    back = matrix_to_text(store, str(tmp_path / 'b.gct'))
+    with open(gct) as a, open(back) as b:
+        assert a.read() == b.read()
+
+def test_text_dtype(tmp_path):
+
+    # the first chunk is integer, the second is not
+    text = str(tmp_path / 'a.txt')
+    pd.DataFrame({'s1': [1, 2, 0.5]}, index=pd.Index(['g1', 'g2', 'g3'], name='Name')).to_csv(text, sep='\t', float_format='%g')
+
+    with pytest.raises(ValueError, match='pass an explicit dtype'):
+        text_to_matrix(text, str(tmp_path / 'a.bmat'), chunk_size=2)
+
+    text_to_matrix(text, str(tmp_path / 'a.bmat'), dtype=np.float64, chunk_size=2)
+    assert load_matrix(str(tmp_path / 'a.bmat'))['s1'].tolist() == [1.0, 2.0, 0.5]
+
+def test_corrupt_header(tmp_path):
+
+    path = str(tmp_path / 'a.bmat')
+    save_matrix(pd.DataFrame({'s1': [1.0]}, index=['g1']), path)
+
+    set_version(path, 2)
+    with pytest.raises(ValueError, match='unsupported matrix store version 2'):
+        load_matrix(path)
+
+    with open(path, 'r+b') as f:
+        f.write(b'\x00')
+    with pytest.raises(ValueError, match='not a binary matrix store'):
+        load_matrix(path)
+
+def test_unsupported_dtype(tmp_path):
+
+    with pytest.raises(ValueError, match='unsupported matrix dtype'):
+        create_matrix(str(tmp_path / 'a.bmat'), ['g1'], ['s1'], dtype=object)
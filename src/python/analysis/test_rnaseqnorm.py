@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import time
+from rnaseqnorm import normalize_quantiles
+
+# parity of normalize_quantiles with the previous per-row implementation
+# (kept here as the reference); the wider benchmark and stored reference
+# outputs are in benchmark_rnaseqnorm.py
+
+def legacy_normalize_quantiles(df):
+
+    M = df.values.copy()
+
+    Q = M.argsort(axis=0)
+    m,n = M.shape
+
+    # compute quantile vector
+    quantiles = np.zeros(m)
+    for i in range(n):
+        quantiles += M[Q[:,i],i]
+    quantiles = quantiles / n
+
+    for i in range(n):
+        # Get equivalence classes; unique values == 0
+        dupes = np.zeros(m, dtype=np.int64)
+        for j in range(m-1):
+            if M[Q[j,i],i]==M[Q[j+1,i],i]:
+                dupes[j+1] = dupes[j]+1
+
+        # Replace column with quantile ranks
+        M[Q[:,i],i] = quantiles
+
+        # Average together equivalence classes
+        j = m-1
+        while j >= 0:
+            if dupes[j] == 0:
+                j -= 1
+            else:
+                idxs = Q[j-dupes[j]:j+1,i]
+                M[idxs,i] = np.median(M[idxs,i])
+                j -= 1 + dupes[j]
+
+    return pd.DataFrame(M, index=df.index, columns=df.columns)
+
+def counts(m, n, seed):
+
+    # tie-heavy negative binomial counts, with all-zero and constant rows
+    rng = np.random.default_rng(seed)
+    mu = rng.lognormal(mean=1, sigma=1.5, size=(m, 1)) * rng.uniform(0.5, 2, size=(1, n))
+    Y = rng.negative_binomial(2, 2/(2+mu)).astype(np.float64)
+    Y[:m//50] = 0
+    Y[m//50:m//25] = 7
+
+    return(pd.DataFrame(Y, index=['g{}'.format(i) for i in range(m)], columns=['s{}'.format(i) for i in range(n)]))
+
+def test_normalize_quantiles_parity():
+
+    for m, n, seed in [(1, 3, 0), (50, 1, 1), (500, 6, 2), (3000, 12, 3)]:
+
+        df = counts(m, n, seed)
+        expected = legacy_normalize_quantiles(df)
+        result = normalize_quantiles(df)
+
+        assert result.index.equals(df.index) and result.columns.equals(df.columns)
+        np.testing.assert_array_equal(result.values, expected.values)
+
+def test_normalize_quantiles_timing():
+
+    df = counts(5000, 8, 4)
+
+    t = time.perf_counter()
+    legacy_normalize_quantiles(df)
+    t_legacy = time.perf_counter() - t
+
+    t = time.perf_counter()
+    normalize_quantiles(df)
+    t_new = time.perf_counter() - t
+
+    assert t_new < t_legacy
@@ -0,0 +1,86 @@
+import pytest
+import sys
+from test_bam import write_bam
+
+# summarize_peak_counts parses its command line on import
+argv, sys.argv = sys.argv, ['summarize_peak_counts.py', 'samples.json', 'peaks.saf', 'test', '--native']
+try:
+    from summarize_peak_counts import count_native
+finally:
+    sys.argv = argv
+
+# P3 is one peak (meta-feature) of two features; P5 has no reads
+SAF = [
+    ('P1', 'chr1', 100, 199),
+    ('P2', 'chr1', 300, 399),
+    ('P3', 'chr1', 600, 649),
+    ('P3', 'chr1', 700, 749),
+    ('P4', 'chr2', 100, 199),
+    ('P5', 'chr3', 100, 199),
+]
+
+# reads and the peak featureCounts assigns them to (SAF coordinates are
+# 1-based, BAM positions 0-based)
+READS = [
+    ('deleted', 0, 89, '5M120D5M'),                         # spans P1, no aligned base in it
+    ('plain', 0, 149, '50M'),                               # P1
+    ('secondary', 0, 149, '50M', 0x100),
+    ('supplementary', 0, 149, '50M', 0x800),
+    ('multi', 0, 149, '50M', 0, [('NH', 'C', 2)]),
+    ('unique', 0, 149, '50M', 0, [('NH', 'C', 1)]),         # P1
+    ('ambiguous', 0, 179, '10M200N10M'),                    # P1 and P2
+    ('spliced', 0, 209, '10M150N10M'),                      # P2, first block between peaks
+    ('clipped', 0, 319, '5S20M3I20M'),                      # P2
+    ('meta', 0, 640, '10M50N10M'),                          # both features of P3
+    ('unmapped', 0, 700, '', 0x4),
+    ('other', 1, 120, '50M'),                               # P4
+]
+
+# read pairs, counted once per fragment from both mates' overlaps
+PAIRS = [
+    ('mate_unmapped', 0, 110, '20M', 0x1 | 0x8 | 0x40),    # P1, by itself
+    ('both', 0, 120, '20M', 0x41, [], 0, 160),              # P1 (both mates)
+    ('ambiguous', 0, 130, '20M', 0x41, [], 0, 320),         # P1 and P2
+    ('secondary', 0, 135, '20M', 0x181, [], 0, 330),
+    ('both', 0, 160, '20M', 0x81, [], 0, 120),
+    ('second', 0, 205, '10M', 0x41, [], 0, 350),            # P2 (second mate)
+    ('ambiguous', 0, 320, '20M', 0x81, [], 0, 130),
+    ('secondary', 0, 330, '20M', 0x41, [], 0, 360),         # P2
+    ('second', 0, 350, '20M', 0x81, [], 0, 205),
+    ('secondary', 0, 360, '20M', 0x81, [], 0, 330),
+    ('first', 0, 640, '10M', 0x41, [], 0, 900),             # P3 (first mate)
+    ('first', 0, 900, '10M', 0x81, [], 0, 640),
+    ('chimeric', 0, 5000, '20M', 0x81, [], 1, 120),
+    ('chimeric', 1, 120, '50M', 0x41, [], 0, 5000),         # P4 (mate on chr1)
+]
+
+def write_saf(tmp_path):
+
+    saf = tmp_path / 'peaks.saf'
+    saf.write_text('GeneID\tChr\tStart\tEnd\tStrand\n' + ''.join('{}\t{}\t{}\t{}\t+\n'.format(*f) for f in SAF))
+
+    return(str(saf))
+
+@pytest.mark.parametrize('options', [{}, {'index': False}, {'index': False, 'sorted_header': False}, {'meta_bin': False}])
+def test_count_native(tmp_path, options):
+
+    saf = write_saf(tmp_path)
+    a = write_bam(str(tmp_path / 'a.bam'), READS, **options)
+    b = write_bam(str(tmp_path / 'b.bam'), READS[-1:], **options)
+
+    df = count_native([('S2', a), ('S1', b)], saf, 1, False)
+
+    assert list(df.columns) == ['S1', 'S2']
+    assert list(df.index) == ['P1', 'P2', 'P3', 'P4', 'P5']
+    assert df['S2'].tolist() == [2, 2, 1, 1, 0]
+    assert df['S1'].tolist() == [0, 0, 0, 1, 0]
+
+@pytest.mark.parametrize('options', [{}, {'index': False}, {'index': False, 'sorted_header': False}])
+def test_count_native_paired(tmp_path, options):
+
+    saf = write_saf(tmp_path)
+    a = write_bam(str(tmp_path / 'a.bam'), PAIRS, **options)
+
+    df = count_native([('S1', a)], saf, 2, True)
+
+    assert df['S1'].tolist() == [2, 2, 1, 1, 0]